@@ -0,0 +1,159 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import logging
+import time
+from collections import OrderedDict
+import bson
+from bson.son import SON
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60
+
+
+class QueryCache(object):
+    """Cache of query results, bounded in bytes and evicted LRU
+
+    results are kept for the ttl of their collection, and all the
+    results of a collection are dropped when it is written through this
+    process. Writes made by other processes are only seen once the
+    cached results expire.
+
+    Every query hitting the cache gets its own copy of the cached
+    documents, so they can be modified like the documents of a query.
+
+    >>> cache = QueryCache(ttl=0, ttls={'countries': 3600})
+    >>> Database.init(['localhost:27017'], 'test', cache=cache)
+
+    :Parameters:
+      - `max_bytes` (optional): estimated size of the cached results,
+        the least recently used ones are dropped above it
+      - `ttl` (optional): seconds the results of a collection are cached,
+        0 to cache only the collections of `ttls`
+      - `ttls` (optional): ttl of specific collections, keyed by name
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=DEFAULT_TTL, ttls=None):
+        assert max_bytes > 0
+        assert ttl >= 0
+
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._ttls = dict(ttls or {})
+        self._entries = OrderedDict()  # key -> (expires, size, value)
+        self._namespaces = {}  # namespace -> keys of its entries
+        self._generations = {}
+        self._size = 0
+
+    def __repr__(self):
+        return "QueryCache entries:{0} bytes:{1}".format(len(self._entries), self._size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """Estimated bytes of the cached results"""
+        return self._size
+
+    def set_ttl(self, collection, ttl):
+        """Cache the results of `collection` for `ttl` seconds, 0 to stop
+        caching them"""
+        self._ttls[collection] = ttl
+
+    def ttl_for(self, collection, cache=None):
+        """Return the ttl of a query on `collection`, 0 if it isn't cached
+
+        `cache` is the option of the query: None to follow the collection
+        settings, False to bypass the cache, True to cache with the
+        collection ttl or the default one, or a ttl in seconds.
+        """
+        if cache is None:
+            return self._ttls.get(collection, self._ttl)
+        if cache is True:
+            return self._ttls.get(collection) or self._ttl or DEFAULT_TTL
+        return cache or 0
+
+    def key(self, namespace, operation, spec, fields=None, sort=None, skip=0, limit=0):
+        """Return the key of a query"""
+        query = SON([('o', operation), ('q', spec), ('f', fields),
+                     ('s', sort), ('k', skip), ('l', limit)])
+        return namespace, bson.BSON.encode(query)
+
+    def generation(self, namespace):
+        """Return a counter increased by every write on `namespace`
+
+        a result read before a write must not be stored after it.
+        """
+        return self._generations.get(namespace, 0)
+
+    def get(self, key):
+        """Return a copy of the result cached for `key`, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry[0] < time.time():
+            self._discard(key)
+            return None
+
+        self._entries[key] = self._entries.pop(key)
+        return copy.deepcopy(entry[2])
+
+    def put(self, key, value, size, ttl, generation=None):
+        """Cache a copy of `value`, of about `size` bytes, for `ttl` seconds
+
+        `value` is dropped if the namespace was written since `generation`.
+        """
+        namespace = key[0]
+        if generation is not None and generation != self.generation(namespace):
+            return
+
+        size += len(key[1])
+        if size > self._max_bytes:
+            return
+
+        if key in self._entries:
+            self._discard(key)
+
+        self._entries[key] = (time.time() + ttl, size, copy.deepcopy(value))
+        self._namespaces.setdefault(namespace, set()).add(key)
+        self._size += size
+
+        while self._size > self._max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def invalidate(self, namespace):
+        """Drop the results of `namespace`"""
+        self._generations[namespace] = self.generation(namespace) + 1
+        for key in list(self._namespaces.get(namespace, ())):
+            self._discard(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._namespaces.clear()
+        self._size = 0
+
+    def _discard(self, key):
+        expires, size, value = self._entries.pop(key)
+        self._size -= size
+
+        keys = self._namespaces[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._namespaces[key[0]]
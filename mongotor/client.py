@@ -21,8 +21,10 @@ import six
 from tornado import gen
 from mongotor.node import ReadPreference
 from mongotor.cursor import Cursor
+from mongotor.scan import ParallelScan
 from mongotor import message
 from mongotor import helpers
+from mongotor.errors import Error, NotMasterError
 
 log = logging.getLogger(__name__)
 
@@ -35,7 +37,8 @@ class Client(object):
         self._collection_name = database.get_collection_name(collection)
 
     @gen.engine
-    def insert(self, doc_or_docs, safe=True, check_keys=True, callback=None):
+    def insert(self, doc_or_docs, safe=True, check_keys=True, session=None,
+               callback=None):
         """Insert a document
 
         :Parameters:
@@ -45,6 +48,8 @@ class Client(object):
           - `check_keys` (optional): check if keys start with '$' or
             contain '.', raising :class:`~pymongo.errors.InvalidName`
             in either case
+          - `session` (optional): the :class:`~mongotor.session.Session`
+            whose following reads must see this write
           - `callback` : method which will be called when save is finished
         """
         if isinstance(doc_or_docs, dict):
@@ -57,22 +62,22 @@ class Client(object):
 
         log.debug("mongo: db.{0}.insert({1})".format(self._collection_name, doc_or_docs))
 
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
-
-        response, error = yield gen.Task(connection.send_message,
-                                         message_insert, safe)
+        response, error = yield gen.Task(self._send_write, message_insert, safe,
+                                         idempotent=all('_id' in doc for doc in doc_or_docs),
+                                         session=session)
 
         if callback:
             callback((response, error))
 
     @gen.engine
-    def remove(self, spec_or_id={}, safe=True, callback=None):
+    def remove(self, spec_or_id={}, safe=True, session=None, callback=None):
         """remove a document
 
         :Parameters:
         - `spec_or_id`: a query or a document id
         - `safe` (optional): safe insert operation
+        - `session` (optional): the session whose following reads must see
+          this write
         - `callback` : method which will be called when save is finished
         """
         if not isinstance(spec_or_id, dict):
@@ -84,18 +89,16 @@ class Client(object):
                                         safe, {})
 
         log.debug("mongo: db.{0}.remove({1})".format(self._collection_name, spec_or_id))
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
-
-        response, error = yield gen.Task(connection.send_message,
-                                         message_delete, safe)
+        response, error = yield gen.Task(self._send_write, message_delete, safe,
+                                         idempotent=list(spec_or_id) == ['_id'],
+                                         session=session)
 
         if callback:
             callback((response, error))
 
     @gen.engine
     def update(self, spec, document, upsert=False, safe=True,
-               multi=False, callback=None):
+               multi=False, session=None, callback=None):
         """Update a document(s) in this collection.
 
         :Parameters:
@@ -114,6 +117,8 @@ class Client(object):
             might eventually change to ``True``. It is recommended
             that you specify this argument explicitly for all update
             operations in order to prepare your code for that change.
+          - `session` (optional): the :class:`~mongotor.session.Session`
+            whose following reads must see this write
         """
         assert isinstance(spec, dict), "spec must be an instance of dict"
         assert isinstance(document, dict), "document must be an instance of dict"
@@ -126,14 +131,63 @@ class Client(object):
         log.debug("mongo: db.{0}.update({1}, {2}, {3}, {4})".format(
             self._collection_name, spec, document, upsert, multi))
 
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
+        response, error = yield gen.Task(self._send_write, message_update, safe,
+                                         idempotent=_idempotent_update(document),
+                                         session=session)
 
-        response, error = yield gen.Task(connection.send_message,
-                                         message_update, safe)
+        if callback:
+            callback((response, error))
+
+    @gen.engine
+    def _send_write(self, message_write, safe, idempotent=False, session=None,
+                    callback=None):
+        """Send a write message to the primary
+
+        a write refused by a former primary, or an `idempotent` write failed
+        with a retryable error, is sent once more to the primary found
+        after a topology refresh. A successful
+        write is recorded in `session`. The cached results of the
+        collection are dropped.
+        """
+        cache = self._database.cache
+        cache.invalidate(self._collection_name)
+
+        retried = False
+        while True:
+            try:
+                node = self._database.fast_node(ReadPreference.PRIMARY)
+                if node is None:
+                    node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
+                connection = yield gen.Task(node.connection)
+
+                response, error = yield gen.Task(connection.send_message,
+                                                 message_write, safe)
+                if error is None or retried or not self._can_retry(error, idempotent):
+                    break
+            except Error as e:
+                if retried or not self._can_retry(e, idempotent):
+                    raise
+
+            log.warn('retrying write on {0} after a retryable error'
+                     .format(self._collection_name))
+            retried = True
+            yield gen.Task(self._database.refresh)
+
+        # reads sent while the write was in flight may have seen the old data
+        cache.invalidate(self._collection_name)
+        if session and error is None:
+            session.record_write(response)
 
         callback((response, error))
 
+    def _can_retry(self, error, idempotent):
+        # a lost connection may have lost the reply of an applied write,
+        # a primary refusing the write didn't apply it
+        if not idempotent and not isinstance(error, NotMasterError):
+            return False
+
+        return self._database.should_retry(error)
+
     @gen.engine
     def find_one(self, spec_or_id=None, **kwargs):
         """Get a single document from the database.
@@ -151,10 +205,19 @@ class Client(object):
 
           - `**kwargs` (optional): any additional keyword arguments
             are the same as the arguments to :meth:`find`.
+
+        The lookups by _id only, issued during the same iteration of the
+        IOLoop, are read with one query by the
+        :class:`~mongotor.loader.IdLoader` of the database.
         """
         if spec_or_id is not None and not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
 
+        loader = self._database.id_loader
+        if loader and loader.can_load(self._collection, spec_or_id, kwargs):
+            loader.load(self._collection, spec_or_id['_id'], **kwargs)
+            return
+
         self.find(spec_or_id, limit=-1, **kwargs)
 
     def find(self, *args, **kwargs):
@@ -193,13 +256,52 @@ class Client(object):
             continue from the last document received. For details, see
             the `tailable cursor documentation
             <http://www.mongodb.org/display/DOCS/Tailable+Cursors>`_.
+            Walk it with :meth:`~mongotor.cursor.Cursor.tail` or
+            :meth:`~mongotor.cursor.Cursor.fetch_next` to receive the
+            documents as they are inserted; the query is sent again from
+            the last document seen if the cursor dies.
+          - `await_data` (optional): with `tailable`, the server waits a
+            while for new data before answering an empty batch
+          - `oplog_replay` (optional): query the oplog from a `ts`, the
+            cursor is sent again from the last `ts` seen
           - `sort` (optional): a list of (key, direction) pairs
             specifying the sort order for this query. See
             :meth:`~pymongo.cursor.Cursor.sort` for details.
           - `max_scan` (optional): limit the number of documents
             examined when performing the query
+          - `batch_size` (optional): documents returned by each batch of
+            the server side cursor. Without `callback` the returned
+            :class:`~mongotor.cursor.Cursor` can be walked batch by batch
+            with :meth:`~mongotor.cursor.Cursor.fetch_next`
+          - `prefetch` (optional): batches requested ahead while the
+            fetched documents are consumed through `fetch_next`. default is 0
+          - `prefetch_bytes` (optional): stop prefetching while this many
+            bytes are buffered. default is 16MB
+          - `exhaust` (optional): the server streams all the batches back
+            to back on the connection of the query, without a getMore round
+            trip per batch. Meant for full scans; closing the cursor early
+            closes its connection. Ignored by mongos
           - `read_preferences` (optional): The read preference for
             this query.
+          - `hedge` (optional): if True, the query is also sent to a second
+            eligible node when the first one doesn't reply within its usual
+            p95 latency, and the first reply wins.
+          - `session` (optional): a :class:`~mongotor.session.Session`; after
+            a write through the session, the query reads from the primary
+            or a secondary which replicated the write.
+          - `tags` (optional): a tag set, or a list of tag sets, the
+            secondary read from must match
+          - `pool` (optional): name of the connection pool used
+          - `max_time_ms` (optional): server side time limit of the query
+          - `cache` (optional): seconds the results are kept in the
+            :class:`~mongotor.cache.QueryCache` of the database, True for
+            the ttl of the collection, False to bypass the cache
+          - `single_flight` (optional): with a `callback`, share the result
+            of an identical query in flight instead of sending this one.
+            Defaults to the `single_flight` option of the database
+
+          Options not given default to the ones of the
+          :class:`~mongotor.routing.Route` of the collection.
         """
 
         log.debug("mongo: db.{0}.find({spec}).limit({limit}).sort({sort})".format(
@@ -238,6 +340,32 @@ class Client(object):
         """
         self.find().count(callback=callback)
 
+    def parallel_scan(self, partitions=4, spec=None, key='_id', ordered=False,
+                      read_preference=None, callback=None, **kwargs):
+        """Read the whole collection through `partitions` concurrent
+        cursors, each one scanning a range of the indexed `key`.
+
+        The ranges are split with `splitVector`, or from a sample of the
+        collection, and read from the secondaries when there are any.
+
+        :Parameters:
+          - `partitions` (optional): number of concurrent cursors
+          - `spec` (optional): restrict the scan to the matching documents
+          - `key` (optional): the indexed key splitting the collection
+          - `ordered` (optional): return the documents sorted by `key`
+          - `read_preference` (optional): SECONDARY_PREFERRED by default
+          - `callback` (optional): called with all the documents, otherwise
+            a :class:`~mongotor.scan.ParallelScan` is returned to stream them
+          - `**kwargs` (optional): other arguments of :meth:`find`
+        """
+        scan = ParallelScan(self._database, self._collection, partitions, spec=spec,
+                            key=key, ordered=ordered, read_preference=read_preference,
+                            **kwargs)
+        if callback:
+            scan.find(callback=callback)
+        else:
+            return scan
+
     @gen.engine
     def aggregate(self, pipeline, read_preference=None, callback=None):
         """Perform an aggregation using the aggregation framework on this
@@ -309,3 +437,10 @@ class Client(object):
                                          read_preference=read_preference)
 
         callback(response)
+
+
+def _idempotent_update(document):
+    """Return True if applying the update `document` twice changes nothing
+    more than applying it once: a replacement, or only $set"""
+    operators = [key for key in document if key.startswith('$')]
+    return not operators or operators == ['$set']
@@ -0,0 +1,582 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import datetime
+import hashlib
+import heapq
+import logging
+import re
+import six
+from bson import Binary, ObjectId, Regex
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.timestamp import Timestamp
+from tornado import gen
+from mongotor.client import Client
+from mongotor.database import Database
+from mongotor.errors import IntegrityError, ProgrammingError
+from mongotor.pagination import _get
+
+logger = logging.getLogger(__name__)
+
+
+def _id_shard_key(collection, document):
+    return document.get('_id')
+
+
+class ShardDatabase(Database):
+    """Database of one shard of a :class:`Cluster`
+
+    unlike :class:`~mongotor.database.Database` it isn't a singleton, every
+    shard owns its replica set.
+    """
+
+    def __new__(cls):
+        instance = object.__new__(cls)
+        instance._initialized = False
+        return instance
+
+    def close(self):
+        for node in self._nodes:
+            node.disconnect()
+        self._initialized = False
+
+
+class HashRing(object):
+    """Consistent hashing ring of the shards
+
+    every shard is placed `vnodes` times on the ring, so adding or removing
+    a shard moves about 1/n of the keys, evenly taken from the other shards.
+    """
+
+    def __init__(self, names=(), vnodes=160):
+        self._vnodes = vnodes
+        self._points = []
+        self._owners = {}
+        for name in names:
+            self.add(name)
+
+    def __repr__(self):
+        return "HashRing {0}".format(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def names(self):
+        return sorted(set(six.itervalues(self._owners)))
+
+    @staticmethod
+    def _hash(value):
+        if not isinstance(value, six.binary_type):
+            value = six.text_type(value).encode('utf-8')
+        return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+    def copy(self):
+        ring = HashRing(vnodes=self._vnodes)
+        ring._points = list(self._points)
+        ring._owners = dict(self._owners)
+        return ring
+
+    def add(self, name):
+        for i in range(self._vnodes):
+            point = self._hash('%s-%d' % (name, i))
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = name
+
+    def remove(self, name):
+        self._points = [point for point in self._points if self._owners[point] != name]
+        self._owners = dict((point, self._owners[point]) for point in self._points)
+
+    def get(self, key):
+        """Return the name of the shard owning `key`"""
+        if not self._points:
+            raise ProgrammingError('the cluster has no shard')
+
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+def _sort_value(value):
+    """Return a key comparing `value` as mongo does, by BSON type first"""
+    # missing fields sort as null, first but after MinKey
+    if value is None:
+        return (1,)
+    if isinstance(value, MinKey):
+        return (0,)
+    if isinstance(value, MaxKey):
+        return (12,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, six.integer_types + (float,)):
+        return (2, value)
+    if isinstance(value, Binary):
+        return (6, bytes(value))
+    if isinstance(value, six.string_types):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, [(key, _sort_value(item)) for key, item in six.iteritems(value)])
+    if isinstance(value, (list, tuple)):
+        return (5, [_sort_value(item) for item in value])
+    if isinstance(value, six.binary_type):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value)
+    if isinstance(value, datetime.datetime):
+        return (9, value)
+    if isinstance(value, Timestamp):
+        return (10, value)
+    if isinstance(value, (Regex, type(re.compile('')))):
+        return (11, value.pattern)
+    return (13, repr(value))
+
+
+class _SortKey(object):
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, document, sort):
+        self.values = [_sort_value(_get(document, key)) for key, direction in sort]
+        self.directions = [direction for key, direction in sort]
+
+    def __lt__(self, other):
+        for mine, theirs, direction in zip(self.values, other.values, self.directions):
+            if mine == theirs:
+                continue
+            return mine < theirs if direction > 0 else mine > theirs
+        return False
+
+
+def merge_sorted(results, sort):
+    """k-way merge of the sorted results of each shard
+
+    :Parameters:
+      - `results`: a list of document lists, each sorted by `sort`
+      - `sort`: a list of (key, direction) pairs
+    """
+    heap = []
+    for i, documents in enumerate(results):
+        if documents:
+            heap.append((_SortKey(documents[0], sort), i, 0))
+    heapq.heapify(heap)
+
+    merged = []
+    while heap:
+        key, i, position = heapq.heappop(heap)
+        merged.append(results[i][position])
+        position += 1
+        if position < len(results[i]):
+            heapq.heappush(heap, (_SortKey(results[i][position], sort), i, position))
+
+    return merged
+
+
+class Cluster(object):
+    """Client side sharding over independent replica sets
+
+    documents are spread across the shards by consistent hashing of their
+    shard key. Operations whose spec holds the shard key go to one shard,
+    the others are sent to every shard and their results merged.
+
+    >>> cluster = Cluster({'shard1': ['db1:27017', 'db2:27017'],
+    ...                    'shard2': ['db3:27017', 'db4:27017']}, 'app',
+    ...                   shard_key=lambda collection, document: document.get('user_id'))
+    >>> cluster.events.insert({'user_id': 1, ...}, callback=...)
+    >>> cluster.events.find({'type': 'click'}, sort=[('date', -1)], limit=10, callback=...)
+
+    :Parameters:
+      - `shards`: the addresses of the replica set of each shard, by name
+      - `dbname`: mongo database name
+      - `shard_key` (optional): function of the collection name and a
+        document or spec returning its shard key, or None if the spec
+        doesn't target a single key. The `_id` by default
+      - `vnodes` (optional): points of each shard on the hashing ring
+      - `**kwargs` (optional): options of :meth:`~mongotor.database.Database.init`
+        used by every shard
+    """
+
+    def __init__(self, shards, dbname, shard_key=None, vnodes=160, **kwargs):
+        self._dbname = dbname
+        self._kwargs = kwargs
+        self._shard_key = shard_key or _id_shard_key
+        self._shards = {}
+        for name, addresses in six.iteritems(shards):
+            self._shards[name] = self._create_shard(addresses)
+
+        self._ring = HashRing(self._shards, vnodes)
+        # the ring before the last add_shard or remove_shard, until rebalanced
+        self._previous_ring = None
+
+    def __repr__(self):
+        return "Cluster {0} {1}".format(self._dbname, sorted(self._shards))
+
+    def _create_shard(self, addresses):
+        shard = ShardDatabase()
+        shard._init(addresses, self._dbname, **self._kwargs)
+        return shard
+
+    @property
+    def dbname(self):
+        return self._dbname
+
+    @property
+    def shards(self):
+        """The databases of the shards, by name"""
+        return dict(self._shards)
+
+    @property
+    def rebalancing(self):
+        return self._previous_ring is not None
+
+    def shard_key(self, collection, document):
+        key = self._shard_key(collection, document or {})
+        if isinstance(key, dict):  # a query operator doesn't target a key
+            return None
+        return key
+
+    def shard_for(self, collection, document):
+        """Return the shard owning `document`, or None if it has no shard key"""
+        key = self.shard_key(collection, document)
+        if key is None:
+            return None
+        return self._shards[self._ring.get(key)]
+
+    def previous_shard_for(self, collection, document):
+        """While rebalancing, return the shard which owned `document`
+        before, if it isn't the current owner"""
+        key = self.shard_key(collection, document)
+        if key is None or self._previous_ring is None:
+            return None
+
+        shard = self._shards[self._previous_ring.get(key)]
+        if shard is not self.shard_for(collection, document):
+            return shard
+
+    def add_shard(self, name, addresses):
+        """Add a shard, :meth:`rebalance` moves its documents to it
+
+        until then, the documents not found on their new shard are
+        looked up on their previous one.
+        """
+        if name in self._shards:
+            raise ProgrammingError('shard %s already exists' % name)
+
+        self._shards[name] = self._create_shard(addresses)
+        self._previous_ring = self._previous_ring or self._ring.copy()
+        self._ring.add(name)
+
+    def remove_shard(self, name):
+        """Remove a shard from the ring, :meth:`rebalance` moves its
+        documents to the other shards and disconnects it"""
+        if name not in self._ring.names:
+            raise ProgrammingError('shard %s does not exist' % name)
+
+        self._previous_ring = self._previous_ring or self._ring.copy()
+        self._ring.remove(name)
+
+    @gen.engine
+    def rebalance(self, collections, batch_size=100, callback=None):
+        """Migrate the documents owned by another shard since the last
+        :meth:`add_shard` or :meth:`remove_shard`
+
+        every shard is scanned by `_id` range, the documents which moved
+        are copied to their new shard then removed from the old one.
+        `callback` is called with the number of documents moved.
+
+        :Parameters:
+          - `collections`: names of the sharded collections
+          - `batch_size` (optional): documents read per query
+        """
+        moved = 0
+        for collection in collections:
+            for name, shard in sorted(six.iteritems(self._shards)):
+                last_id = None
+                while True:
+                    spec = {'_id': {'$gt': last_id}} if last_id is not None else {}
+                    documents, error = yield gen.Task(Client(shard, collection).find, spec,
+                                                      sort=[('_id', 1)], limit=batch_size)
+                    if not documents:
+                        break
+
+                    for document in documents:
+                        target = self.shard_for(collection, document)
+                        if target is None or target is shard:
+                            continue
+
+                        done = yield gen.Task(self._move, collection, document,
+                                              shard, target)
+                        moved += done
+
+                    last_id = documents[-1]['_id']
+                    if len(documents) < batch_size:
+                        break
+
+        logger.info('{0} rebalanced, {1} documents moved'.format(self, moved))
+
+        for name in list(self._shards):
+            if name not in self._ring.names:
+                self._shards.pop(name).close()
+        self._previous_ring = None
+
+        if callback:
+            callback(moved)
+
+    @gen.engine
+    def _move(self, collection, document, source, target, callback):
+        """Move `document` from `source` to `target`, call `callback` with
+        True once it is removed from `source`
+
+        the document is only inserted if `target` doesn't hold it: a write
+        routed to `target` since the ring changed is newer than `document`.
+        """
+        response, error = yield gen.Task(Client(target, collection).insert, document)
+        if error and not isinstance(error, IntegrityError):
+            logger.warning('{0} failed to move {1}: {2}'.format(self, document['_id'], error))
+            callback(False)
+            return
+
+        yield gen.Task(Client(source, collection).remove, document['_id'])
+        callback(True)
+
+    def disconnect(self):
+        for shard in six.itervalues(self._shards):
+            shard.close()
+
+    def __getattr__(self, name):
+        """Get a sharded client collection by name.
+
+        :Parameters:
+          - `name`: the name of the collection
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ShardedClient(self, name)
+
+
+class ShardedClient(object):
+    """Operations on a collection sharded by a :class:`Cluster`
+
+    offers the :class:`~mongotor.client.Client` operations, sent to the
+    shard owning the shard key of their document or spec, or to every
+    shard when they don't hold it.
+    """
+
+    def __init__(self, cluster, collection):
+        self._cluster = cluster
+        self._collection = collection
+
+    def _client(self, shard):
+        return Client(shard, self._collection)
+
+    def _all_clients(self):
+        return [self._client(shard) for name, shard in
+                sorted(six.iteritems(self._cluster.shards))]
+
+    @gen.engine
+    def insert(self, doc_or_docs, safe=True, check_keys=True, callback=None):
+        """Insert documents on the shards owning them"""
+        if isinstance(doc_or_docs, dict):
+            doc_or_docs = [doc_or_docs]
+
+        by_shard = {}
+        for document in doc_or_docs:
+            shard = self._cluster.shard_for(self._collection, document)
+            if shard is None:
+                raise ProgrammingError('document has no shard key')
+            by_shard.setdefault(shard, []).append(document)
+
+        results = yield [gen.Task(self._client(shard).insert, documents,
+                                  safe=safe, check_keys=check_keys)
+                         for shard, documents in six.iteritems(by_shard)]
+
+        if callback:
+            callback(self._first_error(results))
+
+    @gen.engine
+    def update(self, spec, document, upsert=False, safe=True, multi=False,
+               callback=None):
+        """Update documents, on every shard unless `spec` holds the shard key
+
+        while rebalancing, an upsert first moves the documents matching
+        `spec` from their previous shard, so it never creates a second
+        version of them on their new shard.
+        """
+        shard = self._cluster.shard_for(self._collection, spec)
+        if shard is None:
+            if upsert:
+                raise ProgrammingError('upsert requires the shard key in spec')
+
+            results = yield [gen.Task(client.update, spec, document, safe=safe,
+                                      multi=multi)
+                             for client in self._all_clients()]
+            if callback:
+                callback(self._first_error(results))
+            return
+
+        previous = self._cluster.previous_shard_for(self._collection, spec)
+        if previous and upsert:
+            documents, error = yield gen.Task(self._client(previous).find, spec)
+            for moved in documents or []:
+                yield gen.Task(self._cluster._move, self._collection, moved,
+                               previous, shard)
+            previous = None
+
+        response, error = yield gen.Task(self._client(shard).update, spec, document,
+                                         upsert=upsert, safe=safe, multi=multi)
+
+        if previous and not error and response and not response.get('n'):
+            # not migrated yet
+            response, error = yield gen.Task(self._client(previous).update, spec,
+                                             document, safe=safe, multi=multi)
+
+        if callback:
+            callback((response, error))
+
+    @gen.engine
+    def remove(self, spec_or_id={}, safe=True, callback=None):
+        """Remove documents, on every shard unless the spec holds the shard key"""
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+
+        shards = [self._cluster.shard_for(self._collection, spec_or_id)]
+        if shards[0] is None:
+            clients = self._all_clients()
+        else:
+            shards.append(self._cluster.previous_shard_for(self._collection, spec_or_id))
+            clients = [self._client(shard) for shard in shards if shard]
+
+        results = yield [gen.Task(client.remove, spec_or_id, safe=safe)
+                         for client in clients]
+
+        if callback:
+            callback(self._first_error(results))
+
+    @gen.engine
+    def find_one(self, spec_or_id=None, callback=None, **kwargs):
+        """Get a single document, from its shard when the spec holds the
+        shard key"""
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+
+        shard = self._cluster.shard_for(self._collection, spec_or_id)
+        if shard is not None:
+            clients = [self._client(shard)]
+            previous = self._cluster.previous_shard_for(self._collection, spec_or_id)
+            if previous:
+                clients.append(self._client(previous))
+        else:
+            clients = self._all_clients()
+
+        for client in clients:
+            document, error = yield gen.Task(client.find_one, spec_or_id, **kwargs)
+            if document:
+                break
+
+        callback((document or None, error))
+
+    @gen.engine
+    def find(self, spec=None, skip=0, limit=0, sort=None, callback=None, **kwargs):
+        """Query the shards
+
+        a query holding the shard key goes to its shard, the others to every
+        shard, asking each for `skip` + `limit` documents, then the results
+        are merged by `sort` before skipping and limiting. The error of a
+        shard is returned instead of partial results.
+        """
+        assert callback, 'sharded queries require a callback'
+
+        shard = self._cluster.shard_for(self._collection, spec)
+        if shard is not None:
+            shards = [shard, self._cluster.previous_shard_for(self._collection, spec)]
+            clients = [self._client(owner) for owner in shards if owner]
+        else:
+            clients = self._all_clients()
+
+        if len(clients) == 1:
+            clients[0].find(spec, skip=skip, limit=limit, sort=sort,
+                            callback=callback, **kwargs)
+            return
+
+        results = yield [gen.Task(client.find, spec, limit=skip + limit if limit else 0,
+                                  sort=sort, **kwargs)
+                         for client in clients]
+
+        for docs, error in results:
+            if error:
+                callback((None, error))
+                return
+
+        documents = [docs or [] for docs, error in results]
+        if shard is not None:
+            # while moved, a document may be on both shards, the current
+            # owner holds its latest version
+            owned = set(doc.get('_id') for doc in documents[0])
+            documents[1] = [doc for doc in documents[1]
+                            if '_id' not in doc or doc['_id'] not in owned]
+
+        if sort:
+            documents = merge_sorted(documents, sort)
+        else:
+            documents = [doc for docs in documents for doc in docs]
+
+        documents = documents[skip:skip + limit] if limit else documents[skip:]
+        callback((documents, None))
+
+    @gen.engine
+    def count(self, spec=None, callback=None):
+        """Count the documents of every shard, the error of a shard is
+        raised"""
+        results = yield [gen.Task(client._database.command, 'count',
+                                  self._collection, query=spec or {})
+                         for client in self._all_clients()]
+        self._raise_error(results)
+
+        callback(sum(int(response.get('n', 0)) for response, error in results
+                     if response))
+
+    @gen.engine
+    def distinct(self, key, spec=None, callback=None):
+        """Get the distinct values for `key` across the shards, the error
+        of a shard is raised"""
+        command = {'key': key}
+        if spec:
+            command['query'] = spec
+
+        results = yield [gen.Task(client._database.command, 'distinct',
+                                  self._collection, **command)
+                         for client in self._all_clients()]
+        self._raise_error(results)
+
+        values = []
+        for response, error in results:
+            for value in (response or {}).get('values', []):
+                if value not in values:
+                    values.append(value)
+
+        callback(values)
+
+    def _raise_error(self, results):
+        response, error = self._first_error(results)
+        if error:
+            raise error
+
+    def _first_error(self, results):
+        for response, error in results:
+            if error:
+                return response, error
+
+        return results[-1] if results else (None, None)
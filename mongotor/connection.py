@@ -15,22 +15,38 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import with_statement
+from datetime import timedelta
+from functools import partial
 from tornado import iostream
 from tornado import stack_context
+from tornado.ioloop import IOLoop
 from mongotor.errors import InterfaceError, IntegrityError, \
-    ProgrammingError, DatabaseError
+    ProgrammingError, DatabaseError, NotMasterError, NOT_MASTER_CODES
 from mongotor import helpers
+from mongotor.resolver import CachingResolver
 import socket
 import logging
 import struct
+import time
 import contextlib
 
 logger = logging.getLogger(__name__)
 
 
 class Connection(object):
+    """Connection to a mongo node
 
-    def __init__(self, host, port, pool=None, autoreconnect=True, timeout=5):
+    :Parameters:
+      - `timeout` (optional): seconds to wait for the connection to be made
+      - `connect` (optional): connect at once, blocking. When False,
+        :meth:`connect` must be called to connect without blocking
+    """
+
+    # delay before trying the next resolved address when connecting
+    ATTEMPT_DELAY = 0.25
+
+    def __init__(self, host, port, pool=None, autoreconnect=True, timeout=5,
+                 connect=True):
         self._host = host
         self._port = port
         self._pool = pool
@@ -38,31 +54,145 @@ class Connection(object):
         self._timeout = timeout
         self._connected = False
         self._callback = None
+        self._start_time = None
+        self._stream = None
+        self._pinned = False
+        self._exhaust = False
+        self.usage = 0
 
-        self._connect()
+        if connect:
+            self._connect()
 
         logger.debug('{0} created'.format(self))
 
     def _connect(self):
         self.usage = 0
+        # use the address resolved by a previous connect, if any, so
+        # getaddrinfo doesn't block the IOLoop
+        addresses = CachingResolver.instance().cached(self._host, self._port)
+        family, address = addresses[0] if addresses else \
+            (socket.AF_INET, (self._host, self._port))
         try:
-            socket.timeout(self._timeout)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            s.connect((self._host, self._port))
+            s = socket.socket(family, socket.SOCK_STREAM, 0)
+            s.settimeout(self._timeout)
+            s.connect(address)
 
             self._stream = iostream.IOStream(s)
             self._stream.set_close_callback(self._socket_close)
 
             self._connected = True
         except socket.error as error:
+            if self._pool:
+                self._pool.stats.add_failure()
             raise InterfaceError(error)
 
+    def connect(self, callback):
+        """Connect without blocking the IOLoop
+
+        The host is resolved asynchronously and its addresses are tried
+        happy eyeballs fashion: while an attempt is pending, the next
+        address is tried every `ATTEMPT_DELAY` seconds, the first one
+        to succeed wins and the others are closed. Raises
+        :class:`~mongotor.errors.InterfaceError` if no address could be
+        connected within the connection timeout.
+
+        :Parameters:
+          - `callback`: method which will be called when connected
+        """
+        self.usage = 0
+        callback = stack_context.wrap(callback)
+        CachingResolver.instance().resolve(self._host, self._port,
+                                           partial(self._on_resolve, callback))
+
+    def _on_resolve(self, callback, result):
+        addresses, error = result
+        if error:
+            self._on_connect_error(error)
+
+        io_loop = IOLoop.instance()
+        state = {'done': False, 'next': 0, 'pending': 0, 'timers': [],
+                 'streams': [], 'error': None}
+
+        def finish():
+            state['done'] = True
+            for timer in state['timers']:
+                io_loop.remove_timeout(timer)
+
+        def attempt():
+            if state['done'] or state['next'] >= len(addresses):
+                return
+
+            family, address = addresses[state['next']]
+            state['next'] += 1
+            state['pending'] += 1
+
+            stream = iostream.IOStream(socket.socket(family, socket.SOCK_STREAM, 0))
+            state['streams'].append(stream)
+            stream.set_close_callback(partial(on_close, stream))
+            stream.connect(address, partial(on_connect, stream))
+            state['timers'].append(io_loop.add_timeout(
+                timedelta(seconds=self.ATTEMPT_DELAY), attempt))
+
+        def on_connect(stream):
+            if state['done']:
+                stream.close()
+                return
+
+            finish()
+            for other in state['streams']:
+                if other is not stream:
+                    other.set_close_callback(None)
+                    other.close()
+
+            self._stream = stream
+            self._stream.set_close_callback(self._socket_close)
+            self._connected = True
+            logger.debug('{0} connected'.format(self))
+            if self._pool:
+                self._pool.connect_succeeded(self)
+            callback()
+
+        def on_close(stream):
+            if state['done']:
+                return
+
+            state['pending'] -= 1
+            state['error'] = stream.error or state['error']
+            if state['next'] < len(addresses):
+                attempt()
+            elif not state['pending']:
+                finish()
+                self._on_connect_error(InterfaceError(state['error'] or 'connection refused'))
+
+        def on_timeout():
+            if state['done']:
+                return
+
+            finish()
+            for stream in state['streams']:
+                stream.set_close_callback(None)
+                stream.close()
+            self._on_connect_error(InterfaceError('connection timed out'))
+
+        state['timers'].append(io_loop.add_timeout(
+            timedelta(seconds=self._timeout), on_timeout))
+        attempt()
+
+    def _on_connect_error(self, error):
+        logger.error('{0} could not connect to {1}:{2}: {3}'.format(
+            self, self._host, self._port, error))
+        if self._pool:
+            self._pool.connect_failed(self, error)
+        self.release()
+        raise error
+
     def __repr__(self):
         return "Connection {0} ::: ".format(id(self))
 
     def _parse_header(self, header):
         #logger.debug('got data %r' % header)
         length = int(struct.unpack("<i", header[:4])[0])
+        self._reply_id = struct.unpack("<i", header[4:8])[0]
         _request_id = struct.unpack("<i", header[8:12])[0]
 
         assert _request_id == self._request_id, \
@@ -78,8 +208,16 @@ class Connection(object):
     def _parse_response(self, response):
         callback = self._callback
         check_response = self._check_response
-        self.reset()
-        self.release()
+        if self._pool:
+            self._pool.stats.add((time.time() - self._start_time) * 1000)
+
+        if self._exhaust and self._more_replies(response):
+            # the server streams the next reply, in answer to this one
+            self._callback = None
+            self._request_id = self._reply_id
+        else:
+            self.reset()
+            self.release()
 
         if check_response:
             response = self.__check_response_to_last_error(response)
@@ -117,14 +255,22 @@ class Connection(object):
         if "code" in details:
             if details["code"] in [11000, 11001, 12582]:
                 raise IntegrityError(details["err"])
+            elif details["code"] in NOT_MASTER_CODES:
+                raise NotMasterError(details["err"], details["code"])
             else:
                 raise DatabaseError(details["err"], details["code"])
         else:
             raise DatabaseError(details["err"])
 
+    def _more_replies(self, response):
+        flags, cursor_id = struct.unpack("<iq", response[:12])
+        return not flags & 3 and cursor_id != 0
+
     def _socket_close(self):
         logger.debug('{0} connection stream closed'.format(self))
         if self._callback:
+            if self._pool:
+                self._pool.stats.add_failure()
             self._callback((None, InterfaceError('connection closed')))
 
         self.reset()
@@ -138,19 +284,31 @@ class Connection(object):
 
         self.reset()
         self._connected = False
-        self._stream.close()
+        if self._stream:
+            self._stream.close()
 
     def closed(self):
         return not self._connected
 
     def release(self):
-        if self._pool:
+        if self._pool and not self._pinned:
             self._pool.release(self)
 
+    def pin(self):
+        """Keep the connection out of the pool between replies, e.g. while
+        a cursor fetches its batches, until :meth:`unpin` is called"""
+        self._pinned = True
+
+    def unpin(self):
+        if self._pinned:
+            self._pinned = False
+            self.release()
+
     def reset(self):
         self._callback = None
         self._request_id = None
         self._check_response = False
+        self._exhaust = False
 
     @contextlib.contextmanager
     def close_on_error(self):
@@ -164,6 +322,20 @@ class Connection(object):
             self.close()
             raise
 
+    def _reconnect(self):
+        if not self.closed():
+            return
+
+        if not self._autoreconnect:
+            raise InterfaceError('connection is closed and autoreconnect is false')
+
+        if self._pool:
+            # dropped pooled connections are reconnected by the pool when
+            # checked out, paced by its governor, not inline by every request
+            raise InterfaceError('connection closed')
+
+        self._connect()
+
     def send_message(self, message, with_last_error=False, callback=None):
         """Say something to Mongo.
 
@@ -178,14 +350,10 @@ class Connection(object):
           - `with_last_error`: check getLastError status after sending the
             message
         """
-        if self._callback is not None:
+        if self._callback is not None or self._exhaust:
             raise ProgrammingError('connection already in use')
 
-        if self.closed():
-            if self._autoreconnect:
-                self._connect()
-            else:
-                raise InterfaceError('connection is closed and autoreconnect is false')
+        self._reconnect()
 
         self._callback = stack_context.wrap(callback)
         self._check_response = with_last_error
@@ -195,6 +363,7 @@ class Connection(object):
 
     def __send_message(self, message, with_last_error=False):
         self.usage += 1
+        self._start_time = time.time()
 
         (self._request_id, message) = message
 
@@ -218,14 +387,10 @@ class Connection(object):
         :Parameters:
           - `message`: (request_id, data) pair making up the message to send
         """
-        if self._callback is not None:
+        if self._callback is not None or self._exhaust:
             raise ProgrammingError('connection already in use')
 
-        if self.closed():
-            if self._autoreconnect:
-                self._connect()
-            else:
-                raise InterfaceError('connection is closed and autoreconnect is false')
+        self._reconnect()
 
         self._callback = stack_context.wrap(callback)
         self._check_response = False
@@ -233,8 +398,41 @@ class Connection(object):
         with stack_context.StackContext(self.close_on_error):
             self.__send_message_and_receive(message)
 
+    def send_message_exhaust(self, message, callback):
+        """Send a query with the exhaust flag and return its first reply.
+
+        The server then streams the following replies without getMore,
+        each one is read with :meth:`read_next_reply` until a reply closes
+        the cursor. Until then the connection can't send anything else.
+        A reply is only read when asked for, so a slow reader throttles
+        the server through the socket receive buffer.
+
+        :Parameters:
+          - `message`: (request_id, data) pair of a query with the exhaust flag
+        """
+        self.send_message_with_response(message, callback)
+        self._exhaust = True
+
+    def read_next_reply(self, callback):
+        """Read the next reply streamed after :meth:`send_message_exhaust`"""
+        if self._callback is not None:
+            raise ProgrammingError('connection already in use')
+
+        if not self._exhaust:
+            raise ProgrammingError('no reply is streamed on this connection')
+
+        if self.closed():
+            raise InterfaceError('connection closed')
+
+        self._callback = stack_context.wrap(callback)
+        self._start_time = time.time()
+
+        with stack_context.StackContext(self.close_on_error):
+            self._stream.read_bytes(16, callback=self._parse_header)
+
     def __send_message_and_receive(self, message):
         self.usage += 1
+        self._start_time = time.time()
 
         (self._request_id, message) = message
 
@@ -15,23 +15,38 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+from collections import deque
+from datetime import timedelta
+from functools import partial
 import six
 from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
 from bson import SON
 from mongotor import message
 from mongotor import helpers
+from mongotor import pagination
+from mongotor.errors import Error
+from mongotor.node import ReadPreference
 
 _QUERY_OPTIONS = {
     "tailable_cursor": 2,
     "slave_okay": 4,
     "oplog_replay": 8,
-    "no_timeout": 16}
+    "no_timeout": 16,
+    "await_data": 32,
+    "exhaust": 64}
 
 DESCENDING = -1
 ASCENDING = 1
 
 logger = logging.getLogger(__name__)
 
+try:
+    StopAsyncIteration
+except NameError:  # python < 3.5
+    StopAsyncIteration = StopIteration
+
 
 class Cursor(object):
     """A cursor / iterator over Mongo query results.
@@ -40,7 +55,11 @@ class Cursor(object):
     def __init__(self, database, collection, spec_or_id=None, fields=None, snapshot=False,
         tailable=False, max_scan=None, is_command=False, explain=False, hint=None,
         skip=0, limit=0, sort=None, connection=None,
-        read_preference=None, timeout=True, slave_okay=True, **kw):
+        read_preference=None, timeout=True, slave_okay=True, retryable=None,
+        hedge=False, session=None, tags=None, pool=None, max_time_ms=None,
+        batch_size=0, prefetch=0, prefetch_bytes=16 * 1024 * 1024,
+        await_data=False, oplog_replay=False, tail_delay=0.1, exhaust=False,
+        cache=None, single_flight=None, **kw):
 
         if spec_or_id is not None and not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
@@ -53,9 +72,28 @@ class Cursor(object):
             if not isinstance(fields, dict):
                 fields = helpers._fields_list_to_dict(fields)
 
+        if not is_command:
+            # options not given default to the ones routing the collection
+            route = database.route(collection, 'find')
+            if route:
+                if read_preference is None:
+                    read_preference = route.read_preference
+                if tags is None:
+                    tags = route.tags
+                pool = pool or route.pool
+                max_time_ms = max_time_ms or route.timeout
+
         self._fields = fields
         self._snapshot = snapshot
         self._tailable = tailable
+        self._await_data = await_data
+        self._oplog_replay = oplog_replay
+        self._tail_delay = tail_delay
+        self._exhaust = exhaust and not tailable and not is_command
+        self._streaming = False
+        self._tail_spec = self._spec
+        self._last_seen = None
+        self._closed = False
         self._max_scan = max_scan
         self._hint = hint
         self._database = database
@@ -66,35 +104,544 @@ class Cursor(object):
         self._explain = explain
         self._slave_okay = slave_okay
         self._read_preference = read_preference
+        self._session = session
+        self._tags = tags
+        self._pool = pool
+        self._max_time_ms = max_time_ms
         self._connection = connection
+        if isinstance(sort, (list, tuple)):
+            # $orderby must be a document, in the order of the pairs
+            sort = SON(sort)
         self._ordering = sort
         self._skip = skip
         self._limit = limit
+        # a batch of 1 document would close the cursor
+        self._batch_size = 2 if batch_size == 1 else batch_size
+        self._cursor_id = None
+        self._retrieved = 0
+        self._data = deque()
+        self._sizes = deque()  # estimated bytes of the buffered documents
+        self._buffered_bytes = 0
+        self._prefetch_depth = prefetch
+        self._prefetch_bytes = prefetch_bytes
+        self._fetching = False
+        self._kill_pending = False
+        self._more_callbacks = []
+        self._error = None
+        self._pinned = None
+        # queries are idempotent, commands only when they don't change data
+        self._retryable = not is_command if retryable is None else retryable
+        # an exhaust stream is bound to the connection it was sent on
+        self._hedge = hedge and self._retryable and not self._exhaust
+        if single_flight is None:
+            single_flight = database.single_flight
+        # a session or a given connection make a query unlike the others
+        self._single_flight = single_flight and not (tailable or connection or session)
+        self._cache_ttl = 0
+        if not (is_command or tailable or explain or connection):
+            self._cache_ttl = database.cache.ttl_for(collection, cache)
+
+    @property
+    def alive(self):
+        """False once the server side cursor is exhausted or closed"""
+        return self._cursor_id is None or self._cursor_id != 0
 
-    @gen.engine
     def find(self, callback=None):
-        message_query = message.query(self._query_options(), self._collection_name,
-            self._skip, self._limit, self._query_spec(), self._fields)
+        """Send the query and return all its documents, fetching the
+        following batches of the server side cursor with getMore
 
-        if not self._connection:
-            node = yield gen.Task(self._database.get_node, self._read_preference)
-            connection = yield gen.Task(node.connection)
+        the documents are read from the query cache of the database when
+        the collection, or the `cache` option, gives them a ttl. With
+        `single_flight`, a query identical to one in flight isn't sent and
+        returns the documents of the first one.
+        """
+        cache = self._database.cache
+        key = generation = None
+        if self._cache_ttl:
+            key = cache.key(self._collection_name, 'find', self._spec, self._fields,
+                            self._ordering, self._skip, self._limit)
+            documents = cache.get(key)
+            if documents is not None:
+                self._cursor_id = 0
+                callback(self._result(documents))
+                return
+            generation = cache.generation(self._collection_name)
+
+        find = partial(self._find, key, generation)
+        if self._single_flight:
+            self._database.flights.call(self._flight_key(), find, callback)
         else:
-            connection = self._connection
+            find(callback=callback)
+
+    @gen.engine
+    def _find(self, cache_key, generation, callback):
+        documents = []
+        size = 0
+        while True:
+            yield gen.Task(self._refresh)
+            if self._tailable and not self._data:
+                # a tailable cursor stays open, return what is there now
+                self.close()
+                break
+
+            documents.extend(self._data)
+            size += self._buffered_bytes
+            self._clear_buffer()
+            if not self.alive:
+                break
+        self._raise_error()
+
+        if cache_key:
+            self._database.cache.put(cache_key, documents, size, self._cache_ttl,
+                                     generation)
+
+        callback(self._result(documents))
+
+    def _flight_key(self):
+        # the query message without its header, which holds the request id
+        request_id, data = self._query_message(None)
+        return (self._collection_name, data[16:], self._read_preference,
+                repr(self._tags), self._pool)
+
+    @gen.coroutine
+    def page(self, size, token=None):
+        """Resolve to a page of `size` documents and the token of the next
+        page, None after the last one.
 
-        response, _ = yield gen.Task(connection.send_message_with_response, message_query)
-        response = helpers._unpack_response(response)
+        The page starts after the sort key values of the last document of
+        the previous page, carried by `token`, so every page costs the same
+        as the first one, unlike `skip`. The sort of the cursor is made
+        total by _id; its keys should be indexed and present in every
+        document.
+
+        >>> cursor = db.posts.find({'published': True}, sort=[('date', -1)])
+        >>> posts, token = yield cursor.page(20, token=request_token)
+
+        Raises :class:`~mongotor.errors.InvalidOperationError` for a token
+        made for another sort.
+        """
+        assert size > 0, 'size must be positive'
+
+        sort = pagination.keyset_sort(self._ordering)
+        spec = self._spec
+        if token is not None:
+            keyset = pagination.keyset_spec(sort, pagination.decode_token(token, sort))
+            spec = {'$and': [spec, keyset]} if spec else keyset
+
+        if self._fields and any(value for key, value in self._fields.items() if key != '_id'):
+            # the token is read from the sort keys of the last document
+            self._fields = dict(self._fields)
+            for key, direction in sort:
+                self._fields[key] = 1
+
+        self._spec = spec
+        self._ordering = SON(sort)
+        self._skip = 0
+        self._limit = size + 1
+
+        documents, error = yield gen.Task(self.find)
+        next_token = None
+        if len(documents) > size:
+            documents = documents[:size]
+            next_token = pagination.encode_token(sort, documents[-1])
+
+        raise gen.Return((documents, next_token))
+
+    def _result(self, documents):
+        if self._limit == -1 and len(documents) == 1:
+            return documents[0], None
+
+        return documents, None
+
+    @gen.coroutine
+    def fetch_next(self):
+        """Fetch the next batch if needed, resolve to True when a document
+        can be read with :meth:`next_object`
 
-        # close cursor
-        if response and response.get('cursor_id'):
-            cursor_id = response['cursor_id']
+        >>> cursor = db.users.find({'active': True}, batch_size=100)
+        >>> while (yield cursor.fetch_next()):
+        ...     user = cursor.next_object()
+        """
+        if not self._data and self.alive:
+            yield gen.Task(self._refresh)
+
+        while self._tailable and not self._data and not self._closed:
+            yield self._tail()
+
+        if not self._data:
+            self._raise_error()
+
+        raise gen.Return(bool(self._data))
+
+    @gen.engine
+    def tail(self, callback):
+        """Call `callback` with each document of a tailable cursor, as soon
+        as it is inserted, until the cursor is closed
+
+        >>> cursor = db.events.find(tailable=True, await_data=True)
+        >>> cursor.tail(on_event)
+        """
+        while True:
+            has_next = yield self.fetch_next()
+            if not has_next:
+                break
+
+            callback(self.next_object())
+
+    @gen.coroutine
+    def _tail(self):
+        """Wait for new documents on a tailable cursor, querying again from
+        the last document seen when the server side cursor died"""
+        if self._error or not self.alive:
+            error, self._error = self._error, None
+            if error:
+                logger.warn('tailable cursor on {0} failed, querying again: {1}'
+                            .format(self._collection_name, error))
+            yield gen.Task(IOLoop.instance().add_timeout,
+                           timedelta(seconds=self._tail_delay))
+            self._requery()
+        elif not self._await_data:
+            yield gen.Task(IOLoop.instance().add_timeout,
+                           timedelta(seconds=self._tail_delay))
+
+        try:
+            yield gen.Task(self._refresh)
+        except Error as e:
+            self._error = e
+            self._cursor_id = 0
+            self._unpin()
+
+    def _requery(self):
+        key = 'ts' if self._oplog_replay else '_id'
+        if self._last_seen and key in self._last_seen:
+            spec = dict(self._tail_spec)
+            spec[key] = {'$gt': self._last_seen[key]}
+            self._spec = spec
+
+        self._cursor_id = None
+        self._retrieved = 0
+        self._skip = 0
+
+    def next_object(self):
+        """Return the next document already fetched, or None"""
+        if self._data:
+            self._buffered_bytes -= self._sizes.popleft()
+            self._prefetch()
+            return self._data.popleft()
+
+    def __aiter__(self):
+        return self
+
+    @gen.coroutine
+    def __anext__(self):
+        """Resolve to the next document, for ``async for`` on python 3.5+"""
+        has_next = yield self.fetch_next()
+        if not has_next:
+            raise StopAsyncIteration()
+
+        raise gen.Return(self.next_object())
+
+    def close(self):
+        """Kill the server side cursor and give its connection back"""
+        self._closed = True
+        self._kill()
+        self._clear_buffer()
+
+    def __del__(self):
+        # an abandoned cursor must not keep its connection out of the pool
+        if getattr(self, '_pinned', None):
+            self._kill()
+
+    @gen.engine
+    def _refresh(self, callback):
+        """Fetch the next batch, with the query the first time, then with
+        a getMore on the same connection"""
+        if self._cursor_id is None:
+            yield gen.Task(self._send_query)
+        elif self._cursor_id:
+            yield gen.Task(self._get_more)
+            self._raise_error()
+
+        callback()
+
+    @gen.engine
+    def _send_query(self, callback):
+        retried = False
+        while True:
+            try:
+                node, connection = yield gen.Task(self._get_connection)
 
-            connection.send_message(message.kill_cursors([cursor_id]), callback=None)
+                if self._hedge and node is not None:
+                    node, connection, response, error = yield gen.Task(self._send_hedged,
+                                                                       node, connection)
+                    self._pinned = connection if self._pinnable else None
+                else:
+                    self._pin(connection)
+                    # mongos doesn't stream exhaust cursors
+                    self._streaming = self._exhaust and self._pinnable and \
+                        not (node and node.is_mongos)
+                    send = connection.send_message_exhaust if self._streaming \
+                        else connection.send_message_with_response
+                    response, error = yield gen.Task(send, self._query_message(node))
+                if error:
+                    raise error
 
-        if self._limit == -1 and len(response['data']) == 1:
-            callback((response['data'][0], None))
+                size = len(response)
+                response = helpers._unpack_response(response)
+                break
+            except Error as e:
+                self._unpin()
+                if retried or not self._can_retry(e):
+                    raise
+
+            logger.warn('retrying query on {0} after a retryable error'
+                        .format(self._collection_name))
+            retried = True
+            yield gen.Task(self._database.refresh)
+
+        self._on_batch(response, size)
+        callback()
+
+    def _get_more(self, callback):
+        """Call `callback` when the getMore in flight, or a new one,
+        replied"""
+        self._more_callbacks.append(stack_context.wrap(callback))
+        self._send_get_more()
+
+    def _send_get_more(self):
+        if self._fetching or not self._cursor_id:
+            return
+
+        self._fetching = True
+        connection = self._pinned or self._connection
+        try:
+            if self._streaming:
+                connection.read_next_reply(self._on_get_more)
+            else:
+                connection.send_message_with_response(
+                    message.get_more(self._collection_name, self._num_to_return(),
+                                     self._cursor_id),
+                    callback=self._on_get_more)
+        except Error as e:
+            # e.g. a dropped connection failing to reconnect, a prefetch
+            # from next_object must not raise into its caller
+            self._on_get_more((None, e))
+
+    def _on_get_more(self, result):
+        self._fetching = False
+        response, error = result
+        try:
+            if error:
+                raise error
+
+            size = len(response)
+            response = helpers._unpack_response(response, self._cursor_id)
+        except Error as e:
+            # the server side cursor is lost with its connection
+            self._error = e
+            self._cursor_id = 0
+            self._unpin()
+        else:
+            self._on_batch(response, size)
+
+        if self._kill_pending:
+            self._kill()
+            self._clear_buffer()
+
+        callbacks, self._more_callbacks = self._more_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _prefetch(self):
+        """Send the next getMore while the buffered documents are consumed,
+        up to `prefetch` batches and `prefetch_bytes` buffered"""
+        if not self._prefetch_depth or self._kill_pending:
+            return
+
+        batch_size = self._batch_size or 101
+        if len(self._data) < self._prefetch_depth * batch_size and \
+                self._buffered_bytes < self._prefetch_bytes:
+            self._send_get_more()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error:
+            raise error
+
+    def _clear_buffer(self):
+        self._data.clear()
+        self._sizes.clear()
+        self._buffered_bytes = 0
+
+    def _on_batch(self, response, size=0):
+        data = response['data']
+        if self._limit > 0:
+            data = data[:self._limit - self._retrieved]
+
+        self._cursor_id = response['cursor_id']
+        self._retrieved += len(data)
+        self._data.extend(data)
+        if data and self._tailable:
+            self._last_seen = data[-1]
+        if data:
+            self._sizes.extend([float(size) / len(data)] * len(data))
+            self._buffered_bytes += size
+
+        if self._limit and self._retrieved >= abs(self._limit):
+            self._kill()
+        elif not self._cursor_id:
+            self._unpin()
         else:
-            callback((response['data'], None))
+            self._prefetch()
+
+    def _kill(self):
+        connection = self._pinned or self._connection
+        if self._streaming and self._cursor_id and connection:
+            # the server keeps streaming, only closing the connection stops it
+            self._cursor_id = 0
+            connection.close()
+            self._error = None
+            self._unpin()
+            return
+
+        if self._fetching:
+            # the connection is busy, kill when the getMore replies
+            self._kill_pending = True
+            return
+
+        self._kill_pending = False
+        connection = self._pinned or self._connection
+        if self._cursor_id and connection and not connection.closed():
+            connection.send_message(message.kill_cursors([self._cursor_id]),
+                                    callback=None)
+        self._cursor_id = 0
+        self._unpin()
+
+    @property
+    def _pinnable(self):
+        # commands reply in one batch, a given connection is the caller's
+        return not self._is_command and not self._connection
+
+    def _pin(self, connection):
+        if self._pinnable:
+            connection.pin()
+            self._pinned = connection
+
+    def _unpin(self):
+        connection, self._pinned = self._pinned, None
+        if connection:
+            connection.unpin()
+
+    def _num_to_return(self):
+        if self._limit < 0:
+            return self._limit
+
+        if self._limit:
+            remaining = self._limit - self._retrieved
+            return min(self._batch_size, remaining) if self._batch_size else remaining
+
+        return self._batch_size
+
+    def _query_message(self, node):
+        return message.query(self._query_options(), self._collection_name,
+            self._skip, self._num_to_return(), self._query_spec(node), self._fields)
+
+    def _send_hedged(self, node, connection, callback):
+        """Send the query to `node`, and to a second eligible node when the
+        first one doesn't reply within its observed p95 latency.
+
+        The first reply wins, the loser's cursor is killed when it replies.
+        The extra reads are limited by the database hedge budget.
+        """
+        self._database._hedge_budget.deposit()
+        state = {'done': False, 'pending': 0, 'timeout': None}
+
+        def send(node, connection):
+            state['pending'] += 1
+            if self._pinnable:
+                connection.pin()
+            connection.send_message_with_response(self._query_message(node),
+                callback=partial(on_reply, node, connection))
+
+        def on_reply(node, connection, result):
+            response, error = result
+            state['pending'] -= 1
+
+            if state['done']:
+                self._discard_response(connection, response)
+                connection.unpin()
+                return
+
+            if error and state['pending']:
+                # the other node may still answer
+                connection.unpin()
+                return
+
+            state['done'] = True
+            if state['timeout']:
+                IOLoop.instance().remove_timeout(state['timeout'])
+            callback((node, connection, response, error))
+
+        def on_hedge_connection(hedge_node, hedge_connection):
+            if state['done']:
+                hedge_connection.release()
+                return
+
+            send(hedge_node, hedge_connection)
+
+        def hedge():
+            state['timeout'] = None
+            if state['done']:
+                return
+
+            hedge_node = self._database.select_node(self._read_preference,
+                                                    exclude=[node],
+                                                    session=self._session,
+                                                    tags=self._tags)
+            if hedge_node is None or not self._database.should_hedge():
+                return
+
+            logger.debug('hedging query on {0} to {1}'.format(self._collection_name,
+                                                             hedge_node))
+            hedge_node.connection(partial(on_hedge_connection, hedge_node),
+                                  pool=self._pool)
+
+        send(node, connection)
+
+        delay = node.pool.stats.percentile(95)
+        if delay is not None and not state['done']:
+            state['timeout'] = IOLoop.instance().add_timeout(
+                timedelta(milliseconds=delay), hedge)
+
+    def _discard_response(self, connection, response):
+        if not response:
+            return
+
+        try:
+            response = helpers._unpack_response(response)
+        except Error:
+            return
+
+        if response.get('cursor_id'):
+            connection.send_message(message.kill_cursors([response['cursor_id']]),
+                                    callback=None)
+
+    def _get_connection(self, callback):
+        if self._connection:
+            callback((None, self._connection))
+            return
+
+        def on_node(node):
+            node.connection(lambda connection: callback((node, connection)),
+                            pool=self._pool)
+
+        self._database.get_node(self._read_preference, session=self._session,
+                                tags=self._tags, callback=on_node)
+
+    def _can_retry(self, error):
+        # a query pinned to a connection can't be moved to another node
+        return (self._retryable and not self._connection and
+                self._database.should_retry(error))
 
     @gen.coroutine
     def count(self):
@@ -102,6 +649,14 @@ class Cursor(object):
 
         Returns the number of documents in the results set for this query. Does
         """
+        cache = self._database.cache
+        if self._cache_ttl:
+            key = cache.key(self._collection_name, 'count', self._spec)
+            total = cache.get(key)
+            if total is not None:
+                raise gen.Return(total)
+            generation = cache.generation(self._collection_name)
+
         command = {"query": self._spec}
 
         response, error = yield gen.Task(self._database.command,
@@ -110,6 +665,8 @@ class Cursor(object):
         total = 0
         if response and len(response) > 0 and 'n' in response:
             total = int(response['n'])
+            if self._cache_ttl:
+                cache.put(key, total, 0, self._cache_ttl, generation)
 
         raise gen.Return(total)
 
@@ -136,19 +693,40 @@ class Cursor(object):
     def _query_options(self):
         """Get the query options string to use for this query."""
         options = 0
+        if self._streaming:
+            options |= _QUERY_OPTIONS["exhaust"]
         if self._tailable:
             options |= _QUERY_OPTIONS["tailable_cursor"]
+            if self._await_data:
+                options |= _QUERY_OPTIONS["await_data"]
+        if self._oplog_replay:
+            options |= _QUERY_OPTIONS["oplog_replay"]
         if self._slave_okay:
             options |= _QUERY_OPTIONS["slave_okay"]
         if not self._timeout:
             options |= _QUERY_OPTIONS["no_timeout"]
         return options
 
-    def _query_spec(self):
-        """Get the spec to use for a query."""
+    def _query_spec(self, node=None):
+        """Get the spec to use for a query.
+
+        when the query is sent to a mongos `node`, the read preference is
+        forwarded through the `$readPreference` modifier.
+        """
         spec = self._spec
         if not self._is_command and "$query" not in self._spec:
             spec = SON({"$query": self._spec})
+        if node is not None and node.is_mongos:
+            read_preference = self._read_preference
+            if read_preference is None:
+                read_preference = self._database.read_preference
+            if self._session:
+                read_preference = self._session.read_preference(read_preference)
+            mongos_mode = ReadPreference.mongos_mode(read_preference)
+            if mongos_mode:
+                if self._is_command:
+                    spec = SON([("$query", spec)])
+                spec["$readPreference"] = mongos_mode
         if self._ordering:
             spec["$orderby"] = self._ordering
         if self._explain:
@@ -159,4 +737,6 @@ class Cursor(object):
             spec["$snapshot"] = True
         if self._max_scan:
             spec["$maxScan"] = self._max_scan
+        if self._max_time_ms and not self._is_command:
+            spec["$maxTimeMS"] = self._max_time_ms
         return spec
@@ -16,16 +16,60 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from functools import partial, wraps
+from collections import deque
 from datetime import timedelta
+import json
+import logging
+import os
 import six
 from tornado import gen
 from tornado.ioloop import IOLoop
 from bson import SON
 from mongotor.node import Node, ReadPreference
-from mongotor.errors import DatabaseError
+from mongotor.errors import DatabaseError, is_retryable
 from mongotor.client import Client
+from mongotor.retry import RetryBudget
+from mongotor.cache import QueryCache
+from mongotor.loader import IdLoader
+from mongotor.flight import SingleFlight
+from mongotor.routing import RoutingTable
+from mongotor.topology import Topology
 import warnings
 
+logger = logging.getLogger(__name__)
+
+# commands which don't change data, so they can be sent twice safely
+_READ_COMMANDS = frozenset(['count', 'distinct', 'group', 'geonear',
+                            'ismaster', 'buildinfo', 'collstats', 'dbstats',
+                            'splitvector'])
+
+
+def _written_collection(command):
+    """Return the name of the collection changed by `command`, or None"""
+    name = next(iter(command))
+    verb = name.lower()
+    if verb in _READ_COMMANDS:
+        return None
+
+    if verb == 'aggregate':
+        # only the $out or $merge stage writes, to another collection
+        for stage in command.get('pipeline') or []:
+            out = stage.get('$out', stage.get('$merge'))
+            if isinstance(out, dict):
+                out = out.get('coll', out.get('into'))
+            if out is not None:
+                return out if isinstance(out, six.string_types) else None
+        return None
+
+    if verb == 'mapreduce':
+        out = command.get('out')
+        if isinstance(out, dict):
+            out = out.get('replace', out.get('merge', out.get('reduce')))
+        return out if isinstance(out, six.string_types) else None
+
+    value = command[name]
+    return value if isinstance(value, six.string_types) else None
+
 
 def initialized(fn):
     @wraps(fn)
@@ -51,7 +95,11 @@ class Database(object):
         return cls._instance
 
     @classmethod
-    def init(cls, addresses, dbname, read_preference=None, **kwargs):
+    def init(cls, addresses, dbname, read_preference=None, retry=True,
+             retry_budget=None, hedge_budget=None, topology_file=None,
+             server_selection_timeout=0, monitor_timeout=5, routes=None,
+             pools=None, cache=None, batch_lookups=True, single_flight=False,
+             **kwargs):
         """initialize the database
 
         >>> Database.init(['localhost:27017', 'localhost:27018'], 'test', maxconnections=100)
@@ -63,20 +111,67 @@ class Database(object):
           - `dbname` : mongo database name
           - `read_preference` (optional): The read preference for
             this query.
+          - `retry` (optional): retry reads and idempotent writes once on a
+            freshly selected node when they fail with a retryable error, and
+            other writes when the former primary refused them. default is True
+          - `retry_budget` (optional): a :class:`~mongotor.retry.RetryBudget`
+            limiting the retries during an outage
+          - `hedge_budget` (optional): a :class:`~mongotor.retry.RetryBudget`
+            limiting the extra reads sent by hedged queries
+          - `topology_file` (optional): path of a file where the last known
+            state of the nodes is saved, so a restarted process routes its
+            first operations without waiting for the discovery
+          - `server_selection_timeout` (optional): how long, in ms, an
+            operation waits for a suitable node, e.g. during an election,
+            before failing. default is 0, failing immediately
+          - `monitor_timeout` (optional): seconds to wait for the heartbeat
+            of a node, sent through its own monitoring connection. default is 5
+          - `routes` (optional): a list of :class:`~mongotor.routing.Route`
+            setting the read preference, tags, pool and timeout of the
+            operations by collection and operation type
+          - `pools` (optional): options of the named pools used by the
+            routes, keyed by name, e.g. ``{'analytics': {'maxconnections': 5}}``
+          - `cache` (optional): True to cache the results of the queries on
+            every collection, or a :class:`~mongotor.cache.QueryCache`. By
+            default only the collections given a ttl, with
+            ``db.cache.set_ttl``, and the queries passing `cache` are cached
+          - `batch_lookups` (optional): read the documents looked up by _id
+            with `find_one` during an iteration of the IOLoop with a single
+            query. default is True
+          - `single_flight` (optional): a read, or read-only command, sent
+            while an identical one is waiting for its reply shares its
+            result instead of being sent. default is False, enabled by
+            query with the `single_flight` option of find
           - `maxconnections` (optional): maximum open connections for pool. 0 for unlimited
           - `maxusage` (optional): number of requests allowed on a connection
             before it is closed. 0 for unlimited
           - `autoreconnect`: autoreconnect to database. default is True
+          - `max_connecting` (optional): concurrent connection attempts to
+            each node. default is 2
+          - `reconnect_backoff` (optional): seconds to wait before reconnecting
+            to a node after a failed attempt, doubled on each consecutive
+            failure and jittered. default is 0.1
+          - `max_reconnect_backoff` (optional): maximum seconds between
+            attempts. default is 10
+          - `reconnect_wait` (optional): when a node is being reconnected,
+            wait for a pending attempt instead of failing at once. default is True
         """
         if cls._instance and hasattr(cls._instance, '_initialized') and cls._instance._initialized:
             return cls._instance
 
         database = Database()
-        database._init(addresses, dbname, read_preference, **kwargs)
+        database._init(addresses, dbname, read_preference, retry,
+                       retry_budget, hedge_budget, topology_file,
+                       server_selection_timeout, monitor_timeout, routes,
+                       pools, cache, batch_lookups, single_flight, **kwargs)
 
         return database
 
-    def _init(self, addresses, dbname, read_preference=None, **kwargs):
+    def _init(self, addresses, dbname, read_preference=None, retry=True,
+              retry_budget=None, hedge_budget=None, topology_file=None,
+              server_selection_timeout=0, monitor_timeout=5, routes=None,
+              pools=None, cache=None, batch_lookups=True, single_flight=False,
+             **kwargs):
         self._addresses = self._parse_addresses(addresses)
         self._dbname = dbname
         self._read_preference = read_preference or ReadPreference.PRIMARY
@@ -84,42 +179,262 @@ class Database(object):
         self._pool_kwargs = kwargs
         self._initialized = True
         self._connected = False
+        self._discovering = False
         self._connect_callbacks = []
+        self._refresh_callbacks = []
+        self._topology_file = topology_file
+        self._saved_topology = None
+        self._server_selection_timeout = server_selection_timeout
+        self._selection_waiters = deque()
+        self._fast_polling = False
+        self._retry = retry
+        self._retry_budget = retry_budget or RetryBudget()
+        # refused hedges are routine under load, they aren't logged
+        self._hedge_budget = hedge_budget or RetryBudget(ratio=0.05, max_tokens=5,
+                                                         message=None)
+        self._routing = RoutingTable(routes)
+        if not isinstance(cache, QueryCache):
+            cache = QueryCache() if cache else QueryCache(ttl=0)
+        self._cache = cache
+        self._id_loader = IdLoader(self) if batch_lookups else None
+        self._single_flight = single_flight
+        self._flights = SingleFlight()
 
         for host, port in self._addresses:
-            node = Node(host, port, self, self._pool_kwargs)
+            node = Node(host, port, self, self._pool_kwargs, monitor_timeout, pools)
             self._nodes.append(node)
 
-    def _connect(self, callback):
+        if self._topology_file:
+            self._load_topology()
+
+        self._snapshot = Topology(self._nodes)
+
+    def _connect(self, callback, read_preference=None):
         """Connect to database
         connect all mongodb nodes, configuring states and preferences
         - `callback`: (optional) method that will be called when the database is connected
+        - `read_preference`: (optional) call `callback` as soon as a node suitable
+          for this read preference answered, instead of waiting for all nodes
         """
         assert not self._connected
-        self._connect_callbacks.append(callback)
-        if len(self._connect_callbacks) == 1:  # if another _connect is not in progress
-            self._config_nodes(callback=self._on_config_node)
+        self._connect_callbacks.append((read_preference, callback))
+        self._start_discovery()
 
-    def _config_nodes(self, callback=None):
+    def _start_discovery(self):
+        if not self._discovering:  # if another _connect is not in progress
+            self._discovering = True
+            self._config_nodes()
+
+    def _config_nodes(self):
         for node in self._nodes:
-            node.config(callback)
+            node.config(self._on_config_node)
 
         IOLoop.instance().add_timeout(timedelta(seconds=30), self._config_nodes)
 
+    def refresh(self, callback=None):
+        """Force a topology refresh
+
+        configure all nodes again, out of the periodic schedule. Concurrent
+        refreshes are coalesced into a single round of ismaster.
+        - `callback`: (optional) method that will be called when every node answered
+        """
+        self._refresh_callbacks.append(callback)
+        if len(self._refresh_callbacks) > 1:  # a refresh is already in progress
+            return
+
+        pending = [len(self._nodes)]
+
+        def on_config_node():
+            self._on_config_node()
+            pending[0] -= 1
+            if pending[0] > 0:
+                return
+
+            callbacks, self._refresh_callbacks = self._refresh_callbacks, []
+            for callback in callbacks:
+                if callback:
+                    callback()
+
+        for node in self._nodes:
+            node.config(on_config_node)
+
+    def should_retry(self, error):
+        """Return True if an operation failed with `error` may be sent again
+
+        the retry budget is only spent for retryable errors.
+        """
+        return self._retry and is_retryable(error) and self._retry_budget.withdraw()
+
     def _on_config_node(self):
+        if not self._connected:
+            self._connected = all(node.initialized for node in self._nodes)
+
+        self._update_snapshot()
+
+        # release the operations which can already be served
+        pending = []
+        for read_preference, callback in self._connect_callbacks:
+            if self._connected or (read_preference is not None and
+                                   self.select_node(read_preference)):
+                IOLoop.instance().add_callback(callback)
+            else:
+                pending.append((read_preference, callback))
+        self._connect_callbacks = pending
+
+        self._release_selection_waiters()
+
+        if self._topology_file and self._connected:
+            self._save_topology()
+
+    def _update_snapshot(self):
+        """Replace the topology snapshot when a heartbeat changed the state
+        of a node"""
+        if self._snapshot.changed(self._nodes):
+            self._snapshot = Topology(self._nodes, self._snapshot.version + 1)
+            logger.debug('{0} updated'.format(self._snapshot))
+
+    def _wait_for_node(self, read_preference, callback):
+        """Park an operation until a node suitable for `read_preference` is
+        found or `server_selection_timeout` expires
+
+        `callback` is called with True when a node was found. While
+        operations are parked the nodes are polled every 500ms, and they
+        are released in FIFO order.
+        """
+        waiter = [read_preference, callback, None]
+        waiter[2] = IOLoop.instance().add_timeout(
+            timedelta(milliseconds=self._server_selection_timeout),
+            partial(self._on_selection_timeout, waiter))
+        self._selection_waiters.append(waiter)
+
+        if not self._fast_polling:
+            self._fast_polling = True
+            self._fast_poll()
+
+    def _on_selection_timeout(self, waiter):
+        self._selection_waiters.remove(waiter)
+        waiter[1](False)
+
+    def _release_selection_waiters(self):
+        pending = deque()
+        while self._selection_waiters:
+            waiter = self._selection_waiters.popleft()
+            read_preference, callback, timeout = waiter
+            if self.select_node(read_preference):
+                IOLoop.instance().remove_timeout(timeout)
+                IOLoop.instance().add_callback(partial(callback, True))
+            else:
+                pending.append(waiter)
+        self._selection_waiters = pending
+
+    def _fast_poll(self):
+        if not self._selection_waiters:
+            self._fast_polling = False
+            return
+
+        self.refresh()
+        IOLoop.instance().add_timeout(timedelta(milliseconds=500), self._fast_poll)
+
+    def _topology(self):
+        topology = {}
         for node in self._nodes:
-            if not node.initialized:
-                return
+            topology['%s:%d' % (node.host, node.port)] = {
+                'available': node.available,
+                'primary': node.is_primary,
+                'secondary': node.is_secondary,
+                'mongos': node.is_mongos,
+            }
+
+        return topology
+
+    def _save_topology(self):
+        topology = self._topology()
+        if topology == self._saved_topology:
+            return
+
+        temp_file = '%s.%d.tmp' % (self._topology_file, os.getpid())
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump({'dbname': self._dbname, 'nodes': topology}, f)
+            os.rename(temp_file, self._topology_file)
+        except (IOError, OSError) as e:
+            logger.warn('could not save topology to {0}: {1}'.format(self._topology_file, e))
+            return
+
+        self._saved_topology = topology
+
+    def _load_topology(self):
+        """Restore the state of the nodes saved by a previous process
+
+        the restored state is used until the node is configured again.
+        """
+        try:
+            with open(self._topology_file) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.info('could not load topology from {0}: {1}'.format(self._topology_file, e))
+            return
 
-        self._connected = True
-        for callback in self._connect_callbacks:
-            IOLoop.instance().add_callback(callback)
-        self._connect_callbacks = []
+        if saved.get('dbname') != self._dbname:
+            return
+
+        topology = saved.get('nodes', {})
+        for node in self._nodes:
+            state = topology.get('%s:%d' % (node.host, node.port))
+            if state:
+                node.available = state['available']
+                node.is_primary = state['primary']
+                node.is_secondary = state['secondary']
+                node.is_mongos = state['mongos']
+
+        self._saved_topology = topology
 
     @property
     def dbname(self):
         return self._dbname
 
+    @property
+    def read_preference(self):
+        return self._read_preference
+
+    @property
+    @initialized
+    def topology(self):
+        """The current :class:`~mongotor.topology.Topology` snapshot"""
+        return self._snapshot
+
+    @property
+    @initialized
+    def routing(self):
+        """The :class:`~mongotor.routing.RoutingTable` of the database"""
+        return self._routing
+
+    @property
+    def cache(self):
+        """The :class:`~mongotor.cache.QueryCache` of the database"""
+        return self._cache
+
+    @property
+    def id_loader(self):
+        """The :class:`~mongotor.loader.IdLoader` batching the lookups by
+        _id, None when disabled"""
+        return self._id_loader
+
+    @property
+    def single_flight(self):
+        """True if identical reads in flight share their result"""
+        return self._single_flight
+
+    @property
+    def flights(self):
+        """The :class:`~mongotor.flight.SingleFlight` of the reads"""
+        return self._flights
+
+    @initialized
+    def route(self, collection, operation):
+        """Return the route of `operation` on `collection`, or None"""
+        return self._routing.route(collection, operation)
+
     @initialized
     def get_collection_name(self, collection):
         return '%s.%s' % (self.dbname, collection)
@@ -176,28 +491,108 @@ class Database(object):
         else:
             connection.send_message(message, callback=callback)
 
-    @gen.engine
     @initialized
-    def get_node(self, read_preference=None, callback=None):
+    def get_node(self, read_preference=None, session=None, tags=None, callback=None):
+        """Call `callback` with a node suitable for `read_preference`
+
+        when the database is connected the node is taken from the topology
+        snapshot at once, otherwise the operation waits for the discovery.
+        """
         assert callback
 
-        # check if database is connected
+        if session is None and not tags:
+            node = self.fast_node(read_preference)
+            if node:
+                callback(node)
+                return
+
+        self._get_node(read_preference, session, tags, callback)
+
+    def fast_node(self, read_preference=None):
+        """Return a node of the topology snapshot suitable for
+        `read_preference` without waiting, or None when the operation must
+        go through :meth:`get_node`
+        """
         if not self._connected:
-            # connect database
-            yield gen.Task(self._connect)
+            return None
+
+        if read_preference is None:
+            read_preference = self._read_preference
+
+        node = self._snapshot.select_node(read_preference)
+        if node:
+            # every operation selects a node, so it earns its share of retries
+            self._retry_budget.deposit()
 
+        return node
+
+    @gen.engine
+    def _get_node(self, read_preference, session, tags, callback):
         if read_preference is None:
             read_preference = self._read_preference
 
-        node = ReadPreference.select_node(self._nodes, read_preference)
+        # the preference a node must be waited for when none can be selected
+        wait_preference = session.read_preference(read_preference) \
+            if session else read_preference
+
+        # check if database is connected
+        if not self._connected:
+            # a node restored from the topology file or already configured
+            # may serve the operation while the others are discovered
+            if self.select_node(read_preference, session=session, tags=tags):
+                self._start_discovery()
+            else:
+                # connect database
+                yield gen.Task(self._connect, read_preference=wait_preference)
+
+        # every operation selects a node, so it earns its share of retries
+        self._retry_budget.deposit()
+
+        node = self.select_node(read_preference, session=session, tags=tags)
+        if not node and self._server_selection_timeout:
+            found = yield gen.Task(self._wait_for_node, wait_preference)
+            if found:
+                node = self.select_node(read_preference, session=session, tags=tags)
+
         if not node:
             raise DatabaseError('could not find an available node')
 
         callback(node)
 
+    def select_node(self, read_preference=None, exclude=None, session=None,
+                    tags=None):
+        """Select a node of the current topology, without connecting
+
+        :Parameters:
+          - `read_preference` (optional): the read preference used to select
+          - `exclude` (optional): nodes which must not be selected
+          - `session` (optional): a :class:`~mongotor.session.Session` whose
+            reads must see its writes
+          - `tags` (optional): a tag set, or a list of tag sets, the
+            selected secondary must match
+        """
+        if read_preference is None:
+            read_preference = self._read_preference
+
+        nodes = self._nodes
+        if exclude:
+            nodes = [node for node in nodes if node not in exclude]
+        if tags:
+            nodes = ReadPreference.filter_tags(nodes, tags)
+
+        if session:
+            return session.select_node(nodes, read_preference)
+
+        return ReadPreference.select_node(nodes, read_preference)
+
+    def should_hedge(self):
+        """Return True if the hedge budget allows sending a read twice"""
+        return self._hedge_budget.withdraw()
+
     @initialized
     def command(self, command, value=1, read_preference=None,
-                callback=None, check=True, allowable_errors=[], **kwargs):
+                callback=None, check=True, allowable_errors=[], hedge=False,
+                **kwargs):
         """Issue a MongoDB command.
 
         Send command `command` to the database and return the
@@ -236,6 +631,11 @@ class Database(object):
 
           - `value` (optional): value to use for the command verb when
             `command` is passed as a string
+          - `hedge` (optional): send a read-only command to a second node
+            when the first one is slower than usual, the first reply wins
+
+          The read preference, tags, pool and timeout of the command default
+          to the ones of its route, the collection being `value`.
           - `**kwargs` (optional): additional keyword arguments will
             be added to the command document before it is sent
 
@@ -245,21 +645,53 @@ class Database(object):
 
         command.update(kwargs)
 
+        tags = pool = None
+        route = self._command_route(command)
+        if route:
+            if read_preference is None:
+                read_preference = route.read_preference
+            tags, pool = route.tags, route.pool
+            if route.timeout and 'maxTimeMS' not in command:
+                command['maxTimeMS'] = route.timeout
+
         if read_preference is None:
             read_preference = self._read_preference
 
-        self._command(command, read_preference=read_preference, callback=callback)
+        written = _written_collection(command)
+        if written is not None:
+            # e.g. findandmodify or drop change the cached collection
+            self._cache.invalidate(self.get_collection_name(written))
+
+        self._command(command, read_preference=read_preference,
+                      hedge=hedge, tags=tags, pool=pool, callback=callback)
+
+    def _command_route(self, command):
+        if not len(self._routing):
+            return None
+
+        name = next(iter(command))
+        collection = command[name]
+        if isinstance(collection, dict):  # e.g. group
+            collection = collection.get('ns')
+        if not isinstance(collection, six.string_types):
+            collection = None
+
+        return self._routing.route(collection, name)
 
     def _command(self, command, read_preference=None,
-                 connection=None, callback=None):
+                 connection=None, hedge=False, tags=None, pool=None,
+                 callback=None):
 
         if read_preference is None:
             read_preference = self._read_preference
 
         client = Client(self, '$cmd')
 
+        read_only = next(iter(command)).lower() in _READ_COMMANDS
         client.find_one(command, is_command=True, connection=connection,
-            read_preference=read_preference, callback=callback)
+            read_preference=read_preference, callback=callback,
+            retryable=read_only, hedge=hedge and read_only, tags=tags,
+            pool=pool, single_flight=None if read_only else False)
 
     def __getattr__(self, name):
         """Get a client collection by name.
@@ -19,17 +19,28 @@
 class Error(Exception):
     """Base class for all mongotor exceptions.
 
+    `retryable` tells whether the operation which raised the error may be
+    sent again to a freshly selected node.
     """
+    retryable = False
 
 
 class InterfaceError(Error):
     """Raised when a connection to the database cannot be made or is lost.
     """
+    retryable = True
 
 
 class TooManyConnections(InterfaceError):
     """Raised when a pool is busy.
     """
+    retryable = False
+
+
+class CursorNotFound(InterfaceError):
+    """Raised when the server does not know the cursor id of a getMore.
+    """
+    retryable = False
 
 
 class InvalidOperationError(Error):
@@ -56,6 +67,12 @@ class IntegrityError(DatabaseError):
         self.msg = msg
 
 
+class NotMasterError(DatabaseError):
+    """Raised when a node is no longer the primary or is recovering.
+    """
+    retryable = True
+
+
 class ProgrammingError(DatabaseError):
     pass
 
@@ -63,3 +80,15 @@ class ProgrammingError(DatabaseError):
 class TimeoutError(DatabaseError):
     """Raised when a database operation times out.
     """
+
+
+# server error codes meaning the node can't serve the operation right now,
+# usually because an election is in progress
+NOT_MASTER_CODES = frozenset([10058, 10107, 13435, 13436, 11600, 11602, 189, 91])
+
+
+def is_retryable(error):
+    """Return True if `error` is transient, so the operation which raised it
+    may be retried on a freshly selected node.
+    """
+    return getattr(error, 'retryable', False)
@@ -0,0 +1,75 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import logging
+from tornado import gen
+from tornado import stack_context
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """Share the result of identical operations in flight
+
+    an operation started while an identical one, with the same key, is
+    waiting for its reply isn't sent: its caller receives the result of
+    the first one, or its error raised in the caller's context. Every
+    caller after the first one receives its own copy of the result.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    def __repr__(self):
+        return "SingleFlight in flight:{0}".format(len(self._flights))
+
+    def __len__(self):
+        return len(self._flights)
+
+    def call(self, key, fn, callback):
+        """Call `fn(callback=...)` unless an operation with `key` is in
+        flight, `callback` receives the result of the one sent"""
+        waiter = (stack_context.wrap(callback), stack_context.wrap(_raise))
+        if key in self._flights:
+            logger.debug('{0} joining a flight on {1}'.format(self, key[0]))
+            self._flights[key].append(waiter)
+            return
+
+        self._flights[key] = [waiter]
+        self._run(key, fn)
+
+    @gen.engine
+    def _run(self, key, fn):
+        result = error = None
+        try:
+            result = yield gen.Task(fn)
+        except Exception as e:
+            # the callers still waiting must not hang
+            error = e
+
+        for i, (callback, fail) in enumerate(self._flights.pop(key)):
+            try:
+                if error is not None:
+                    fail(error)
+                else:
+                    callback(result if i == 0 else copy.deepcopy(result))
+            except Exception:
+                logger.exception('{0} callback failed'.format(self))
+
+
+def _raise(error):
+    raise error
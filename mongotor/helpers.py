@@ -15,8 +15,8 @@
 import bson
 import struct
 import six
-from mongotor.errors import (DatabaseError,
-    InterfaceError, TimeoutError)
+from mongotor.errors import (DatabaseError, CursorNotFound,
+    NotMasterError, TimeoutError, NOT_MASTER_CODES)
 
 
 def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
@@ -37,12 +37,13 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
         # Shouldn't get this response if we aren't doing a getMore
         assert cursor_id is not None
 
-        raise InterfaceError("cursor id '%s' not valid at server" %
-                               cursor_id)
+        raise CursorNotFound("cursor id '%s' not valid at server" %
+                             cursor_id)
     elif response_flag & 2:
         error_object = bson.BSON(response[20:]).decode()
-        if error_object["$err"] == "not master":
-            raise DatabaseError("master has changed")
+        if (error_object["$err"] == "not master" or
+                error_object.get("code") in NOT_MASTER_CODES):
+            raise NotMasterError("master has changed", error_object.get("code"))
         raise DatabaseError("database error: %s" %
                                error_object["$err"])
 
@@ -98,3 +99,13 @@ def _fields_list_to_dict(fields):
                             "each an instance of string (str/unicode)")
         as_dict[field] = 1
     return as_dict
+
+
+def _optime_of(value):
+    """Return the timestamp of an optime, which is a
+    :class:`~bson.timestamp.Timestamp` or, with replication protocol 1,
+    a ``{ts: Timestamp, t: term}`` document
+    """
+    if isinstance(value, dict):
+        return value.get('ts')
+    return value
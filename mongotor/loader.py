@@ -0,0 +1,128 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+from collections import OrderedDict
+from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+from mongotor.cursor import Cursor
+from mongotor.errors import Error
+from mongotor.flight import _raise
+
+logger = logging.getLogger(__name__)
+
+# options of find_one which can be shared by a batch of lookups
+_BATCHABLE_OPTIONS = frozenset(['fields', 'read_preference', 'cache', 'callback'])
+
+
+class IdLoader(object):
+    """Batch the lookups by _id of a collection
+
+    the ids looked up with :meth:`~mongotor.client.Client.find_one` during
+    an iteration of the IOLoop are read with a single ``$in`` query at
+    the start of the next one, and each caller receives its document, or
+    None when there is none. An error of the query is raised in the
+    context of every caller, as find_one does.
+
+    :Parameters:
+      - `database`: the :class:`~mongotor.database.Database` queried
+      - `max_batch` (optional): maximum ids of a query
+    """
+
+    def __init__(self, database, max_batch=500):
+        assert max_batch > 0
+
+        self._database = database
+        self._max_batch = max_batch
+        self._batches = {}
+
+    def __repr__(self):
+        return "IdLoader batches:{0}".format(len(self._batches))
+
+    def can_load(self, collection, spec, options):
+        """Return True if find_one(`spec`, **`options`) can be batched"""
+        if not isinstance(spec, dict) or list(spec) != ['_id']:
+            return False
+
+        if isinstance(spec['_id'], (dict, list)) or 'callback' not in options:
+            return False
+
+        if not _BATCHABLE_OPTIONS.issuperset(options):
+            return False
+
+        fields = options.get('fields')
+        if isinstance(fields, dict) and not fields.get('_id', True):
+            return False
+
+        # a cached lookup doesn't need a round trip
+        return not self._database.cache.ttl_for(collection, options.get('cache'))
+
+    def load(self, collection, _id, callback, fields=None, read_preference=None,
+             cache=None):
+        """Call `callback` with a (document, error) tuple for the document
+        of `collection` whose _id is `_id`
+
+        the batched lookups are never cached, `cache` is accepted for the
+        options of find_one.
+        """
+        key = (collection, repr(fields), read_preference)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = OrderedDict()
+            IOLoop.current().add_callback(self._flush, key, fields)
+
+        waiter = (stack_context.wrap(callback), stack_context.wrap(_raise))
+        batch.setdefault(_id, []).append(waiter)
+
+    def _flush(self, key, fields):
+        batch = self._batches.pop(key)
+        ids = list(batch)
+        for i in range(0, len(ids), self._max_batch):
+            self._send(key, fields, ids[i:i + self._max_batch], batch)
+
+    @gen.engine
+    def _send(self, key, fields, ids, batch):
+        collection, _, read_preference = key
+        if len(ids) == 1:
+            spec = {'_id': ids[0]}
+        else:
+            spec = {'_id': {'$in': ids}}
+            logger.debug('loading {0} ids of {1} in one query'.format(len(ids), collection))
+
+        documents, error, failure = [], None, None
+        try:
+            result, error = yield gen.Task(Cursor(self._database, collection, spec,
+                                                  fields, read_preference=read_preference,
+                                                  limit=-1 if len(ids) == 1 else 0).find)
+            if isinstance(result, dict):
+                result = [result]
+            documents = result or []
+        except Error as e:
+            # the callers still waiting must not hang
+            failure = e
+
+        found = dict((document['_id'], document) for document in documents)
+        for _id in ids:
+            document = found.get(_id)
+            for callback, fail in batch[_id]:
+                try:
+                    if failure is not None:
+                        fail(failure)
+                    else:
+                        callback((document, error))
+                except Exception:
+                    logger.exception('{0} callback failed'.format(self))
@@ -17,21 +17,137 @@
 
 import logging
 import random
+import time
+from datetime import timedelta
+from functools import partial
 import six
 from tornado import gen
+from tornado.ioloop import IOLoop
 from bson import SON
 from mongotor.pool import ConnectionPool
 from mongotor.connection import Connection
-from mongotor.errors import InterfaceError, TooManyConnections
+from mongotor.errors import Error
+from mongotor.helpers import _optime_of
 
 logger = logging.getLogger(__name__)
 
 
+class CircuitBreaker(object):
+    """Eject a sick node from the selection, from real operation outcomes
+
+    The circuit opens when `max_consecutive_failures` operations in a row
+    failed, or when more than `max_error_rate` of the recent operations
+    failed or were slower than `slow_latency` ms. An open circuit rejects
+    the node for `backoff` seconds, doubled at each failed probe up to
+    `max_backoff`. Then a single probe operation is let through (half
+    open): if it succeeds the circuit closes, otherwise it opens again.
+
+    :Parameters:
+      - `stats`: the :class:`~mongotor.pool.OperationStats` of the node pool
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, stats, max_consecutive_failures=5, max_error_rate=0.5,
+                 min_operations=20, slow_latency=5000, backoff=1, max_backoff=30):
+        self._stats = stats
+        self._max_consecutive_failures = max_consecutive_failures
+        self._max_error_rate = max_error_rate
+        self._min_operations = min_operations
+        self._slow_latency = slow_latency
+        self._initial_backoff = backoff
+        self._max_backoff = max_backoff
+
+        self.state = self.CLOSED
+        self._backoff = backoff
+        self._open_until = 0
+        self._probe_operations = None
+
+    def __repr__(self):
+        return "CircuitBreaker {0}".format(self.state)
+
+    def _tripped(self):
+        if self._stats.consecutive_failures >= self._max_consecutive_failures:
+            return True
+
+        error_rate, operations = self._stats.error_rate(self._slow_latency)
+        return operations >= self._min_operations and error_rate > self._max_error_rate
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._open_until = now + self._backoff
+        self._backoff = min(self._backoff * 2, self._max_backoff)
+        logger.warn('{0} opened for {1}s'.format(self, self._open_until - now))
+
+    def _close(self):
+        self.state = self.CLOSED
+        self._backoff = self._initial_backoff
+        self._stats.reset_outcomes()
+
+    def _update(self, now):
+        """Apply the transitions following the outcomes of the operations"""
+        if self.state == self.CLOSED:
+            if self._tripped():
+                self._open(now)
+        elif self.state == self.HALF_OPEN and \
+                self._stats.operations > self._probe_operations:
+            # the probe finished
+            if self._stats.last_failed:
+                self._open(now)
+            else:
+                self._close()
+
+    @property
+    def ejected(self):
+        """True while operations must not be sent to the node
+
+        checking never takes the probe of an open circuit, only
+        :meth:`acquire` does, for the node actually selected.
+        """
+        now = time.time()
+        self._update(now)
+
+        # an open circuit, or a half open one waiting for its probe
+        return self.state != self.CLOSED and now < self._open_until
+
+    def acquire(self):
+        """Account an operation sent to the node, return False if the
+        circuit rejects it. Once the backoff expired, the operation is the
+        probe of the half open circuit."""
+        now = time.time()
+        self._update(now)
+
+        if self.state == self.CLOSED:
+            return True
+
+        if now < self._open_until:
+            return False
+
+        # let one probe through, if it never completes another one is
+        # allowed after the backoff
+        self.state = self.HALF_OPEN
+        self._probe_operations = self._stats.operations
+        self._open_until = now + self._backoff
+        return True
+
+
 class Node(object):
     """Node of database cluster
+
+    the node state is monitored through a dedicated connection, outside of
+    the pool, so heartbeats don't wait for a saturated pool.
+
+    :Parameters:
+      - `monitor_timeout` (optional): seconds to connect and to wait for
+        the ismaster reply of the monitoring connection
+      - `pools` (optional): options of the named pools, overriding
+        `pool_kargs`, keyed by name
     """
 
-    def __init__(self, host, port, database, pool_kargs=None):
+    def __init__(self, host, port, database, pool_kargs=None, monitor_timeout=5,
+                 pools=None):
         if not pool_kargs:
             pool_kargs = {}
 
@@ -45,55 +161,143 @@ class Node(object):
 
         self.is_primary = False
         self.is_secondary = False
+        self.is_mongos = False
         self.available = False
         self.initialized = False
+        self.ping_time = None  # moving average of ismaster round trips, in ms
+        self.optime = None  # timestamp of the last write applied by the node
+        self.tags = {}
+        self.monitor_timeout = monitor_timeout
+        self._monitor = None
+        self._config_callbacks = []
 
         self.pool = ConnectionPool(self.host, self.port, self.database.dbname,
                                    **self.pool_kargs)
+        self.breaker = CircuitBreaker(self.pool.stats)
+        self._pool_options = pools or {}
+        self._named_pools = {}
 
-    @gen.engine
     def config(self, callback=None):
+        """Update the node state with an ismaster sent through the
+        monitoring connection. Concurrent calls share the same ismaster.
+        """
+        self._config_callbacks.append(callback)
+        if len(self._config_callbacks) == 1:  # if another config is not in progress
+            self._config()
+
+    def _monitor_connection(self, callback):
+        if self._monitor is not None and not self._monitor.closed():
+            callback(self._monitor)
+            return
+
+        self._monitor = Connection(host=self.host, port=self.port,
+                                   autoreconnect=False, connect=False,
+                                   timeout=self.monitor_timeout)
+        self._monitor.connect(partial(callback, self._monitor))
+
+    @gen.engine
+    def _config(self):
         ismaster = SON([('ismaster', 1)])
 
         response = None
+        timeout = None
         try:
-            try:
-                connection = yield gen.Task(self.connection)
-            except TooManyConnections:
-                # create a connection on the fly if pool is full
-                connection = Connection(host=self.host, port=self.port)
+            connection = yield gen.Task(self._monitor_connection)
+            # a node which doesn't answer in time is considered unavailable
+            timeout = IOLoop.instance().add_timeout(
+                timedelta(seconds=self.monitor_timeout), connection.close)
+            start = time.time()
             response, error = yield gen.Task(self.database._command, ismaster,
                                              connection=connection)
-            if not connection._pool:  # if connection is created on the fly
-                connection.close()
-        except InterfaceError as ie:
+            self._update_ping_time((time.time() - start) * 1000)
+        except Error as e:
             logger.error('oops, database node {host}:{port} is unavailable: {error}'
-                         .format(host=self.host, port=self.port, error=ie))
+                         .format(host=self.host, port=self.port, error=e))
+            if self._monitor:
+                self._monitor.close()
+        finally:
+            if timeout:
+                IOLoop.instance().remove_timeout(timeout)
 
         if response:
             self.is_primary = response.get('ismaster', True)
             self.is_secondary = response.get('secondary', False)
+            self.is_mongos = response.get('msg') == 'isdbgrid'
+            self.optime = _optime_of(response.get('lastWrite', {}).get('opTime'))
+            self.tags = response.get('tags', {})
             self.available = True
         else:
             self.available = False
 
         self.initialized = True
 
-        if callback:
-            callback()
+        callbacks, self._config_callbacks = self._config_callbacks, []
+        for callback in callbacks:
+            if callback:
+                callback()
+
+    def _update_ping_time(self, ping_time):
+        if self.ping_time is None:
+            self.ping_time = ping_time
+        else:
+            self.ping_time = 0.8 * self.ping_time + 0.2 * ping_time
+
+    @property
+    def healthy(self):
+        """False while the circuit breaker ejects this node"""
+        return not self.breaker.ejected
+
+    @property
+    def load(self):
+        """Estimated cost of sending one more operation to this node
+
+        outstanding requests (connections in use and requests waiting for
+        one) weighted by the recent latency of the node.
+        """
+        latency = self.pool.stats.latency or self.ping_time or 1
+        return (self.pool.in_use + self.pool.waiters + 1) * latency
+
+    def get_pool(self, name=None):
+        """Return the pool named `name`, the default pool if None
+
+        named pools isolate a kind of traffic, e.g. analytics queries,
+        in their own connections.
+        """
+        if name is None:
+            return self.pool
+
+        pool = self._named_pools.get(name)
+        if pool is None:
+            kwargs = dict(self.pool_kargs)
+            kwargs.update(self._pool_options.get(name, {}))
+            pool = ConnectionPool(self.host, self.port, self.database.dbname, **kwargs)
+            self._named_pools[name] = pool
+
+        return pool
 
     def disconnect(self):
+        if self._monitor and not self._monitor.closed():
+            self._monitor.close()
         self.pool.close()
+        for pool in self._named_pools.values():
+            pool.close()
 
     def __repr__(self):
-        return """MongoDB node {host}:{port} ({primary}, {secondary})""" \
+        return """MongoDB node {host}:{port} ({primary}, {secondary}, {mongos})""" \
             .format(host=self.host, port=self.port, primary=self.is_primary,
-                    secondary=self.is_secondary)
+                    secondary=self.is_secondary, mongos=self.is_mongos)
 
-    def connection(self, callback):
+    def connection(self, callback, pool=None):
         """Return one connection from pool
+
+        :Parameters:
+          - `pool` (optional): name of the pool, the default pool if None
+
+        the operation is accounted by the circuit breaker, the probe of an
+        open circuit is only taken by the node selected.
         """
-        self.pool.connection(callback)
+        self.breaker.acquire()
+        self.get_pool(pool).connection(callback)
 
 
 class ReadPreference(object):
@@ -102,11 +306,19 @@ class ReadPreference(object):
     * `PRIMARY`: Queries are sent to the primary of the replica set.
     * `PRIMARY_PREFERRED`: Queries are sent to the primary if available,
       otherwise a secondary.
-    * `SECONDARY`: Queries are distributed among secondaries. An error
-      is raised if no secondaries are available.
+    * `SECONDARY`: Queries are distributed among secondaries, favouring
+      the least loaded ones. An error is raised if no secondaries are
+      available.
     * `SECONDARY_PREFERRED`: Queries are distributed among secondaries,
       or the primary if no secondary is available.
     * TODO: `NEAREST`: Queries are distributed among all members.
+
+    Nodes ejected by their :class:`CircuitBreaker` are skipped while another
+    node can serve the mode.
+
+    When the nodes are mongos routers of a sharded cluster, every mode
+    spreads the operations across the routers within `LOCAL_THRESHOLD_MS`
+    of the fastest one, and the mode itself is forwarded to mongos.
     """
 
     PRIMARY = 0
@@ -116,6 +328,64 @@ class ReadPreference(object):
     SECONDARY_PREFERRED = 3
     #NEAREST = 4
 
+    LOCAL_THRESHOLD_MS = 15
+
+    _MONGOS_MODES = {
+        PRIMARY_PREFERRED: 'primaryPreferred',
+        SECONDARY: 'secondary',
+        SECONDARY_PREFERRED: 'secondaryPreferred',
+    }
+
+    @classmethod
+    def mongos_mode(cls, mode):
+        """Return the `$readPreference` document understood by mongos,
+        or None for `PRIMARY`, which is the mongos default.
+        """
+        name = cls._MONGOS_MODES.get(mode)
+        if name:
+            return SON([('mode', name)])
+
+    @classmethod
+    def select_mongos_node(cls, nodes):
+        candidates = [node for node in nodes if node.available and node.is_mongos]
+        if not candidates:
+            return None
+
+        candidates = cls.healthy_nodes(candidates) or candidates
+
+        fastest = min(node.ping_time or 0 for node in candidates)
+        candidates = [node for node in candidates
+                      if (node.ping_time or 0) <= fastest + cls.LOCAL_THRESHOLD_MS]
+
+        return cls.select_least_loaded_node(candidates)
+
+    @classmethod
+    def healthy_nodes(cls, nodes):
+        return [node for node in nodes if node.healthy]
+
+    @classmethod
+    def filter_tags(cls, nodes, tags):
+        """Keep the secondaries matching the first tag set matched by any
+        of them, and the other nodes
+
+        :Parameters:
+          - `tags`: a tag set, or a list of tag sets by order of preference
+        """
+        if not tags:
+            return nodes
+
+        tag_sets = [tags] if isinstance(tags, dict) else tags
+        secondaries = [node for node in nodes if not node.is_primary and not node.is_mongos]
+        others = [node for node in nodes if node not in secondaries]
+
+        for tag_set in tag_sets:
+            matching = [node for node in secondaries
+                        if all(node.tags.get(k) == v for k, v in tag_set.items())]
+            if matching:
+                return others + matching
+
+        return others
+
     @classmethod
     def select_primary_node(cls, nodes):
         for node in nodes:
@@ -123,7 +393,10 @@ class ReadPreference(object):
                 return node
 
     @classmethod
-    def select_random_node(cls, nodes, secondary_only):
+    def select_random_node(cls, nodes, secondary_only, healthy_only=False):
+        """Select among the available nodes, skipping the ones ejected by
+        their circuit breaker unless all of them are and not `healthy_only`
+        """
         candidates = []
 
         for node in nodes:
@@ -135,32 +408,63 @@ class ReadPreference(object):
 
             candidates.append(node)
 
+        healthy_candidates = cls.healthy_nodes(candidates)
+        if healthy_candidates or healthy_only:
+            candidates = healthy_candidates
+
         if not candidates:
             return None
 
-        return random.choice(candidates)
+        return cls.select_least_loaded_node(candidates)
+
+    @classmethod
+    def select_least_loaded_node(cls, candidates):
+        """Power of two choices: pick two random candidates and return the
+        less loaded, so a slow node stops receiving its full share.
+        """
+        if len(candidates) == 1:
+            return candidates[0]
+
+        first, second = random.sample(candidates, 2)
+        if second.load < first.load:
+            return second
+
+        return first
 
     @classmethod
     def select_node(cls, nodes, mode=None):
+        mongos_node = cls.select_mongos_node(nodes)
+        if mongos_node:
+            return mongos_node
+
+        secondaries = [node for node in nodes if node.available and not node.is_primary]
+        return cls.select_candidate(cls.select_primary_node(nodes), secondaries, mode)
+
+    @classmethod
+    def select_candidate(cls, primary_node, secondaries, mode=None):
+        """Select for `mode` among the primary, possibly None, and the
+        available secondaries"""
         if mode is None:
             mode = cls.PRIMARY
 
         if mode == cls.PRIMARY:
-            return cls.select_primary_node(nodes)
+            return primary_node
 
         if mode == cls.PRIMARY_PREFERRED:
-            primary_node = cls.select_primary_node(nodes)
-            if primary_node:
+            if primary_node and primary_node.healthy:
                 return primary_node
             else:
-                return cls.select_node(nodes, cls.SECONDARY)
+                return (cls.select_random_node(secondaries, secondary_only=True) or
+                        primary_node)
 
         if mode == cls.SECONDARY:
-            return cls.select_random_node(nodes, secondary_only=True)
+            return cls.select_random_node(secondaries, secondary_only=True)
 
         if mode == cls.SECONDARY_PREFERRED:
-            secondary_node = cls.select_random_node(nodes, secondary_only=True)
+            secondary_node = cls.select_random_node(secondaries, secondary_only=True,
+                                                    healthy_only=True)
             if secondary_node:
                 return secondary_node
             else:
-                return cls.select_primary_node(nodes)
+                return (primary_node or
+                        cls.select_random_node(secondaries, secondary_only=True))
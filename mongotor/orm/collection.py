@@ -19,11 +19,13 @@ import re
 import logging
 import six
 from tornado import gen
+from tornado.concurrent import chain_future
 from mongotor.client import Client
 from mongotor.orm.field import Field
 from mongotor.orm.signal import (pre_save, post_save,
     pre_remove, post_remove, pre_update, post_update)
 from mongotor.orm.manager import Manager
+from mongotor.orm.projection import FieldFuture
 from mongotor.database import Database
 
 
@@ -40,6 +42,9 @@ class CollectionMetaClass(type):
         global __lazy_classes__
 
         fields_name_to_attr = attrs['_fields_name_to_attr'] = {}
+        deferred_fields = set()
+        for base in bases:
+            deferred_fields.update(getattr(base, '_deferred_fields', ()))
         # Add the document's fields to the _data
         for attr_name, attr_value in six.iteritems(attrs):
             if isinstance(attr_value, Field):
@@ -47,6 +52,9 @@ class CollectionMetaClass(type):
                     attr_value.name = attr_name
                 else:
                     fields_name_to_attr[attr_value.name] = attr_name
+                if attr_value.deferred:
+                    deferred_fields.add(attr_value.name)
+        attrs['_deferred_fields'] = frozenset(deferred_fields)
 
         new_class = super(CollectionMetaClass, cls).__new__(cls, name,
             bases, attrs)
@@ -76,9 +84,34 @@ class Collection(object):
     If you do not specify `__collection__` attribute, it is
     auto-generated from class name. Camel case is converted
     to snake case. For example: CamelCase -> camel_case.
+
+    The results of the queries of `objects` are cached for `__cache__`
+    seconds, False disables the cache of the collection.
+
+    With `__adaptive__` set to a number of queries, the queries of
+    `objects` made by a line of code only request the fields it read from
+    the documents of its first `__adaptive__` queries, and a field read
+    later is requested by the following queries.
+
+    .. warning::
+       After the warm-up, reading a field left out doesn't return its
+       value but a :class:`~mongotor.orm.projection.FieldFuture`, resolved
+       once the whole document is loaded, which must be yielded:
+       ``age = yield user.age``. Testing the truth of the future raises a
+       TypeError. Code reading fields without yielding them must leave
+       `__adaptive__` to 0, or load the instances with
+       :meth:`load` first.
     """
+    __cache__ = None
+    __adaptive__ = 0
     _fields_name_to_attr = {}  # maps field database name to field attr name
                                # will be filled in metaclass
+    _deferred_fields = frozenset()  # filled in metaclass
+    _batch = None  # the instances of the same query
+    _site = None  # call site recording the fields read
+    _projection = None  # fields loaded, None for the whole document
+    _deferred = None  # deferred fields not loaded yet
+    _loading = None
 
     def __new__(cls, class_name=None, *args, **kwargs):
         if class_name:
@@ -99,7 +132,7 @@ class Collection(object):
             iteritems = ((k,v) for k,v in iteritems if k in fields)
 
         for attr_name, attr_type in iteritems:
-            if isinstance(attr_type, Field):
+            if isinstance(attr_type, Field) and not self._unloaded(attr_type.name):
                 attr_value = getattr(self, attr_name)
                 if attr_value is not None:
                     items[attr_type.name] = attr_value
@@ -109,7 +142,7 @@ class Collection(object):
         if not fields:
             for cls in self.__class__.__mro__:
                 for attr_name, attr_type in six.iteritems(cls.__dict__):
-                    if isinstance(attr_type, Field):
+                    if isinstance(attr_type, Field) and not self._unloaded(attr_type.name):
                         attr_value = getattr(self, attr_name)
                         if attr_value is not None:
                             items[attr_type.name] = attr_value
@@ -148,8 +181,73 @@ class Collection(object):
     def get_client(self):
         return Client(Database(), self.__collection__)
 
+    def _unloaded(self, name):
+        if self._projection is not None and name not in self._projection:
+            return True
+
+        return bool(self._deferred) and name in self._deferred
+
+    def load(self):
+        """Load the fields left out by the projection of the query which
+        returned this instance, return a Future resolved once they are"""
+        if self._loading is None:
+            self._loading = self._load()
+        return self._loading
+
+    @gen.coroutine
+    def _load(self):
+        if self._projection is None and not self._deferred:
+            return
+
+        client = self.get_client()
+        document, error = yield gen.Task(client.find_one, self._id)
+        if error:
+            self._loading = None
+            raise error
+
+        dirty = set(self._dirty)
+        for (key, value) in six.iteritems(document or {}):
+            if key in self._data:
+                continue
+            try:
+                setattr(self, self._fields_name_to_attr.get(key, key), value)
+            except TypeError as e:
+                logger.warn(e)
+
+        self._dirty = dirty
+        self._projection = None
+        self._deferred = None
+
+    def _loaded(self, name, value):
+        """Set the value of `name`, read after the query"""
+        if name not in self._data and value is not None:
+            dirty = set(self._dirty)
+            try:
+                setattr(self, self._fields_name_to_attr.get(name, name), value)
+            except TypeError as e:
+                logger.warn(e)
+            self._dirty = dirty
+
+        if self._projection is not None:
+            self._projection.add(name)
+        if self._deferred:
+            self._deferred.discard(name)
+
+    def _load_field(self, field):
+        future = FieldFuture(field.name)
+        chain_future(self._fetch_field(field), future)
+        return future
+
+    @gen.coroutine
+    def _fetch_field(self, field):
+        if self._batch is not None and self._deferred and field.name in self._deferred:
+            yield self._batch.load(field.name)
+        else:
+            yield self.load()
+        raise gen.Return(field.__get__(self, type(self)))
+
     @gen.coroutine
-    def save(self, safe=True, check_keys=True):
+    def save(self, safe=True, check_keys=True, session=None):
         """Save a document
 
         >>> user = Users()
@@ -161,13 +259,15 @@ class Collection(object):
           - `check_keys` (optional): check if keys start with '$' or
             contain '.', raising :class:`~pymongo.errors.InvalidName`
             in either case
+          - `session` (optional): session whose following reads must see
+            this write
         - `callback` : method which will be called when save is finished
         """
         pre_save.send(instance=self)
 
         client = self.get_client()
         response, error = yield gen.Task(client.insert, self.as_dict(),
-            safe=safe, check_keys=check_keys)
+            safe=safe, check_keys=check_keys, session=session)
 
         self.clean_fields()
 
@@ -176,28 +276,32 @@ class Collection(object):
         raise gen.Return((response, error))
 
     @gen.coroutine
-    def remove(self, safe=True):
+    def remove(self, safe=True, session=None):
         """Remove a document
 
         :Parameters:
         - `safe` (optional): safe remove operation
+        - `session` (optional): session whose following reads must see this write
         - `callback` : method which will be called when remove is finished
         """
         pre_remove.send(instance=self)
 
         client = self.get_client()
-        response, error = yield gen.Task(client.remove, self._id, safe=safe)
+        response, error = yield gen.Task(client.remove, self._id, safe=safe,
+                                         session=session)
 
         post_remove.send(instance=self)
 
         raise gen.Return((response, error))
 
     @gen.coroutine
-    def update(self, document=None, upsert=False, safe=True, multi=False, force=False):
+    def update(self, document=None, upsert=False, safe=True, multi=False, force=False,
+               session=None):
         """Update a document
 
         :Parameters:
         - `safe` (optional): safe update operation
+        - `session` (optional): session whose following reads must see this write
         - `callback` : method which will be called when update is finished
         - `force`: if True will overide full document
         """
@@ -208,6 +312,8 @@ class Collection(object):
 
         if not document:
             if force:
+                # the fields left out by a projection must not be erased
+                yield self.load()
                 document = self.as_dict()
             else:
                 document = {"$set": self.as_dict(self.dirty_fields)}
@@ -216,7 +322,7 @@ class Collection(object):
         spec = {'_id': self._id}
 
         response, error = yield gen.Task(client.update, spec, document,
-            upsert=upsert, safe=safe, multi=multi)
+            upsert=upsert, safe=safe, multi=multi, session=session)
 
         self.clean_fields()
 
@@ -25,17 +25,31 @@ import six
 
 
 class Field(object):
+    """A field of a collection
 
-    def __init__(self, default=None, name=None, field_type=None):
+    a `deferred` field is left out of the queries of the manager. The
+    first time it is read it returns a Future of its value, to be yielded,
+    loaded with the values of the other instances returned by the same
+    query.
+    """
 
+    def __init__(self, default=None, name=None, field_type=None, deferred=False):
         self.field_type = field_type
         self.name = name
+        self.deferred = deferred
         self.default = self._validate(default)
 
     def __get__(self, instance, owner):
         if not instance:
             return self
 
+        if instance._site is not None:
+            instance._site.accessed(self.name)
+
+        if instance._unloaded(self.name):
+            # left out by the projection of the query
+            return instance._load_field(self)
+
         value = instance._data.get(self.name)
         if value is None:
             return self.default() if callable(self.default) else self.default
@@ -48,6 +62,12 @@ class Field(object):
             instance._dirty.add(self.name)
         instance._data[self.name] = value
 
+        # the value set is the one of the field, not to be loaded
+        if instance._projection is not None:
+            instance._projection.add(self.name)
+        if instance._deferred:
+            instance._deferred.discard(self.name)
+
     def _validate(self, value):
         if value is not None and not isinstance(value, self.field_type):
             try:
@@ -19,37 +19,113 @@ from bson.son import SON
 from tornado import gen
 from mongotor.database import Database
 from mongotor.client import Client
+from mongotor.orm.projection import CallSite, QueryBatch, call_site
 
 
 class Manager(object):
 
     def __init__(self, collection):
         self.collection = collection
+        self._sites = {}
 
     @gen.coroutine
-    def find_one(self, query):
+    def find_one(self, query, session=None):
+        """Find the instance matching `query`, None if there is no such
+        instance
+
+        after a write through `session`, the query reads from the primary or
+        a secondary which replicated the write.
+        """
+        batch, fields = self._query({})
         client = Client(Database(), self.collection.__collection__)
-        result, error = yield gen.Task(client.find_one, query)
+        kw = {'session': session} if session else {}  # lookups without session are batched
+        result, error = yield gen.Task(client.find_one, query, fields=fields,
+                                       cache=self.collection.__cache__, **kw)
 
         instance = None
         if result:
-            instance = self.collection.create(result, cleaned=True)
+            instance = self._create(result, batch)
 
         raise gen.Return(instance)
 
     @gen.coroutine
-    def find(self, query, **kw):
+    def find(self, query, session=None, **kw):
+        """Find the instances matching `query`
+
+        after a write through `session`, the query reads from the primary or
+        a secondary which replicated the write. See
+        :meth:`~mongotor.client.Client.find` for the other arguments.
+        """
+        batch, kw['fields'] = self._query(kw)
         client = Client(Database(), self.collection.__collection__)
-        result, error = yield gen.Task(client.find, query, **kw)
+        kw.setdefault('cache', self.collection.__cache__)
+        result, error = yield gen.Task(client.find, query, session=session, **kw)
 
         items = []
 
         if result:
             for item in result:
-                items.append(self.collection.create(item, cleaned=True))
+                items.append(self._create(item, batch))
 
         raise gen.Return(items)
 
+    @gen.coroutine
+    def page(self, query, sort=None, size=20, token=None, session=None):
+        """Find a page of `size` documents sorted by `sort`, starting after
+        the page of `token`
+
+        Resolves to the instances and the token of the next page, None
+        after the last one. See :meth:`~mongotor.cursor.Cursor.page`.
+        """
+        batch, fields = self._query({})
+        client = Client(Database(), self.collection.__collection__)
+        cursor = client.find(query, fields=fields, sort=sort,
+                             cache=self.collection.__cache__, session=session)
+        documents, next_token = yield cursor.page(size, token)
+
+        items = [self._create(document, batch) for document in documents]
+        raise gen.Return((items, next_token))
+
+    def _query(self, kw):
+        """Return the :class:`~mongotor.orm.projection.QueryBatch` of a
+        query, None when all its fields are loaded, and the fields it
+        should request
+
+        must be called before the first yield of the query, while the
+        caller is still on the stack.
+        """
+        fields = kw.get('fields')
+        if fields is not None:
+            return None, fields
+
+        site = None
+        warmup = self.collection.__adaptive__
+        if warmup:
+            key = call_site()
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = CallSite()
+            fields = site.projection(warmup)
+
+        projection = None if fields is None else set(fields)
+        deferred = self.collection._deferred_fields
+        if deferred and fields is None:
+            fields = dict((name, 0) for name in deferred)
+        elif deferred:
+            deferred = deferred.difference(fields)
+
+        if site is None and not deferred:
+            return None, fields
+
+        return QueryBatch(self.collection, site, projection, deferred), fields
+
+    def _create(self, document, batch):
+        instance = self.collection.create(document, cleaned=True)
+        if batch is not None:
+            batch.add(instance)
+
+        return instance
+
     @gen.coroutine
     def remove(self, *args, **kwargs):
         client = Client(Database(), self.collection.__collection__)
@@ -68,7 +144,7 @@ class Manager(object):
     @gen.coroutine
     def count(self, query=None):
         client = Client(Database(), self.collection.__collection__)
-        count = yield client.find(query).count()
+        count = yield client.find(query, cache=self.collection.__cache__).count()
         raise gen.Return(count)
 
     @gen.coroutine
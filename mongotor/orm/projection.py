@@ -0,0 +1,150 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sys
+import weakref
+from tornado import gen
+from tornado.concurrent import Future
+
+# frames of these packages are skipped to find the caller of a query
+_INTERNAL_MODULES = ('mongotor.', 'tornado.')
+
+
+class CallSite(object):
+    """The fields read from the documents of the queries of a line of code
+
+    once `warmup` queries were observed, the queries of the call site
+    only request the fields read so far. A field read later is added to
+    the projection of the following queries.
+    """
+    __slots__ = ('queries', 'fields')
+
+    def __init__(self):
+        self.queries = 0
+        self.fields = set(['_id'])
+
+    def __repr__(self):
+        return "CallSite queries:{0} fields:{1}".format(self.queries, sorted(self.fields))
+
+    def projection(self, warmup):
+        """Account a query and return the fields it should request, or
+        None for whole documents"""
+        self.queries += 1
+        if self.queries <= warmup:
+            return None
+
+        return dict((name, 1) for name in self.fields)
+
+    def accessed(self, name):
+        self.fields.add(name)
+
+
+class FieldFuture(Future):
+    """The Future of a field left out by the projection of a query
+
+    it must be yielded to get the value of the field; testing its truth
+    raises a TypeError, as it would be true whatever the value.
+    """
+
+    def __init__(self, name):
+        super(FieldFuture, self).__init__()
+        self.name = name
+
+    def __bool__(self):
+        raise TypeError("field %s wasn't loaded by the query, yield it to "
+                        "get its value" % self.name)
+    __nonzero__ = __bool__
+
+
+def call_site():
+    """Return the (filename, line) of the code calling into mongotor"""
+    frame = sys._getframe(1)
+    while frame.f_back is not None and \
+            frame.f_globals.get('__name__', '').startswith(_INTERNAL_MODULES):
+        frame = frame.f_back
+
+    return frame.f_code.co_filename, frame.f_lineno
+
+
+class QueryBatch(object):
+    """The instances returned by a query of the manager
+
+    the instances share the call site of the query and load their
+    deferred fields together, with one query by field. The batch only
+    keeps weak references to them, an instance kept alive doesn't keep
+    the others.
+
+    :Parameters:
+      - `collection`: the :class:`~mongotor.orm.collection.Collection` class
+      - `site` (optional): the :class:`CallSite` of the query
+      - `projection` (optional): the fields requested, None for all
+      - `deferred` (optional): the deferred fields left out
+    """
+
+    def __init__(self, collection, site=None, projection=None, deferred=None):
+        self.collection = collection
+        self.site = site
+        self.projection = projection
+        self.deferred = deferred
+        self._refs = []
+        self._loading = {}
+
+    def __repr__(self):
+        return "QueryBatch {0} instances:{1}".format(self.collection.__collection__,
+                                                     len(self.instances))
+
+    @property
+    def instances(self):
+        """The instances of the query still alive"""
+        instances = [ref() for ref in self._refs]
+        return [instance for instance in instances if instance is not None]
+
+    def add(self, instance):
+        instance._batch = self
+        instance._site = self.site
+        if self.projection is not None:
+            instance._projection = set(self.projection)
+        if self.deferred:
+            instance._deferred = set(self.deferred)
+        self._refs.append(weakref.ref(instance))
+
+    def load(self, name):
+        """Load the field `name` of the instances still missing it, return
+        a Future resolved once they are"""
+        future = self._loading.get(name)
+        if future is None:
+            future = self._loading[name] = self._load(name)
+        return future
+
+    @gen.coroutine
+    def _load(self, name):
+        instances = [instance for instance in self.instances
+                     if instance._deferred and name in instance._deferred]
+        if not instances:
+            return
+
+        ids = [instance._id for instance in instances]
+        spec = {'_id': ids[0]} if len(ids) == 1 else {'_id': {'$in': ids}}
+        client = instances[0].get_client()
+        documents, error = yield gen.Task(client.find, spec, fields={name: 1})
+        if error:
+            del self._loading[name]
+            raise error
+
+        values = dict((document['_id'], document.get(name))
+                      for document in documents or [])
+        for instance in instances:
+            instance._loaded(name, values.get(instance._id))
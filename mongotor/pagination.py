@@ -0,0 +1,92 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+import binascii
+import bson
+from bson.errors import BSONError
+from bson.son import SON
+from mongotor.errors import InvalidOperationError
+
+
+def keyset_sort(sort):
+    """Return `sort` as a list of (key, direction) pairs ending with _id,
+    making the order of the documents total"""
+    if sort is None:
+        sort = []
+    elif isinstance(sort, dict):
+        sort = list(sort.items())
+
+    sort = [(key, direction) for key, direction in sort]
+    if '_id' not in [key for key, direction in sort]:
+        sort.append(('_id', 1))
+
+    return sort
+
+
+def encode_token(sort, document):
+    """Return the token of the page following `document`"""
+    values = [_get(document, key) for key, direction in sort]
+    data = bson.BSON.encode(SON([('s', _keys(sort)), ('v', values)]))
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_token(token, sort):
+    """Return the sort key values carried by `token`
+
+    raises :class:`~mongotor.errors.InvalidOperationError` if the token is
+    malformed or was made for another sort.
+    """
+    try:
+        data = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        document = bson.BSON(data).decode()
+    except (TypeError, ValueError, binascii.Error, BSONError):
+        raise InvalidOperationError('invalid page token')
+
+    if document.get('s') != _keys(sort) or \
+            len(document.get('v', [])) != len(sort):
+        raise InvalidOperationError('page token was made for another sort')
+
+    return document['v']
+
+
+def keyset_spec(sort, values):
+    """Return the spec of the documents sorted after `values`
+
+    for a sort on (a, b) the spec is
+    ``{'$or': [{a: {$gt: va}}, {a: va, b: {$gt: vb}}]}``, the operator
+    of each key following its direction.
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        clause = SON((sort[j][0], values[j]) for j in range(i))
+        clause[key] = {'$gt' if direction > 0 else '$lt': values[i]}
+        clauses.append(clause)
+
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
+def _keys(sort):
+    # the keys and directions of `sort`, as stored in the tokens
+    return [[key, 1 if direction > 0 else -1] for key, direction in sort]
+
+
+def _get(document, key):
+    for part in key.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
@@ -15,17 +15,189 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import random
+import time
+from collections import deque
 from datetime import timedelta
 from threading import Condition
 import six
+from tornado import stack_context
 from tornado.ioloop import IOLoop
 from functools import partial
 from mongotor.connection import Connection
-from mongotor.errors import TooManyConnections
+from mongotor.errors import TooManyConnections, InterfaceError
 
 log = logging.getLogger(__name__)
 
 
+class OperationStats(object):
+    """Outcome of the operations sent through the connections of a pool
+
+    keeps an exponentially weighted moving average of the round trips, in ms,
+    the last `window` round trips to compute percentiles and the last
+    `window` outcomes, a failure being recorded as None.
+    """
+
+    def __init__(self, alpha=0.2, window=100):
+        self._alpha = alpha
+        self._samples = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self.latency = None
+        self.operations = 0
+        self.consecutive_failures = 0
+
+    def __repr__(self):
+        return "OperationStats latency:{0} consecutive failures:{1}"\
+            .format(self.latency, self.consecutive_failures)
+
+    def add(self, latency):
+        self._samples.append(latency)
+        self._outcomes.append(latency)
+        self.operations += 1
+        self.consecutive_failures = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = (1 - self._alpha) * self.latency + self._alpha * latency
+
+    def add_failure(self):
+        self._outcomes.append(None)
+        self.operations += 1
+        self.consecutive_failures += 1
+
+    @property
+    def last_failed(self):
+        return bool(self._outcomes) and self._outcomes[-1] is None
+
+    def error_rate(self, slow_latency=None):
+        """Return the ratio of failed operations in the recent outcomes, and
+        their number. Operations slower than `slow_latency` count as failed.
+        """
+        if not self._outcomes:
+            return 0.0, 0
+
+        failures = 0
+        for latency in self._outcomes:
+            if latency is None or (slow_latency is not None and latency > slow_latency):
+                failures += 1
+
+        return float(failures) / len(self._outcomes), len(self._outcomes)
+
+    def reset_outcomes(self):
+        self._outcomes.clear()
+        self.consecutive_failures = 0
+
+    def percentile(self, percent, min_samples=10):
+        """Return the `percent` percentile of the recent round trips, or None
+        while there are fewer than `min_samples` of them.
+        """
+        if len(self._samples) < min_samples:
+            return None
+
+        samples = sorted(self._samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+class ReconnectGovernor(object):
+    """Pace the connection attempts made to a node
+
+    At most `max_attempts` connections are dialed at once. After a failed
+    attempt the next one waits an exponential backoff with full jitter,
+    so the clients of a restarted node don't reconnect at the same instant.
+    Requests which can't dial wait for a free slot when `wait` is True, and
+    fail with the error of the attempt they were waiting on; otherwise they
+    fail at once.
+
+    :Parameters:
+      - `max_attempts` (optional): concurrent connection attempts
+      - `backoff` (optional): seconds to wait after the first failure,
+        doubled on each consecutive failure
+      - `max_backoff` (optional): maximum seconds between attempts
+      - `wait` (optional): queue the requests instead of failing them
+    """
+
+    def __init__(self, max_attempts=2, backoff=0.1, max_backoff=10, wait=True):
+        assert max_attempts > 0
+
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._wait = wait
+        self._attempts = 0
+        self._failures = 0
+        self._next_attempt = 0
+        self._waiting = deque()
+        self._timeout = None
+
+    def __repr__(self):
+        return "ReconnectGovernor attempts:{0} failures:{1} waiting:{2}".format(
+            self._attempts, self._failures, len(self._waiting))
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def _can_attempt(self):
+        return self._attempts < self._max_attempts and \
+            time.time() >= self._next_attempt
+
+    def acquire(self, callback):
+        """Call `callback` when a connection attempt is allowed, with
+        an error as argument if the request was refused instead
+        """
+        if self._can_attempt():
+            self._attempts += 1
+            callback(None)
+            return
+
+        if not self._wait:
+            log.warn('{0} refusing connection attempt'.format(self))
+            callback(InterfaceError('node is reconnecting, try again later'))
+            return
+
+        self._waiting.append(stack_context.wrap(callback))
+        self._schedule()
+
+    def succeeded(self):
+        self._attempts -= 1
+        self._failures = 0
+        self._next_attempt = 0
+        self._drain()
+
+    def failed(self, error):
+        self._attempts -= 1
+        self._failures += 1
+
+        backoff = min(self._max_backoff, self._backoff * 2 ** (self._failures - 1))
+        self._next_attempt = time.time() + random.uniform(0, backoff)
+        log.warn('{0} connection failed, next attempt in {1:.2f}s'.format(
+            self, self._next_attempt - time.time()))
+
+        # the waiting requests would dial the same sick node
+        while self._waiting:
+            self._waiting.popleft()(error)
+
+    def _drain(self):
+        while self._waiting and self._can_attempt():
+            self._attempts += 1
+            self._waiting.popleft()(None)
+
+        self._schedule()
+
+    def _schedule(self):
+        if not self._waiting or self._timeout is not None or \
+                self._attempts >= self._max_attempts:
+            return
+
+        def on_timeout():
+            self._timeout = None
+            self._drain()
+
+        delay = max(0, self._next_attempt - time.time())
+        self._timeout = IOLoop.instance().add_timeout(timedelta(seconds=delay), on_timeout)
+
+
 class ConnectionPool(object):
     """Connection Pool
 
@@ -34,10 +206,17 @@ class ConnectionPool(object):
       - `maxusage` (optional): number of requests allowed on a connection before it is closed. 0 for unlimited
       - `dbname`: mongo database name
       - `autoreconnect`: autoreconnect on database
+      - `max_connecting` (optional): concurrent connection attempts to the node
+      - `reconnect_backoff` (optional): seconds to wait before reconnecting
+        after a failed attempt, doubled on each consecutive failure
+      - `max_reconnect_backoff` (optional): maximum seconds between attempts
+      - `reconnect_wait` (optional): wait for a pending attempt instead of
+        failing at once when the node is being reconnected
 
     """
     def __init__(self, host, port, dbname, maxconnections=0, maxusage=0,
-                 autoreconnect=True):
+                 autoreconnect=True, max_connecting=2, reconnect_backoff=0.1,
+                 max_reconnect_backoff=10, reconnect_wait=True):
 
         assert isinstance(host, six.string_types)
         assert isinstance(port, int)
@@ -52,8 +231,12 @@ class ConnectionPool(object):
         self._maxusage = maxusage
         self._autoreconnect = autoreconnect
         self._connections = 0
+        self._waiters = 0
         self._idle_connections = []
         self._condition = Condition()
+        self.stats = OperationStats()
+        self.governor = ReconnectGovernor(max_connecting, reconnect_backoff,
+                                          max_reconnect_backoff, reconnect_wait)
 
         for i in range(self._maxconnections):
             conn = self._create_connection()
@@ -63,10 +246,20 @@ class ConnectionPool(object):
         return "ConnectionPool {0}:{1}:{2} using:{3}, idle:{4} :::: "\
             .format(id(self), self._host, self._port, self._connections, len(self._idle_connections))
 
+    @property
+    def in_use(self):
+        """Number of connections checked out of the pool"""
+        return self._connections
+
+    @property
+    def waiters(self):
+        """Number of requests waiting for a connection to be released"""
+        return self._waiters
+
     def _create_connection(self):
         log.debug('{0} creating new connection'.format(self))
         return Connection(host=self._host, port=self._port, pool=self,
-                          autoreconnect=self._autoreconnect)
+                          autoreconnect=self._autoreconnect, connect=False)
 
     def connection(self, callback=None, retries=0):
         """Get a connection from pool
@@ -77,6 +270,9 @@ class ConnectionPool(object):
         """
         self._condition.acquire()
         try:
+            if retries:
+                self._waiters -= 1
+
             try:
                 conn = self._idle_connections.pop(0)
             except IndexError:
@@ -85,6 +281,7 @@ class ConnectionPool(object):
                         raise TooManyConnections()
 
                     log.warn('{0} too many connections, retries {1}'.format(self, retries))
+                    self._waiters += 1
                     retry_connection = partial(self.connection, retries=(retries + 1), callback=callback)
                     IOLoop.instance().add_timeout(timedelta(microseconds=300), retry_connection)
 
@@ -98,7 +295,25 @@ class ConnectionPool(object):
             self._condition.release()
 
         log.debug('{0} {1} connection retrieved'.format(self, conn))
-        callback(conn)
+        if conn.closed():
+            # new and dropped connections are dialed as the governor allows
+            self.governor.acquire(partial(self._connect, conn, callback))
+        else:
+            callback(conn)
+
+    def _connect(self, conn, callback, error):
+        if error:
+            self.release(conn)
+            raise error
+
+        conn.connect(partial(callback, conn))
+
+    def connect_succeeded(self, conn):
+        self.governor.succeeded()
+
+    def connect_failed(self, conn, error):
+        self.stats.add_failure()
+        self.governor.failed(error)
 
     def release(self, conn):
         if self._maxusage and conn.usage > self._maxusage:
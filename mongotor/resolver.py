@@ -0,0 +1,130 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import socket
+import time
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+from tornado.netutil import ThreadedResolver, is_valid_ip
+from mongotor.errors import InterfaceError
+
+logger = logging.getLogger(__name__)
+
+
+class CachingResolver(object):
+    """Resolve hostnames without blocking the IOLoop
+
+    Lookups run through a tornado :class:`~tornado.netutil.Resolver`, a
+    :class:`~tornado.netutil.ThreadedResolver` by default, and their
+    results are cached for `ttl` seconds. Concurrent lookups of the same
+    host share a single query.
+
+    :Parameters:
+      - `resolver` (optional): the tornado resolver doing the lookups
+      - `ttl` (optional): seconds a resolved address is cached
+    """
+    _instance = None
+
+    def __init__(self, resolver=None, ttl=60):
+        self._resolver = resolver
+        self._ttl = ttl
+        self._cache = {}
+        self._pending = {}
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __repr__(self):
+        return "CachingResolver ttl:{0} cached:{1}".format(self._ttl, len(self._cache))
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            self._resolver = ThreadedResolver()
+        return self._resolver
+
+    def cached(self, host, port):
+        """Return the cached addresses of `host`, or None if they are
+        unknown or expired. IP addresses are returned as they are.
+        """
+        if is_valid_ip(host):
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            return [(family, (host, port))]
+
+        entry = self._cache.get((host, port))
+        if entry and entry[0] > time.time():
+            return entry[1]
+
+    def resolve(self, host, port, callback):
+        """Resolve `host` and call `callback` with an (addresses, error)
+        tuple, addresses being a list of (family, address) pairs ordered
+        to alternate address families, and error an
+        :class:`~mongotor.errors.InterfaceError` if the lookup failed.
+        """
+        addresses = self.cached(host, port)
+        if addresses:
+            callback((addresses, None))
+            return
+
+        key = (host, port)
+        callback = stack_context.wrap(callback)
+        if key in self._pending:
+            self._pending[key].append(callback)
+            return
+
+        self._pending[key] = [callback]
+        future = self.resolver.resolve(host, port, socket.AF_UNSPEC)
+        IOLoop.instance().add_future(future, lambda future: self._on_resolve(key, future))
+
+    def _on_resolve(self, key, future):
+        callbacks = self._pending.pop(key)
+        try:
+            addresses = interleave_families(future.result())
+            error = None
+        except Exception as e:
+            logger.error('{0} could not resolve {1}: {2}'.format(self, key[0], e))
+            addresses, error = None, InterfaceError('could not resolve %s: %s' % (key[0], e))
+        else:
+            self._cache[key] = (time.time() + self._ttl, addresses)
+
+        for callback in callbacks:
+            callback((addresses, error))
+
+    def clear(self):
+        self._cache.clear()
+
+
+def interleave_families(addresses):
+    """Order `addresses` alternating their families, starting with the
+    family of the first one, as recommended for happy eyeballs connects.
+    """
+    if not addresses:
+        return []
+
+    first_family = addresses[0][0]
+    first = [address for address in addresses if address[0] == first_family]
+    others = [address for address in addresses if address[0] != first_family]
+
+    interleaved = []
+    for i in range(max(len(first), len(others))):
+        interleaved.extend(first[i:i + 1])
+        interleaved.extend(others[i:i + 1])
+
+    return interleaved
@@ -0,0 +1,65 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudget(object):
+    """Token bucket limiting how many operations may be retried
+
+    Every operation deposits `ratio` tokens and every retry withdraws
+    one, so during a real outage at most `ratio` of the traffic is sent
+    twice instead of doubling the load on the cluster. The same bucket
+    caps the extra reads sent by hedged queries.
+
+    :Parameters:
+      - `ratio` (optional): tokens earned by each operation
+      - `max_tokens` (optional): maximum balance, also the initial one
+      - `message` (optional): warning logged when a withdrawal is refused,
+        None to refuse silently
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10, message='exhausted, not retrying'):
+        assert ratio >= 0
+        assert max_tokens >= 0
+
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._message = message
+        self._balance = float(max_tokens)
+
+    def __repr__(self):
+        return "RetryBudget balance:{0:.2f} ratio:{1}".format(self._balance, self._ratio)
+
+    @property
+    def balance(self):
+        return self._balance
+
+    def deposit(self):
+        """Account a new operation"""
+        self._balance = min(self._max_tokens, self._balance + self._ratio)
+
+    def withdraw(self):
+        """Try to spend one token, return True if the retry is allowed"""
+        if self._balance < 1:
+            if self._message:
+                logger.warn('{0} {1}'.format(self, self._message))
+            return False
+
+        self._balance -= 1
+        return True
@@ -0,0 +1,88 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from fnmatch import fnmatchcase
+
+
+class Route(object):
+    """Options applied to the operations on matching collections
+
+    >>> Route('reports.*', read_preference=ReadPreference.SECONDARY,
+    ...       tags={'use': 'analytics'}, pool='analytics', timeout=30000)
+    >>> Route('*', operations=['aggregate', 'mapreduce'],
+    ...       read_preference=ReadPreference.SECONDARY_PREFERRED)
+
+    :Parameters:
+      - `collection` (optional): shell style pattern of the collection names
+      - `operations` (optional): the operations routed, ``find``, ``count``,
+        ``distinct``, ``aggregate``, ``mapreduce``, ``group`` or any other
+        command name. All of them by default
+      - `read_preference` (optional): read preference of the operations
+      - `tags` (optional): a tag set, or a list of tag sets by order of
+        preference, the secondaries must match
+      - `pool` (optional): name of the connection pool, configured through
+        the `pools` argument of :meth:`~mongotor.database.Database.init`
+      - `timeout` (optional): server side time limit of the operations, in ms
+    """
+
+    def __init__(self, collection='*', operations=None, read_preference=None,
+                 tags=None, pool=None, timeout=None):
+        self.collection = collection
+        self.operations = frozenset(op.lower() for op in operations) \
+            if operations else None
+        self.read_preference = read_preference
+        self.tags = tags
+        self.pool = pool
+        self.timeout = timeout
+
+    def __repr__(self):
+        return "Route {0} {1}".format(self.collection, sorted(self.operations or ['*']))
+
+    def matches(self, collection, operation):
+        if self.operations is not None and operation.lower() not in self.operations:
+            return False
+
+        return fnmatchcase(collection or '', self.collection)
+
+
+class RoutingTable(object):
+    """Ordered routes, the first route matching an operation applies
+
+    :Parameters:
+      - `routes` (optional): a list of :class:`Route`
+    """
+
+    def __init__(self, routes=None):
+        self._routes = list(routes or [])
+
+    def __repr__(self):
+        return "RoutingTable {0}".format(self._routes)
+
+    def __len__(self):
+        return len(self._routes)
+
+    def add(self, collection='*', operations=None, **options):
+        """Append a route, see :class:`Route` for the options"""
+        route = Route(collection, operations, **options)
+        self._routes.append(route)
+        return route
+
+    def route(self, collection, operation):
+        """Return the first route matching `operation` on `collection`,
+        or None"""
+        for route in self._routes:
+            if route.matches(collection, operation):
+                return route
@@ -0,0 +1,233 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+from tornado import gen
+from tornado.concurrent import Future
+from mongotor.cursor import Cursor
+from mongotor.node import ReadPreference
+
+logger = logging.getLogger(__name__)
+
+try:
+    StopAsyncIteration
+except NameError:  # python < 3.5
+    StopAsyncIteration = StopIteration
+
+# documents sampled for each partition when splitVector is not available
+SAMPLES_PER_PARTITION = 10
+
+
+def partition_specs(spec, key, split_points):
+    """Return the specs of the ranges of `key` delimited by `split_points`,
+    each restricted by `spec`"""
+    bounds = [None] + list(split_points) + [None]
+    specs = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        condition = {}
+        if lower is not None:
+            condition['$gte'] = lower
+        if upper is not None:
+            condition['$lt'] = upper
+
+        partition = {key: condition} if condition else {}
+        if spec and partition:
+            partition = {'$and': [spec, partition]}
+        elif spec:
+            partition = spec
+        specs.append(partition)
+
+    return specs
+
+
+@gen.engine
+def split_points(database, collection, partitions, key='_id', callback=None):
+    """Find the values of `key` splitting `collection` in `partitions`
+    ranges of about the same size
+
+    asks `splitVector` for them, or samples the collection when the
+    command isn't allowed, e.g. through mongos.
+    """
+    points = []
+    if partitions > 1:
+        stats, error = yield gen.Task(database.command, 'collstats', collection,
+                                      read_preference=ReadPreference.SECONDARY_PREFERRED)
+        size = (stats or {}).get('size', 0)
+        if size:
+            response, error = yield gen.Task(
+                database.command, 'splitVector', database.get_collection_name(collection),
+                keyPattern={key: 1}, maxChunkSizeBytes=max(1, size // partitions),
+                read_preference=ReadPreference.SECONDARY_PREFERRED)
+            if response and response.get('ok'):
+                points = [split[key] for split in response.get('splitKeys', [])]
+            else:
+                points = yield gen.Task(_sample_points, database, collection,
+                                        partitions, key)
+
+    callback(_evenly(sorted(points), partitions))
+
+
+@gen.engine
+def _sample_points(database, collection, partitions, key, callback):
+    pipeline = [{'$sample': {'size': partitions * SAMPLES_PER_PARTITION}},
+                {'$project': {key: 1}}]
+    response, error = yield gen.Task(database.command, 'aggregate', collection,
+                                     pipeline=pipeline, cursor={},
+                                     read_preference=ReadPreference.SECONDARY_PREFERRED)
+    if not response or not response.get('ok'):
+        logger.warn('could not split {0}, scanning it in one partition'.format(collection))
+        callback([])
+        return
+
+    documents = response.get('cursor', {}).get('firstBatch') or response.get('result', [])
+    callback([document[key] for document in documents if key in document])
+
+
+def _evenly(points, partitions):
+    """Keep `partitions` - 1 points evenly spaced among `points`"""
+    if len(points) < partitions:
+        return points
+
+    step = float(len(points)) / partitions
+    return [points[int(step * i)] for i in range(1, partitions)]
+
+
+class ParallelScan(object):
+    """Scan a collection through several cursors at once
+
+    the range of an indexed `key` is split in `partitions`, each one read
+    by its own cursor, connection and, with the default read preference,
+    secondary. The documents are read as one stream, in the order they
+    arrive or, if `ordered`, in `key` order.
+
+    >>> scan = db.users.parallel_scan(partitions=8)
+    >>> while (yield scan.fetch_next()):
+    ...     user = scan.next_object()
+
+    :Parameters:
+      - `partitions` (optional): number of concurrent cursors
+      - `spec` (optional): restrict the scan to the matching documents
+      - `key` (optional): the indexed key splitting the collection
+      - `ordered` (optional): stream the documents sorted by `key`
+      - `read_preference` (optional): read preference of the cursors,
+        SECONDARY_PREFERRED by default
+      - `**kwargs` (optional): other options of the cursors, e.g.
+        `fields`, `batch_size` or `prefetch`
+    """
+
+    def __init__(self, database, collection, partitions=4, spec=None, key='_id',
+                 ordered=False, read_preference=None, **kwargs):
+        assert partitions > 0
+
+        if read_preference is None:
+            read_preference = ReadPreference.SECONDARY_PREFERRED
+
+        self._database = database
+        self._collection = collection
+        self._partitions = partitions
+        self._spec = spec or {}
+        self._key = key
+        self._ordered = ordered
+        self._read_preference = read_preference
+        self._kwargs = kwargs
+        self._cursors = None
+        self._pending = {}
+        self._current = None
+
+    def __repr__(self):
+        return "ParallelScan {0} partitions:{1}".format(self._collection, self._partitions)
+
+    @gen.coroutine
+    def _start(self):
+        points = yield gen.Task(split_points, self._database, self._collection,
+                                self._partitions, self._key)
+
+        sort = [(self._key, 1)] if self._ordered else None
+        self._cursors = [Cursor(self._database, self._collection, spec, sort=sort,
+                                read_preference=self._read_preference, **self._kwargs)
+                         for spec in partition_specs(self._spec, self._key, points)]
+        logger.debug('{0} split in {1} ranges'.format(self, len(self._cursors)))
+
+    @gen.coroutine
+    def fetch_next(self):
+        """Resolve to True when a document can be read with :meth:`next_object`"""
+        if self._cursors is None:
+            yield self._start()
+
+        while self._cursors:
+            readable = self._cursors[:1] if self._ordered else self._cursors
+            for cursor in readable:
+                if cursor._data:
+                    self._current = cursor
+                    raise gen.Return(True)
+
+            # every partition without documents fetches its next batch
+            for cursor in self._cursors:
+                if not cursor._data and cursor not in self._pending:
+                    self._pending[cursor] = cursor.fetch_next()
+
+            cursor = yield self._first_done(readable)
+            if not self._pending.pop(cursor).result():
+                self._cursors.remove(cursor)
+
+        raise gen.Return(False)
+
+    def _first_done(self, cursors):
+        """Resolve to the first of `cursors` whose fetch is done"""
+        first = Future()
+
+        def on_done(cursor):
+            if not first.done():
+                first.set_result(cursor)
+
+        for cursor in cursors:
+            future = self._pending.get(cursor)
+            if future is not None:
+                future.add_done_callback(lambda f, cursor=cursor: on_done(cursor))
+
+        return first
+
+    def next_object(self):
+        """Return the next document already fetched, or None"""
+        if self._current is not None:
+            return self._current.next_object()
+
+    def __aiter__(self):
+        return self
+
+    @gen.coroutine
+    def __anext__(self):
+        """Resolve to the next document, for ``async for`` on python 3.5+"""
+        has_next = yield self.fetch_next()
+        if not has_next:
+            raise StopAsyncIteration()
+
+        raise gen.Return(self.next_object())
+
+    @gen.engine
+    def find(self, callback):
+        """Return all the documents of the scan"""
+        documents = []
+        while (yield self.fetch_next()):
+            documents.append(self.next_object())
+
+        callback((documents, None))
+
+    def close(self):
+        """Close the cursors of the partitions"""
+        for cursor in self._cursors or []:
+            cursor.close()
+        self._cursors = []
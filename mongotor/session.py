@@ -0,0 +1,85 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+from mongotor.node import ReadPreference
+from mongotor.helpers import _optime_of
+
+
+class Session(object):
+    """Read your own writes while reading from secondaries
+
+    Writes and reads made through the same session are tracked: after a
+    write, the reads of the session go for `window` seconds to the
+    primary, or to a secondary which already replicated the write when
+    its optime is known. Other reads follow their read preference.
+
+    >>> session = Session(window=2)
+    >>> db.users.update({'_id': 1}, {'$set': {'name': 'x'}}, session=session, callback=...)
+    >>> db.users.find_one(1, session=session, callback=...)
+
+    :Parameters:
+      - `window` (optional): seconds the reads stick to the primary after a write
+    """
+
+    def __init__(self, window=1):
+        self.window = window
+        self._last_write = None
+        self._optime = None
+
+    def __repr__(self):
+        return "Session window:{0} optime:{1}".format(self.window, self._optime)
+
+    def record_write(self, response=None):
+        """Account a write made through the session
+
+        :Parameters:
+          - `response` (optional): the getLastError reply of the write,
+            holding the optime of the write
+        """
+        self._last_write = time.time()
+
+        optime = _optime_of((response or {}).get('lastOp'))
+        if optime is not None and (self._optime is None or optime > self._optime):
+            self._optime = optime
+
+    @property
+    def pinned(self):
+        """True while the reads of the session must see its last write"""
+        return self._last_write is not None and \
+            time.time() - self._last_write < self.window
+
+    def caught_up(self, node):
+        """Return True if `node` already replicated the last write"""
+        return self._optime is not None and node.optime is not None and \
+            node.optime >= self._optime
+
+    def read_preference(self, read_preference):
+        """Return the read preference forwarded to mongos or used to wait
+        for a node"""
+        if self.pinned:
+            return ReadPreference.PRIMARY
+        return read_preference
+
+    def select_node(self, nodes, read_preference):
+        if not self.pinned or read_preference == ReadPreference.PRIMARY:
+            return ReadPreference.select_node(nodes, read_preference)
+
+        caught_up = [node for node in nodes if node.is_secondary and self.caught_up(node)]
+        if caught_up:
+            return ReadPreference.select_node(caught_up, ReadPreference.SECONDARY)
+
+        return ReadPreference.select_node(nodes, ReadPreference.PRIMARY)
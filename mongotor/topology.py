@@ -0,0 +1,62 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from mongotor.node import ReadPreference
+
+
+class Topology(object):
+    """Immutable snapshot of the state of the nodes
+
+    the candidates of every read preference are computed once, when the
+    snapshot is built after a heartbeat changed the state of a node, so
+    selecting a node only weighs the health and the load of a few
+    candidates.
+
+    :Parameters:
+      - `nodes`: the nodes of the database
+      - `version` (optional): incremented by each new snapshot
+    """
+
+    __slots__ = ('version', 'nodes', 'primary', 'secondaries', 'mongos', 'state')
+
+    def __init__(self, nodes, version=0):
+        available = [node for node in nodes if node.available]
+
+        self.version = version
+        self.nodes = tuple(nodes)
+        self.mongos = tuple(node for node in available if node.is_mongos)
+        self.primary = ReadPreference.select_primary_node(available)
+        self.secondaries = tuple(node for node in available if not node.is_primary)
+        self.state = Topology.state_of(nodes)
+
+    def __repr__(self):
+        return "Topology version:{0} primary:{1} secondaries:{2} mongos:{3}".format(
+            self.version, self.primary, len(self.secondaries), len(self.mongos))
+
+    @staticmethod
+    def state_of(nodes):
+        return tuple((node.available, node.is_primary, node.is_secondary, node.is_mongos)
+                     for node in nodes)
+
+    def changed(self, nodes):
+        """Return True if the state of `nodes` differs from the snapshot"""
+        return tuple(nodes) != self.nodes or Topology.state_of(nodes) != self.state
+
+    def select_node(self, mode=None):
+        if self.mongos:
+            return ReadPreference.select_mongos_node(self.mongos)
+
+        return ReadPreference.select_candidate(self.primary, self.secondaries, mode)
@@ -0,0 +1,201 @@
+# coding: utf-8
+import gc
+from bson import ObjectId
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from mongotor.orm.collection import Collection
+from mongotor.orm.field import IntegerField, ListField, ObjectIdField, StringField
+from mongotor.orm.manager import Manager
+from mongotor.orm.projection import CallSite, QueryBatch, call_site
+from tests.util import unittest
+
+
+class ProfileTest(Collection):
+    __collection__ = "profile_test"
+    __adaptive__ = 2
+
+    _id = ObjectIdField()
+    name = StringField()
+    age = IntegerField()
+
+
+class HistoryTest(Collection):
+    __collection__ = "history_test"
+
+    _id = ObjectIdField()
+    name = StringField()
+    events = ListField(deferred=True)
+
+
+class FakeClient(object):
+
+    def __init__(self, *documents):
+        self.documents = dict((document['_id'], document) for document in documents)
+        self.queries = []
+
+    def find_one(self, spec_or_id, callback):
+        self.queries.append(spec_or_id)
+        callback((self.documents.get(spec_or_id), None))
+
+    def find(self, spec, fields, callback):
+        self.queries.append((spec, fields))
+        ids = spec['_id']['$in'] if isinstance(spec['_id'], dict) else [spec['_id']]
+        callback(([dict((key, value) for key, value in self.documents[_id].items()
+                        if key == '_id' or key in fields)
+                   for _id in ids if _id in self.documents], None))
+
+    def update(self, spec, document, callback, **kwargs):
+        self.queries.append(('update', spec, document))
+        callback(({'n': 1}, None))
+
+
+class CallSiteTestCase(unittest.TestCase):
+
+    def test_whole_documents_are_read_during_warmup(self):
+        """[CallSiteTestCase] - whole documents are read during the warm-up"""
+        site = CallSite()
+        site.accessed('name')
+
+        self.assertIsNone(site.projection(2))
+        self.assertIsNone(site.projection(2))
+        self.assertEqual(site.projection(2), {'_id': 1, 'name': 1})
+
+    def test_call_site_is_the_caller_line(self):
+        """[CallSiteTestCase] - the call site is the line calling the manager"""
+        site = call_site()
+
+        self.assertEqual(site[0], __file__.replace('.pyc', '.py'))
+
+    def test_manager_keeps_a_call_site_by_line(self):
+        """[CallSiteTestCase] - the manager keeps a call site by line"""
+        manager = Manager(ProfileTest)
+
+        first, fields = manager._query({})
+        second, fields = manager._query({})
+
+        self.assertIsNot(first.site, second.site)
+        self.assertEqual(len(manager._sites), 2)
+        self.assertEqual(manager._query({'fields': ['name']}), (None, ['name']))
+
+
+class PartialInstanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+        self.site = CallSite()
+        self._id = ObjectId()
+        batch = QueryBatch(ProfileTest, self.site, set(['_id', 'name']))
+        self.profile = ProfileTest.objects._create({'_id': self._id, 'name': u'joe'},
+                                                   batch)
+        self.client = FakeClient({'_id': self._id, 'name': u'joe', 'age': 42})
+        self.profile.get_client = lambda: self.client
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def test_reads_are_recorded_by_the_call_site(self):
+        """[PartialInstanceTestCase] - the fields read are recorded by the call site"""
+        self.assertEqual(self.profile.name, u'joe')
+
+        self.assertEqual(self.site.fields, set(['_id', 'name']))
+
+    def test_field_left_out_is_loaded(self):
+        """[PartialInstanceTestCase] - a field left out returns a future of its value"""
+        age = self.profile.age
+
+        self.assertIsInstance(age, Future)
+        self.assertEqual(self.io_loop.run_sync(lambda: age), 42)
+        self.assertEqual(self.profile.age, 42)
+        self.assertEqual(self.client.queries, [self._id])
+        self.assertIn('age', self.site.fields)
+        self.assertEqual(self.profile.dirty_fields, [])
+
+    def test_field_left_out_must_be_yielded(self):
+        """[PartialInstanceTestCase] - testing the truth of a field left out raises an error"""
+        age = self.profile.age
+
+        self.assertRaises(TypeError, bool, age)
+        self.assertEqual(self.io_loop.run_sync(lambda: age), 42)
+
+    def test_field_left_out_is_updated_once_set(self):
+        """[PartialInstanceTestCase] - a field left out and set is read and updated"""
+        self.profile.age = 30
+
+        self.assertEqual(self.profile.age, 30)
+        self.io_loop.run_sync(self.profile.update)
+        self.assertEqual(self.client.queries,
+                         [('update', {'_id': self._id}, {'$set': {'age': 30}})])
+
+    def test_as_dict_skips_fields_left_out(self):
+        """[PartialInstanceTestCase] - as_dict skips the fields left out"""
+        self.assertEqual(self.profile.as_dict(), {'_id': self._id, 'name': u'joe'})
+
+
+class DeferredFieldTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+        self.ids = [ObjectId(), ObjectId()]
+        self.client = FakeClient(*[{'_id': _id, 'name': u'joe', 'events': [i]}
+                                   for i, _id in enumerate(self.ids)])
+
+        batch, self.fields = HistoryTest.objects._query({})
+        self.histories = [HistoryTest.objects._create({'_id': _id, 'name': u'joe'}, batch)
+                          for _id in self.ids]
+        for history in self.histories:
+            history.get_client = lambda: self.client
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def test_deferred_fields_are_left_out(self):
+        """[DeferredFieldTestCase] - deferred fields are left out of the queries"""
+        self.assertEqual(HistoryTest._deferred_fields, frozenset(['events']))
+        self.assertEqual(self.fields, {'events': 0})
+        self.assertEqual(HistoryTest.objects._query({'fields': ['name']}), (None, ['name']))
+
+    def test_deferred_field_is_loaded_for_the_whole_query(self):
+        """[DeferredFieldTestCase] - a deferred field is loaded for all the instances of the query"""
+        events = self.histories[0].events
+
+        self.assertIsInstance(events, Future)
+        self.assertEqual(self.io_loop.run_sync(lambda: events), [0])
+        self.assertEqual(self.histories[1].events, [1])
+        self.assertEqual(self.client.queries,
+                         [({'_id': {'$in': self.ids}}, {'events': 1})])
+        self.assertEqual(self.histories[1].dirty_fields, [])
+
+    def test_loaded_fields_are_not_erased(self):
+        """[DeferredFieldTestCase] - a deferred field set before its load is kept"""
+        self.histories[1].events = [10]
+
+        self.io_loop.run_sync(lambda: self.histories[0].events)
+
+        self.assertEqual(self.histories[1].events, [10])
+
+    def test_deferred_field_is_updated_once_set(self):
+        """[DeferredFieldTestCase] - a deferred field set is read and updated without loading it"""
+        self.histories[0].events = [10]
+
+        self.assertEqual(self.histories[0].events, [10])
+        self.io_loop.run_sync(self.histories[0].update)
+        self.assertEqual(self.client.queries,
+                         [('update', {'_id': self.ids[0]}, {'$set': {'events': [10]}})])
+
+    def test_instances_are_not_kept_by_their_batch(self):
+        """[DeferredFieldTestCase] - an instance kept alive doesn't keep the others of its query"""
+        batch = self.histories[0]._batch
+        self.assertEqual(len(batch.instances), 2)
+
+        del self.histories[1]
+        gc.collect()
+
+        self.assertEqual(batch.instances, [self.histories[0]])
+        self.io_loop.run_sync(lambda: self.histories[0].events)
+        self.assertEqual(self.client.queries, [({'_id': self.ids[0]}, {'events': 1})])
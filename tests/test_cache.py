@@ -0,0 +1,135 @@
+# coding: utf-8
+import unittest
+from bson.son import SON
+from mongotor.cache import QueryCache, DEFAULT_TTL
+from mongotor.database import Database
+from mongotor.node import ReadPreference
+from mongotor.routing import RoutingTable
+
+
+class QueryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = QueryCache(max_bytes=1000)
+        self.key = self.cache.key('test.users', 'find', {'active': True})
+
+    def test_cache_results(self):
+        """[QueryCacheTestCase] - cache results by query"""
+        self.cache.put(self.key, [{'_id': 1}], 10, ttl=60)
+
+        self.assertEqual(self.cache.get(self.key), [{'_id': 1}])
+        self.assertEqual(self.cache.get(self.cache.key('test.users', 'find', {})), None)
+
+    def test_callers_get_their_own_copy(self):
+        """[QueryCacheTestCase] - modifying the documents of a query doesn't change the cache"""
+        documents = [{'_id': 1, 'tags': ['a']}]
+        self.cache.put(self.key, documents, 10, ttl=60)
+        documents[0]['tags'].append('b')
+
+        first = self.cache.get(self.key)
+        first[0]['name'] = 'joe'
+        first.append({'_id': 2})
+
+        self.assertEqual(self.cache.get(self.key), [{'_id': 1, 'tags': ['a']}])
+
+    def test_queries_differing_by_options_have_different_keys(self):
+        """[QueryCacheTestCase] - queries differing by an option have different keys"""
+        keys = set([self.key,
+                    self.cache.key('test.users', 'count', {'active': True}),
+                    self.cache.key('test.users', 'find', {'active': True}, limit=1),
+                    self.cache.key('test.users', 'find', {'active': True}, sort=[('a', 1)]),
+                    self.cache.key('test.posts', 'find', {'active': True})])
+
+        self.assertEqual(len(keys), 5)
+
+    def test_expired_results_are_dropped(self):
+        """[QueryCacheTestCase] - expired results are dropped"""
+        self.cache.put(self.key, [{'_id': 1}], 10, ttl=-1)
+
+        self.assertEqual(self.cache.get(self.key), None)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_least_recently_used_results_are_evicted(self):
+        """[QueryCacheTestCase] - least recently used results are evicted above max bytes"""
+        keys = [self.cache.key('test.users', 'find', {'_id': i}) for i in range(3)]
+        for key in keys:
+            self.cache.put(key, [], 250, ttl=60)
+        self.cache.get(keys[0])
+
+        self.cache.put(self.key, [], 250, ttl=60)
+
+        self.assertEqual(self.cache.get(keys[0]), [])
+        self.assertEqual(self.cache.get(keys[1]), None)
+        self.assertEqual(self.cache.get(keys[2]), [])
+        self.assertTrue(self.cache.size <= 1000)
+
+    def test_writes_invalidate_the_namespace(self):
+        """[QueryCacheTestCase] - a write drops the results of its namespace"""
+        other = self.cache.key('test.posts', 'find', {})
+        self.cache.put(self.key, [], 10, ttl=60)
+        self.cache.put(other, [], 10, ttl=60)
+
+        self.cache.invalidate('test.users')
+
+        self.assertEqual(self.cache.get(self.key), None)
+        self.assertEqual(self.cache.get(other), [])
+
+    def test_results_read_before_a_write_are_not_cached(self):
+        """[QueryCacheTestCase] - results read before a write are not cached"""
+        generation = self.cache.generation('test.users')
+        self.cache.invalidate('test.users')
+
+        self.cache.put(self.key, [], 10, ttl=60, generation=generation)
+
+        self.assertEqual(self.cache.get(self.key), None)
+
+    def test_ttl_of_collections(self):
+        """[QueryCacheTestCase] - ttl of the queries by collection and option"""
+        cache = QueryCache(ttl=0, ttls={'countries': 3600})
+
+        self.assertEqual(cache.ttl_for('countries'), 3600)
+        self.assertEqual(cache.ttl_for('users'), 0)
+        self.assertEqual(cache.ttl_for('users', cache=True), DEFAULT_TTL)
+        self.assertEqual(cache.ttl_for('countries', cache=False), 0)
+        self.assertEqual(cache.ttl_for('users', cache=5), 5)
+
+        cache.set_ttl('users', 10)
+        self.assertEqual(cache.ttl_for('users'), 10)
+
+
+class CommandInvalidationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.database = object.__new__(Database)
+        self.database._initialized = True
+        self.database._dbname = 'test'
+        self.database._routing = RoutingTable([])
+        self.database._read_preference = ReadPreference.PRIMARY
+        self.database._cache = QueryCache()
+        self.database._command = lambda command, **kwargs: None
+
+    def generations(self, command):
+        cache = self.database._cache
+        before = dict((name, cache.generation(name)) for name in ('test.users', 'test.stats'))
+        self.database.command(command)
+        return sorted(name for name in before if cache.generation(name) != before[name])
+
+    def test_reads_leave_the_cache_alone(self):
+        """[CommandInvalidationTestCase] - aggregations and inline map reduces leave the cache alone"""
+        self.assertEqual(self.generations(SON([('aggregate', 'users'),
+                                               ('pipeline', [{'$match': {}}])])), [])
+        self.assertEqual(self.generations(SON([('mapreduce', 'users'),
+                                               ('out', {'inline': 1})])), [])
+        self.assertEqual(self.generations(SON([('count', 'users')])), [])
+
+    def test_writes_invalidate_the_collection_written(self):
+        """[CommandInvalidationTestCase] - commands invalidate the collection they write"""
+        self.assertEqual(self.generations(SON([('aggregate', 'users'),
+                                               ('pipeline', [{'$out': 'stats'}])])),
+                         ['test.stats'])
+        self.assertEqual(self.generations(SON([('mapreduce', 'users'),
+                                               ('out', {'replace': 'stats'})])),
+                         ['test.stats'])
+        self.assertEqual(self.generations(SON([('findandmodify', 'users')])),
+                         ['test.users'])
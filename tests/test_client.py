@@ -3,6 +3,7 @@ import six
 from tornado.ioloop import IOLoop
 from tornado import testing
 from mongotor.database import Database
+from mongotor.node import ReadPreference
 from bson import ObjectId
 from datetime import datetime
 
@@ -345,3 +346,87 @@ class ClientTestCase(testing.AsyncTestCase):
         self.assertEquals(len(result['comment']), 1)
         self.assertEquals(result['comment'][0]['author'], 'joe')
         self.assertIsNone(_)
+
+    def test_parallel_scan(self):
+        """[ClientTestCase] - scan the collection in parallel partitions"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        documents = [{'_id': i, 'name': 'shouldbename'} for i in range(100)]
+        db.collection_test.insert(documents, safe=True, callback=self.stop)
+        self.wait()
+
+        db.collection_test.parallel_scan(partitions=4, ordered=True,
+            read_preference=ReadPreference.PRIMARY, callback=self.stop)
+        result, error = self.wait()
+
+        self.assertIsNone(error)
+        self.assertEquals([document['_id'] for document in result], list(range(100)))
+
+    def test_cached_find_is_invalidated_by_writes(self):
+        """[ClientTestCase] - cached results are dropped by a write"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+        db.cache.set_ttl('collection_test', 60)
+
+        db.collection_test.insert({'_id': 1, 'name': 'shouldbename'}, callback=self.stop)
+        self.wait()
+
+        db.collection_test.find({'name': 'shouldbename'}, callback=self.stop)
+        result, error = self.wait()
+        self.assertEquals(len(result), 1)
+        self.assertEquals(len(db.cache), 1)
+
+        db.collection_test.insert({'_id': 2, 'name': 'shouldbename'}, callback=self.stop)
+        self.wait()
+        self.assertEquals(len(db.cache), 0)
+
+        db.collection_test.find({'name': 'shouldbename'}, callback=self.stop)
+        result, error = self.wait()
+        self.assertEquals(len(result), 2)
+
+    def test_find_one_by_id_lookups_are_batched(self):
+        """[ClientTestCase] - concurrent find_one by id are read in one query"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        documents = [{'_id': i, 'name': 'shouldbename'} for i in range(3)]
+        db.collection_test.insert(documents, callback=self.stop)
+        self.wait()
+
+        results = {}
+
+        def on_document(_id, result):
+            results[_id] = result
+            if len(results) == 4:
+                self.stop()
+
+        for _id in (0, 1, 2, 10):
+            db.collection_test.find_one(_id, callback=lambda result, _id=_id: on_document(_id, result))
+        self.wait()
+
+        self.assertEquals(results[1], (documents[1], None))
+        self.assertEquals(results[10], (None, None))
+
+    def test_identical_finds_in_flight_share_the_result(self):
+        """[ClientTestCase] - identical finds in flight share the result"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        db.collection_test.insert({'_id': 1, 'name': 'shouldbename'}, callback=self.stop)
+        self.wait()
+
+        results = []
+
+        def on_result(result):
+            results.append(result)
+            if len(results) == 2:
+                self.stop()
+
+        for i in range(2):
+            db.collection_test.find({'name': 'shouldbename'}, single_flight=True,
+                callback=on_result)
+        self.assertEquals(len(db.flights), 1)
+        self.wait()
+
+        self.assertIs(results[0][0], results[1][0])
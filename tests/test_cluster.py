@@ -0,0 +1,275 @@
+# coding: utf-8
+import unittest
+from tornado import gen
+from tornado.ioloop import IOLoop
+from mongotor import cluster
+from mongotor.cluster import Cluster, HashRing, ShardDatabase, merge_sorted, _sort_value
+from mongotor.errors import IntegrityError, InterfaceError
+
+
+class HashRingTestCase(unittest.TestCase):
+
+    def test_keys_are_spread_across_shards(self):
+        """[HashRingTestCase] - keys are spread across the shards"""
+        ring = HashRing(['shard1', 'shard2', 'shard3'])
+        owners = [ring.get(i) for i in range(3000)]
+
+        for name in ('shard1', 'shard2', 'shard3'):
+            self.assertTrue(700 < owners.count(name) < 1300)
+
+    def test_adding_a_shard_moves_few_keys(self):
+        """[HashRingTestCase] - adding a shard only moves keys to it"""
+        ring = HashRing(['shard1', 'shard2', 'shard3'])
+        before = [ring.get(i) for i in range(3000)]
+
+        ring.add('shard4')
+        after = [ring.get(i) for i in range(3000)]
+
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        self.assertTrue(500 < len(moved) < 1000)
+        self.assertTrue(all(new == 'shard4' for old, new in moved))
+
+    def test_removing_a_shard(self):
+        """[HashRingTestCase] - removing a shard gives its keys to the others"""
+        ring = HashRing(['shard1', 'shard2'])
+        ring.remove('shard2')
+
+        self.assertEqual(ring.names, ['shard1'])
+        self.assertEqual(set(ring.get(i) for i in range(100)), set(['shard1']))
+
+
+class MergeSortedTestCase(unittest.TestCase):
+
+    def test_merge_sorted_results(self):
+        """[MergeSortedTestCase] - k-way merge of sorted results"""
+        results = [[{'a': 1}, {'a': 4}], [{'a': 2}, {'a': 3}, {'a': 5}], []]
+
+        merged = merge_sorted(results, [('a', 1)])
+        self.assertEqual([doc['a'] for doc in merged], [1, 2, 3, 4, 5])
+
+    def test_merge_sorted_results_by_several_keys(self):
+        """[MergeSortedTestCase] - merge by several keys and directions"""
+        results = [[{'a': 2, 'b': 1}, {'a': 1, 'b': 2}],
+                   [{'a': 2, 'b': 3}, {'a': 1}]]
+
+        merged = merge_sorted(results, [('a', -1), ('b', 1)])
+        self.assertEqual([(doc['a'], doc.get('b')) for doc in merged],
+                         [(2, 1), (2, 3), (1, None), (1, 2)])
+
+
+    def test_merge_by_dotted_keys(self):
+        """[MergeSortedTestCase] - merge by the values of embedded documents"""
+        results = [[{'author': {'name': 'ann'}}, {'author': {'name': 'joe'}}],
+                   [{'author': {}}, {'author': {'name': 'bob'}}]]
+
+        merged = merge_sorted(results, [('author.name', 1)])
+        self.assertEqual([doc['author'].get('name') for doc in merged],
+                         [None, 'ann', 'bob', 'joe'])
+
+    def test_merge_values_of_different_types(self):
+        """[MergeSortedTestCase] - values of different types are ordered by BSON type"""
+        results = [[{'a': 'x'}, {'a': True}], [{}, {'a': 2.5}, {'a': [1]}]]
+
+        merged = merge_sorted([sorted(docs, key=lambda doc: _sort_value(doc.get('a')))
+                               for docs in results], [('a', 1)])
+        self.assertEqual([doc.get('a') for doc in merged], [None, 2.5, 'x', [1], True])
+
+
+class ClusterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = Cluster({'shard1': ['localhost:27027'],
+                                'shard2': ['localhost:27028']}, 'test',
+                               shard_key=lambda collection, doc: doc.get('user_id'))
+
+    def tearDown(self):
+        self.cluster.disconnect()
+
+    def test_shards_are_independent_databases(self):
+        """[ClusterTestCase] - every shard owns its database"""
+        shard1, shard2 = self.cluster.shards['shard1'], self.cluster.shards['shard2']
+
+        self.assertIsInstance(shard1, ShardDatabase)
+        self.assertIsNot(shard1, shard2)
+        self.assertEqual(shard1._nodes[0].port, 27027)
+        self.assertEqual(shard2._nodes[0].port, 27028)
+
+    def test_route_by_shard_key(self):
+        """[ClusterTestCase] - route documents by shard key"""
+        shards = set(self.cluster.shard_for('events', {'user_id': i}) for i in range(100))
+
+        self.assertEqual(len(shards), 2)
+        self.assertIsNone(self.cluster.shard_for('events', {'type': 'click'}))
+        self.assertIsNone(self.cluster.shard_for('events', {'user_id': {'$in': [1, 2]}}))
+
+    def test_previous_owner_while_rebalancing(self):
+        """[ClusterTestCase] - keep the previous owner of moved keys until rebalanced"""
+        self.cluster.add_shard('shard3', ['localhost:27029'])
+        self.assertTrue(self.cluster.rebalancing)
+
+        shard3 = self.cluster.shards['shard3']
+        for i in range(100):
+            document = {'user_id': i}
+            previous = self.cluster.previous_shard_for('events', document)
+            if self.cluster.shard_for('events', document) is shard3:
+                self.assertIn(previous, (self.cluster.shards['shard1'],
+                                         self.cluster.shards['shard2']))
+            else:
+                self.assertIsNone(previous)
+
+
+def _matches(document, spec):
+    for key, value in (spec or {}).items():
+        if isinstance(value, dict):
+            if not document.get(key) > value['$gt']:
+                return False
+        elif document.get(key) != value:
+            return False
+    return True
+
+
+class FakeClient(object):
+    """Client of an in memory collection of each shard"""
+
+    stores = {}
+    down = ()
+
+    def __init__(self, database, collection):
+        self.documents = self.stores.setdefault((database, collection), {})
+        self.error = InterfaceError('connection closed') if database in self.down else None
+        self._database = self
+
+    def command(self, name, collection, callback, query=None, key=None):
+        if self.error:
+            callback((None, self.error))
+        elif name == 'count':
+            callback(({'n': len(self.documents), 'ok': 1}, None))
+        else:
+            callback(({'values': sorted(set(doc.get(key) for doc in self.documents.values())),
+                       'ok': 1}, None))
+
+    def find(self, spec=None, sort=None, limit=0, skip=0, callback=None, **kwargs):
+        if self.error:
+            callback((None, self.error))
+            return
+        documents = sorted((dict(document) for document in self.documents.values()
+                            if _matches(document, spec)), key=lambda doc: doc['_id'])
+        callback((documents[skip:skip + limit] if limit else documents[skip:], None))
+
+    def insert(self, document, callback=None, **kwargs):
+        if document['_id'] in self.documents:
+            callback((None, IntegrityError('duplicate key')))
+            return
+        self.documents[document['_id']] = dict(document)
+        callback(({'n': 0}, None))
+
+    def update(self, spec, document, upsert=False, callback=None, **kwargs):
+        found = [doc for doc in self.documents.values() if _matches(doc, spec)]
+        for doc in found:
+            self.documents[doc['_id']] = dict(document, _id=doc['_id'])
+        if not found and upsert:
+            self.documents[spec.get('_id', len(self.stores))] = dict(
+                document, _id=spec.get('_id', len(self.stores)))
+        callback(({'n': len(found) or int(upsert)}, None))
+
+    def remove(self, spec_or_id, callback=None, **kwargs):
+        spec = spec_or_id if isinstance(spec_or_id, dict) else {'_id': spec_or_id}
+        for doc in [doc for doc in self.documents.values() if _matches(doc, spec)]:
+            del self.documents[doc['_id']]
+        callback(({'n': 1}, None))
+
+
+class RebalanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+        self.client = cluster.Client
+        cluster.Client = FakeClient
+        FakeClient.stores = {}
+        FakeClient.down = ()
+
+        self.cluster = Cluster({'shard1': ['localhost:27027'],
+                                'shard2': ['localhost:27028']}, 'test',
+                               shard_key=lambda collection, doc: doc.get('user_id'))
+        self.cluster.add_shard('shard3', ['localhost:27029'])
+
+        # a user moved to shard3
+        shard3 = self.cluster.shards['shard3']
+        self.user_id = [i for i in range(100)
+                        if self.cluster.shard_for('events', {'user_id': i}) is shard3][0]
+        self.spec = {'user_id': self.user_id}
+        self.current = FakeClient(shard3, 'events').documents
+        self.previous = FakeClient(self.cluster.previous_shard_for('events', self.spec),
+                                   'events').documents
+        self.previous[1] = {'_id': 1, 'user_id': self.user_id, 'version': 'old'}
+
+    def tearDown(self):
+        cluster.Client = self.client
+        self.cluster.disconnect()
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def run_task(self, fn, *args, **kwargs):
+        return self.io_loop.run_sync(lambda: gen.Task(fn, *args, **kwargs))
+
+    def test_rebalance_keeps_newer_versions(self):
+        """[RebalanceTestCase] - a document written on its new shard isn't replaced by the migration"""
+        self.current[1] = {'_id': 1, 'user_id': self.user_id, 'version': 'new'}
+
+        moved = self.run_task(self.cluster.rebalance, ['events'])
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(self.previous, {})
+        self.assertEqual(self.current[1]['version'], 'new')
+
+    def test_upsert_moves_the_document_first(self):
+        """[RebalanceTestCase] - an upsert while rebalancing updates the document of the previous shard"""
+        response, error = self.run_task(self.cluster.events.update, self.spec,
+                                        {'user_id': self.user_id, 'version': 'new'},
+                                        upsert=True)
+
+        self.assertIsNone(error)
+        self.assertEqual(self.previous, {})
+        self.assertEqual(self.current, {1: {'_id': 1, 'user_id': self.user_id,
+                                            'version': 'new'}})
+
+        self.assertEqual(self.run_task(self.cluster.rebalance, ['events']), 0)
+        self.assertEqual(self.current[1]['version'], 'new')
+
+    def test_update_without_callback(self):
+        """[RebalanceTestCase] - updates don't require a callback"""
+        self.cluster.events.update(self.spec, {'user_id': self.user_id, 'version': 'new'},
+                                   safe=False)
+        self.cluster.events.update({'version': 'old'}, {'version': 'new'}, safe=False)
+        self.io_loop.run_sync(lambda: None)
+
+        self.assertEqual(self.previous[1]['version'], 'new')
+
+    def test_targeted_find_has_no_duplicates(self):
+        """[RebalanceTestCase] - a document on both shards is found once, from its new shard"""
+        self.current[1] = {'_id': 1, 'user_id': self.user_id, 'version': 'new'}
+        self.previous[2] = {'_id': 2, 'user_id': self.user_id, 'version': 'old'}
+
+        documents, error = self.run_task(self.cluster.events.find, self.spec,
+                                         sort=[('_id', 1)])
+
+        self.assertEqual([(doc['_id'], doc['version']) for doc in documents],
+                         [(1, 'new'), (2, 'old')])
+
+    def test_shard_errors_are_reported(self):
+        """[RebalanceTestCase] - a shard down fails the queries instead of returning partial results"""
+        self.current[2] = {'_id': 2, 'user_id': self.user_id, 'version': 'new'}
+        self.assertEqual(self.run_task(self.cluster.events.count), 2)
+        self.assertEqual(sorted(self.run_task(self.cluster.events.distinct, 'version')),
+                         ['new', 'old'])
+
+        FakeClient.down = (self.cluster.shards['shard3'],)
+
+        documents, error = self.run_task(self.cluster.events.find, {})
+        self.assertIsNone(documents)
+        self.assertIsInstance(error, InterfaceError)
+        self.assertRaises(InterfaceError, self.run_task, self.cluster.events.count)
+        self.assertRaises(InterfaceError, self.run_task, self.cluster.events.distinct,
+                          'version')
@@ -84,6 +84,144 @@ class CursorTestCase(testing.AsyncTestCase):
         self.assertEquals(str(result[1]['_id']), str(document2['_id']))
         self.assertIsNone(error)
 
+    def test_find_documents_in_several_batches(self):
+        """[CursorTestCase] - Find all documents of a query fetching several batches"""
+        for i in range(5):
+            self._insert_document({'_id': i, 'name': 'should be name %d' % i})
+
+        cursor = Cursor(database=Database(), collection='cursor_test',
+                        sort={'_id': 1}, batch_size=2)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['_id'] for doc in result], [0, 1, 2, 3, 4])
+        self.assertFalse(cursor.alive)
+        self.assertIsNone(error)
+
+    def test_fetch_next_batch_by_batch(self):
+        """[CursorTestCase] - Walk a query batch by batch with fetch_next"""
+        for i in range(5):
+            self._insert_document({'_id': i, 'name': 'should be name %d' % i})
+
+        cursor = Cursor(database=Database(), collection='cursor_test',
+                        sort={'_id': 1}, batch_size=2, limit=4)
+
+        ids = []
+        while True:
+            cursor.fetch_next().add_done_callback(self.stop)
+            if not self.wait().result():
+                break
+            ids.append(cursor.next_object()['_id'])
+
+        self.assertEquals(ids, [0, 1, 2, 3])
+        self.assertFalse(cursor.alive)
+
+    def test_prefetch_next_batch(self):
+        """[CursorTestCase] - Prefetch the next batch while documents are consumed"""
+        for i in range(6):
+            self._insert_document({'_id': i, 'name': 'should be name %d' % i})
+
+        cursor = Cursor(database=Database(), collection='cursor_test',
+                        sort={'_id': 1}, batch_size=2, prefetch=1)
+
+        cursor.fetch_next().add_done_callback(self.stop)
+        self.assertTrue(self.wait().result())
+        self.assertEquals(cursor.next_object()['_id'], 0)
+
+        # the second batch is requested while the first one is consumed
+        self.assertTrue(cursor._fetching)
+
+        ids = [1]
+        cursor.next_object()
+        while True:
+            cursor.fetch_next().add_done_callback(self.stop)
+            if not self.wait().result():
+                break
+            ids.append(cursor.next_object()['_id'])
+
+        self.assertEquals(ids, [1, 2, 3, 4, 5])
+
+    def test_find_documents_with_exhaust(self):
+        """[CursorTestCase] - Find all documents streamed by an exhaust cursor"""
+        for i in range(5):
+            self._insert_document({'_id': i, 'name': 'should be name %d' % i})
+
+        cursor = Cursor(database=Database(), collection='cursor_test',
+                        sort={'_id': 1}, batch_size=2, exhaust=True)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['_id'] for doc in result], [0, 1, 2, 3, 4])
+        self.assertIsNone(error)
+
+    def test_tail_capped_collection(self):
+        """[CursorTestCase] - Tail the documents inserted in a capped collection"""
+        Database().command('create', 'cursor_capped_test', capped=True, size=10000,
+                           callback=self.stop)
+        self.wait()
+
+        Database().cursor_capped_test.insert({'_id': 1}, callback=self.stop)
+        self.wait()
+
+        cursor = Cursor(database=Database(), collection='cursor_capped_test',
+                        tailable=True, await_data=True)
+        received = []
+
+        def on_document(document):
+            received.append(document['_id'])
+            if len(received) == 1:
+                Database().cursor_capped_test.insert({'_id': 2}, callback=lambda r: None)
+            else:
+                cursor.close()
+                self.stop()
+
+        cursor.tail(on_document)
+        self.wait()
+
+        self.assertEquals(received, [1, 2])
+
+        Database().command('drop', 'cursor_capped_test', callback=self.stop)
+        self.wait()
+
+    def test_close_cursor_releases_connection(self):
+        """[CursorTestCase] - Closing a cursor gives its connection back to the pool"""
+        for i in range(5):
+            self._insert_document({'_id': i, 'name': 'should be name %d' % i})
+
+        node = Database().fast_node(ReadPreference.PRIMARY)
+        in_use = node.pool.in_use
+
+        cursor = Cursor(database=Database(), collection='cursor_test', batch_size=2)
+        cursor.fetch_next().add_done_callback(self.stop)
+        self.assertTrue(self.wait().result())
+
+        self.assertTrue(cursor.alive)
+        self.assertEquals(node.pool.in_use, in_use + 1)
+
+        cursor.close()
+
+        self.assertFalse(cursor.alive)
+        self.assertEquals(node.pool.in_use, in_use)
+
+    def test_page_documents_with_keyset_tokens(self):
+        """[CursorTestCase] - Page documents with keyset tokens"""
+        for i in range(5):
+            self._insert_document({'_id': i, 'name': 'should be name %d' % (i % 2)})
+
+        pages, token = [], None
+        while True:
+            cursor = Cursor(database=Database(), collection='cursor_test',
+                            sort=[('name', 1)])
+            cursor.page(2, token).add_done_callback(self.stop)
+            documents, token = self.wait().result()
+            pages.append([doc['_id'] for doc in documents])
+            if token is None:
+                break
+
+        self.assertEquals(pages, [[0, 2], [4, 1], [3]])
+
     def test_find_documents_with_spec(self):
         """[CursorTestCase] - Find documents with spec"""
 
@@ -202,3 +340,44 @@ class CursorTestCase(testing.AsyncTestCase):
         self.assertEquals(len(result['comment']), 1)
         self.assertEquals(result['comment'][0]['author'], 'joe')
         self.assertIsNone(_)
+
+
+class MongosQuerySpecTestCase(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(MongosQuerySpecTestCase, self).setUp()
+        Database.init(["localhost:27027"], dbname='mongotor_test')
+        self.node = Database()._nodes[0]
+        self.node.is_mongos = True
+
+    def tearDown(self):
+        super(MongosQuerySpecTestCase, self).tearDown()
+        Database.disconnect()
+
+    def test_forward_read_preference_to_mongos(self):
+        """[MongosQuerySpecTestCase] - Forward read preference to mongos with $readPreference"""
+        cursor = Cursor(Database(), 'cursor_test', {'name': 'should be name'},
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+
+        spec = cursor._query_spec(self.node)
+
+        self.assertEquals(spec['$query'], {'name': 'should be name'})
+        self.assertEquals(spec['$readPreference'], {'mode': 'secondaryPreferred'})
+
+    def test_not_forward_primary_read_preference(self):
+        """[MongosQuerySpecTestCase] - Don't send $readPreference when preference is PRIMARY"""
+        cursor = Cursor(Database(), 'cursor_test', {'name': 'should be name'})
+
+        spec = cursor._query_spec(self.node)
+
+        self.assertNotIn('$readPreference', spec)
+
+    def test_wrap_command_with_read_preference(self):
+        """[MongosQuerySpecTestCase] - Wrap a command in $query to forward read preference"""
+        cursor = Cursor(Database(), '$cmd', {'count': 'cursor_test'}, is_command=True,
+            read_preference=ReadPreference.SECONDARY)
+
+        spec = cursor._query_spec(self.node)
+
+        self.assertEquals(list(spec.keys()), ['$query', '$readPreference'])
+        self.assertEquals(spec['$query'], {'count': 'cursor_test'})
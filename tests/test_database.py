@@ -1,8 +1,15 @@
 # coding: utf-8
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from functools import partial
 from tornado.ioloop import IOLoop
 from tornado import testing
 from mongotor.database import Database
 from mongotor.errors import DatabaseError
+from mongotor.node import ReadPreference
 from mongotor import message
 from mongotor import helpers
 from bson.objectid import ObjectId
@@ -79,6 +86,43 @@ class DatabaseTestCase(testing.AsyncTestCase):
         self.assertRaisesRegexp(DatabaseError, 'could not find an available node',
                                 send_message)
 
+    def test_raises_error_when_server_selection_timeout_expires(self):
+        """[DatabaseTestCase] - Raises DatabaseError when no node is found before server selection timeout"""
+
+        database = Database.init(["localhost:27030"], dbname='test',
+                                 server_selection_timeout=200)
+
+        def send_message():
+            database.send_message('', callback=self.stop)
+            self.wait()
+
+        self.assertRaisesRegexp(DatabaseError, 'could not find an available node',
+                                send_message)
+
+    def test_wait_for_primary_during_election(self):
+        """[DatabaseTestCase] - Wait for a primary to be elected before failing"""
+
+        database = Database.init(["localhost:27027", "localhost:27028"], dbname='test',
+                                 server_selection_timeout=2000)
+        primary, secondary = database._nodes
+        elected = []
+
+        def config(node, callback=None):
+            node.initialized = True
+            if elected:
+                node.available = node.is_primary = node is secondary
+            IOLoop.instance().add_callback(callback)
+
+        for node in database._nodes:
+            node.config = partial(config, node)
+
+        database.get_node(ReadPreference.PRIMARY, callback=self.stop)
+        IOLoop.instance().add_timeout(timedelta(milliseconds=600),
+                                      lambda: elected.append(True))
+
+        node = self.wait()
+        self.assertEquals(node, secondary)
+
     def test_run_command(self):
         """[DatabaseTestCase] - Run a database command"""
 
@@ -87,3 +131,69 @@ class DatabaseTestCase(testing.AsyncTestCase):
 
         response, error = self.wait()
         self.assertTrue(response['ok'])
+
+
+class TopologyFileTestCase(testing.AsyncTestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def setUp(self):
+        super(TopologyFileTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.topology_file = os.path.join(self.directory, 'topology.json')
+
+    def tearDown(self):
+        super(TopologyFileTestCase, self).tearDown()
+        Database._instance = None
+        shutil.rmtree(self.directory)
+
+    def test_route_with_saved_topology(self):
+        """[TopologyFileTestCase] - Route operations with the topology saved by a previous process"""
+        with open(self.topology_file, 'w') as f:
+            json.dump({'dbname': 'test', 'nodes': {
+                'localhost:27027': {'available': True, 'primary': False,
+                                    'secondary': True, 'mongos': False},
+                'localhost:27028': {'available': True, 'primary': True,
+                                    'secondary': False, 'mongos': False}}}, f)
+
+        database = Database.init(["localhost:27027", "localhost:27028"], dbname='test',
+                                 topology_file=self.topology_file)
+
+        node = database.select_node(ReadPreference.PRIMARY)
+        self.assertEquals(node.port, 27028)
+
+    def test_ignore_topology_of_another_database(self):
+        """[TopologyFileTestCase] - Ignore a topology file saved for another database"""
+        with open(self.topology_file, 'w') as f:
+            json.dump({'dbname': 'other', 'nodes': {
+                'localhost:27027': {'available': True, 'primary': True,
+                                    'secondary': False, 'mongos': False}}}, f)
+
+        database = Database.init(["localhost:27027"], dbname='test',
+                                 topology_file=self.topology_file)
+
+        self.assertIsNone(database.select_node(ReadPreference.PRIMARY))
+
+    def test_save_topology_when_connected(self):
+        """[TopologyFileTestCase] - Save the topology when all nodes are configured"""
+        database = Database.init(["localhost:27027", "localhost:27028"], dbname='test',
+                                 topology_file=self.topology_file)
+        database._connect(callback=self.stop)
+        self.wait()
+
+        with open(self.topology_file) as f:
+            saved = json.load(f)
+
+        self.assertEquals(saved['dbname'], 'test')
+        self.assertTrue(saved['nodes']['localhost:27027']['primary'])
+        self.assertTrue(saved['nodes']['localhost:27028']['secondary'])
+
+    def test_serve_operations_before_all_nodes_are_configured(self):
+        """[TopologyFileTestCase] - Serve operations as soon as a suitable node answered"""
+        database = Database.init(["localhost:27027", "localhost:27030"], dbname='test')
+
+        database.get_node(ReadPreference.PRIMARY, callback=self.stop)
+        node = self.wait()
+
+        self.assertEquals(node.port, 27027)
@@ -0,0 +1,82 @@
+# coding: utf-8
+import unittest
+from tornado import gen
+from tornado.ioloop import IOLoop
+from mongotor.errors import InterfaceError
+from mongotor.flight import SingleFlight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.flights = SingleFlight()
+        self.calls = []
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def operation(self, result=None, error=None):
+        def fn(callback):
+            self.calls.append(result)
+
+            def reply():
+                if error:
+                    raise error
+                callback(result)
+            self.io_loop.add_callback(reply)
+        return fn
+
+    def run_all(self, *calls):
+        @gen.coroutine
+        def call(key, fn):
+            try:
+                result = yield gen.Task(self.flights.call, key, fn)
+            except InterfaceError as e:
+                result = e
+            raise gen.Return(result)
+
+        @gen.coroutine
+        def run():
+            results = yield [call(key, fn) for key, fn in calls]
+            raise gen.Return(results)
+
+        return self.io_loop.run_sync(run)
+
+    def test_identical_operations_share_the_result(self):
+        """[SingleFlightTestCase] - identical operations in flight share the result"""
+        results = self.run_all((('test.users', b'a'), self.operation(1)),
+                               (('test.users', b'a'), self.operation(2)),
+                               (('test.users', b'b'), self.operation(3)))
+
+        self.assertEqual(results, [1, 1, 3])
+        self.assertEqual(self.calls, [1, 3])
+        self.assertEqual(len(self.flights), 0)
+
+    def test_callers_get_their_own_copy(self):
+        """[SingleFlightTestCase] - every caller gets its own copy of the result"""
+        results = self.run_all((('test.users', b'a'), self.operation([{'_id': 1}])),
+                               (('test.users', b'a'), self.operation([{'_id': 2}])))
+
+        self.assertEqual(results, [[{'_id': 1}], [{'_id': 1}]])
+        self.assertIsNot(results[0], results[1])
+        self.assertIsNot(results[0][0], results[1][0])
+
+    def test_operation_after_the_reply_is_sent(self):
+        """[SingleFlightTestCase] - an operation after the reply is sent again"""
+        self.run_all((('test.users', b'a'), self.operation(1)))
+        results = self.run_all((('test.users', b'a'), self.operation(2)))
+
+        self.assertEqual(results, [2])
+        self.assertEqual(self.calls, [1, 2])
+
+    def test_error_is_raised_to_every_caller(self):
+        """[SingleFlightTestCase] - the error is raised to every caller"""
+        error = InterfaceError('connection closed')
+        results = self.run_all((('test.users', b'a'), self.operation(error=error)),
+                               (('test.users', b'a'), self.operation(2)))
+
+        self.assertEqual(results, [error, error])
+        self.assertEqual(len(self.flights), 0)
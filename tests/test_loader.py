@@ -0,0 +1,118 @@
+# coding: utf-8
+import unittest
+from tornado import gen
+from tornado.ioloop import IOLoop
+from mongotor import loader
+from mongotor.cache import QueryCache
+from mongotor.errors import InterfaceError
+from mongotor.loader import IdLoader
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+        self.cache = QueryCache(ttl=0)
+
+
+class FakeCursor(object):
+    documents = {}
+    queries = []
+    error = None
+
+    def __init__(self, database, collection, spec, fields, read_preference=None, limit=0):
+        self.spec = spec
+        self.limit = limit
+        FakeCursor.queries.append(spec)
+
+    def find(self, callback):
+        if FakeCursor.error:
+            raise FakeCursor.error
+
+        _id = self.spec['_id']
+        ids = _id['$in'] if isinstance(_id, dict) else [_id]
+        documents = [self.documents[i] for i in ids if i in self.documents]
+        if self.limit == -1 and len(documents) == 1:
+            callback((documents[0], None))
+        else:
+            callback((documents, None))
+
+
+class IdLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.cursor, loader.Cursor = loader.Cursor, FakeCursor
+        FakeCursor.documents = dict((i, {'_id': i}) for i in range(5))
+        FakeCursor.queries = []
+        FakeCursor.error = None
+        self.loader = IdLoader(FakeDatabase(), max_batch=3)
+
+    def tearDown(self):
+        loader.Cursor = self.cursor
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def load(self, ids, **kwargs):
+        results = {}
+        for _id in ids:
+            self.loader.load('users', _id,
+                             callback=lambda result, _id=_id: results.setdefault(_id, result),
+                             **kwargs)
+        self.io_loop.run_sync(lambda: None)
+        return results
+
+    def test_lookups_of_an_iteration_are_batched(self):
+        """[IdLoaderTestCase] - lookups of an iteration are sent in one query"""
+        results = self.load([1, 2, 9])
+
+        self.assertEqual(FakeCursor.queries, [{'_id': {'$in': [1, 2, 9]}}])
+        self.assertEqual(results, {1: ({'_id': 1}, None), 2: ({'_id': 2}, None),
+                                   9: (None, None)})
+
+    def test_single_lookup_is_sent_as_is(self):
+        """[IdLoaderTestCase] - a single lookup is sent without $in"""
+        results = self.load([3, 3])
+
+        self.assertEqual(FakeCursor.queries, [{'_id': 3}])
+        self.assertEqual(results, {3: ({'_id': 3}, None)})
+
+    def test_batches_are_split_by_max_batch(self):
+        """[IdLoaderTestCase] - batches are split by max batch"""
+        self.load([0, 1, 2, 3, 4])
+
+        self.assertEqual(FakeCursor.queries, [{'_id': {'$in': [0, 1, 2]}},
+                                              {'_id': {'$in': [3, 4]}}])
+
+    def test_errors_are_raised_to_every_caller(self):
+        """[IdLoaderTestCase] - an error is raised in the context of every caller"""
+        FakeCursor.error = InterfaceError('connection closed')
+
+        @gen.coroutine
+        def load(_id):
+            try:
+                result = yield gen.Task(self.loader.load, 'users', _id)
+            except InterfaceError as e:
+                result = e
+            raise gen.Return(result)
+
+        @gen.coroutine
+        def run():
+            results = yield [load(1), load(2)]
+            raise gen.Return(results)
+
+        self.assertEqual(self.io_loop.run_sync(run), [FakeCursor.error, FakeCursor.error])
+
+    def test_only_lookups_by_id_are_batched(self):
+        """[IdLoaderTestCase] - only lookups by _id are batched"""
+        callback = {'callback': None}
+
+        self.assertTrue(self.loader.can_load('users', {'_id': 1}, callback))
+        self.assertFalse(self.loader.can_load('users', {'_id': 1, 'a': 1}, callback))
+        self.assertFalse(self.loader.can_load('users', {'_id': {'$gt': 1}}, callback))
+        self.assertFalse(self.loader.can_load('users', {'_id': 1}, {}))
+        self.assertFalse(self.loader.can_load('users', {'_id': 1},
+                                              dict(callback, session=object())))
+        self.assertFalse(self.loader.can_load('users', {'_id': 1},
+                                              dict(callback, fields={'_id': 0})))
+        self.assertFalse(self.loader.can_load('users', {'_id': 1}, dict(callback, cache=60)))
@@ -1,6 +1,7 @@
 # coding:utf-8
 import unittest
-from mongotor.node import ReadPreference, Node
+from mongotor.node import ReadPreference, Node, CircuitBreaker
+from mongotor.pool import OperationStats
 
 
 class ReadPreferenceTestCase(unittest.TestCase):
@@ -74,3 +75,246 @@ class ReadPreferenceTestCase(unittest.TestCase):
             self.secondary2, self.primary], ReadPreference.SECONDARY_PREFERRED)
 
         self.assertEquals(node_found, self.primary)
+
+
+class MongosReadPreferenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Database:
+            dbname = 'test'
+
+        self.mongos1 = Node(host='localhost', port=27017, database=Database)
+        self.mongos2 = Node(host='localhost', port=27018, database=Database)
+        self.mongos3 = Node(host='localhost', port=27019, database=Database)
+
+        for node, ping_time in ((self.mongos1, 2), (self.mongos2, 5), (self.mongos3, 80)):
+            node.available = True
+            node.is_primary = True
+            node.is_mongos = True
+            node.ping_time = ping_time
+
+    def test_spread_operations_across_near_mongos(self):
+        """[MongosReadPreferenceTestCase] - spread operations across mongos within the latency window"""
+        nodes = [self.mongos1, self.mongos2, self.mongos3]
+
+        self.mongos1.pool._connections = 5
+        self.mongos3.pool._connections = 0
+
+        for i in range(20):
+            node_found = ReadPreference.select_node(nodes, ReadPreference.PRIMARY)
+            self.assertEquals(node_found, self.mongos2)
+
+        self.mongos1.pool._connections = 0
+        self.mongos2.pool._connections = 5
+
+        for i in range(20):
+            node_found = ReadPreference.select_node(nodes, ReadPreference.PRIMARY)
+            self.assertEquals(node_found, self.mongos1)
+
+    def test_select_mongos_for_secondary_mode(self):
+        """[MongosReadPreferenceTestCase] - mongos is selected when preference is SECONDARY"""
+        self.mongos1.available = False
+        self.mongos2.available = False
+
+        node_found = ReadPreference.select_node([self.mongos1, self.mongos2,
+            self.mongos3], ReadPreference.SECONDARY)
+
+        self.assertEquals(node_found, self.mongos3)
+
+    def test_mongos_mode(self):
+        """[MongosReadPreferenceTestCase] - read preference document forwarded to mongos"""
+        self.assertIsNone(ReadPreference.mongos_mode(ReadPreference.PRIMARY))
+        self.assertEquals(ReadPreference.mongos_mode(ReadPreference.SECONDARY_PREFERRED),
+                          {'mode': 'secondaryPreferred'})
+
+
+class LeastLoadedReadPreferenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Database:
+            dbname = 'test'
+
+        self.primary = Node(host='localhost', port=27027, database=Database)
+        self.secondary1 = Node(host='localhost', port=27028, database=Database)
+        self.secondary2 = Node(host='localhost', port=27029, database=Database)
+
+        self.primary.available = True
+        self.primary.is_primary = True
+
+        for node in (self.secondary1, self.secondary2):
+            node.available = True
+            node.is_secondary = True
+            node.pool.stats.add(10)
+
+    def test_load_uses_outstanding_requests_and_latency(self):
+        """[LeastLoadedReadPreferenceTestCase] - node load grows with outstanding requests and latency"""
+        self.assertEquals(self.secondary1.load, 10)
+
+        self.secondary1.pool._connections = 3
+        self.secondary1.pool._waiters = 1
+        self.assertEquals(self.secondary1.load, 50)
+
+        self.secondary2.pool.stats.add(110)
+        self.assertEquals(self.secondary2.load, 30)
+
+    def test_avoid_busy_secondary(self):
+        """[LeastLoadedReadPreferenceTestCase] - get the less loaded secondary when preference is SECONDARY"""
+        self.secondary1.pool._connections = 5
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY)
+
+            self.assertEquals(node_found, self.secondary2)
+
+    def test_avoid_slow_secondary(self):
+        """[LeastLoadedReadPreferenceTestCase] - get the faster secondary when preference is SECONDARY_PREFERRED"""
+        for i in range(10):
+            self.secondary2.pool.stats.add(500)
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY_PREFERRED)
+
+            self.assertEquals(node_found, self.secondary1)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = OperationStats()
+
+    def test_open_after_consecutive_failures(self):
+        """[CircuitBreakerTestCase] - open the circuit after consecutive failures"""
+        breaker = CircuitBreaker(self.stats, max_consecutive_failures=3)
+
+        for i in range(2):
+            self.stats.add_failure()
+        self.assertTrue(breaker.acquire())
+
+        self.stats.add_failure()
+        self.assertFalse(breaker.acquire())
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+
+    def test_open_when_error_rate_is_high(self):
+        """[CircuitBreakerTestCase] - open the circuit when error rate is high"""
+        breaker = CircuitBreaker(self.stats, min_operations=10, max_error_rate=0.5)
+
+        for i in range(6):
+            self.stats.add(1)
+            self.stats.add_failure()
+        self.assertTrue(breaker.acquire())
+
+        self.stats.add_failure()
+        self.assertFalse(breaker.acquire())
+
+    def test_slow_operations_count_as_failures(self):
+        """[CircuitBreakerTestCase] - slow operations count in the error rate"""
+        breaker = CircuitBreaker(self.stats, min_operations=10, slow_latency=100)
+
+        for i in range(10):
+            self.stats.add(1000)
+        self.assertFalse(breaker.acquire())
+
+    def test_close_after_successful_probe(self):
+        """[CircuitBreakerTestCase] - close the circuit when the half open probe succeeds"""
+        breaker = CircuitBreaker(self.stats, max_consecutive_failures=1, backoff=0)
+        self.stats.add_failure()
+
+        self.assertTrue(breaker.acquire())  # probe
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.stats.add(1)
+        self.assertTrue(breaker.acquire())
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_reopen_after_failed_probe(self):
+        """[CircuitBreakerTestCase] - open the circuit again when the half open probe fails"""
+        breaker = CircuitBreaker(self.stats, max_consecutive_failures=1, backoff=10)
+        self.stats.add_failure()
+        self.assertFalse(breaker.acquire())
+
+        breaker._open_until = 0
+        self.assertTrue(breaker.acquire())  # probe
+        self.assertFalse(breaker.acquire())  # probe in flight
+
+        self.stats.add_failure()
+        self.assertFalse(breaker.acquire())
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+
+
+    def test_checking_does_not_take_the_probe(self):
+        """[CircuitBreakerTestCase] - checking an open circuit doesn't take its probe"""
+        breaker = CircuitBreaker(self.stats, max_consecutive_failures=1, backoff=10)
+        self.stats.add_failure()
+        self.assertTrue(breaker.ejected)
+
+        breaker._open_until = 0
+        for i in range(3):
+            self.assertFalse(breaker.ejected)
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+
+        self.assertTrue(breaker.acquire())  # probe
+        self.assertTrue(breaker.ejected)
+
+
+class EjectedNodeReadPreferenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Database:
+            dbname = 'test'
+
+        self.primary = Node(host='localhost', port=27027, database=Database)
+        self.secondary1 = Node(host='localhost', port=27028, database=Database)
+        self.secondary2 = Node(host='localhost', port=27029, database=Database)
+
+        self.primary.available = True
+        self.primary.is_primary = True
+
+        for node in (self.secondary1, self.secondary2):
+            node.available = True
+            node.is_secondary = True
+
+        for i in range(5):
+            self.secondary1.pool.stats.add_failure()
+
+    def test_skip_ejected_secondary(self):
+        """[EjectedNodeReadPreferenceTestCase] - skip ejected secondary when preference is SECONDARY"""
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY)
+
+            self.assertEquals(node_found, self.secondary2)
+
+    def test_use_primary_when_secondaries_are_ejected(self):
+        """[EjectedNodeReadPreferenceTestCase] - get primary when preference is SECONDARY_PREFERRED and secondaries are ejected"""
+        self.secondary2.available = False
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.SECONDARY_PREFERRED)
+
+        self.assertEquals(node_found, self.primary)
+
+    def test_use_ejected_node_when_there_is_no_other(self):
+        """[EjectedNodeReadPreferenceTestCase] - get ejected secondary when it is the only secondary"""
+        self.secondary2.available = False
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.SECONDARY)
+
+        self.assertEquals(node_found, self.secondary1)
+
+    def test_node_not_selected_keeps_its_probe(self):
+        """[EjectedNodeReadPreferenceTestCase] - a node checked but not selected keeps its probe"""
+        self.secondary1.healthy  # opens the circuit
+        self.secondary1.breaker._open_until = 0
+        self.secondary2.available = False
+
+        # the primary is selected, the recovering secondary is only checked
+        for i in range(3):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.PRIMARY_PREFERRED)
+            self.assertEquals(node_found, self.primary)
+
+        self.assertEquals(self.secondary1.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.secondary1.breaker.acquire())
@@ -0,0 +1,43 @@
+# coding: utf-8
+import unittest
+from datetime import datetime
+from bson import ObjectId
+from bson.son import SON
+from mongotor.errors import InvalidOperationError
+from mongotor.pagination import keyset_sort, encode_token, decode_token, keyset_spec
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+
+    def test_sort_is_made_total_by_id(self):
+        """[KeysetPaginationTestCase] - the sort ends with _id"""
+        self.assertEqual(keyset_sort(None), [('_id', 1)])
+        self.assertEqual(keyset_sort([('date', -1)]), [('date', -1), ('_id', 1)])
+        self.assertEqual(keyset_sort(SON([('_id', -1)])), [('_id', -1)])
+
+    def test_token_carries_the_sort_key_values(self):
+        """[KeysetPaginationTestCase] - the token carries the sort key values"""
+        sort = [('date', -1), ('author.name', 1), ('_id', 1)]
+        document = {'_id': ObjectId(), 'date': datetime(2012, 1, 2),
+                    'author': {'name': 'joe'}}
+
+        token = encode_token(sort, document)
+
+        self.assertEqual(decode_token(token, sort),
+                         [document['date'], 'joe', document['_id']])
+        self.assertNotIn('=', token)
+
+    def test_token_of_another_sort_is_refused(self):
+        """[KeysetPaginationTestCase] - a token of another sort is refused"""
+        token = encode_token([('_id', 1)], {'_id': 1})
+
+        self.assertRaises(InvalidOperationError, decode_token, token, [('a', 1), ('_id', 1)])
+        self.assertRaises(InvalidOperationError, decode_token, token, [('_id', -1)])
+        self.assertRaises(InvalidOperationError, decode_token, 'not a token', [('_id', 1)])
+
+    def test_spec_of_the_following_documents(self):
+        """[KeysetPaginationTestCase] - the spec selects the documents after the values"""
+        self.assertEqual(keyset_spec([('_id', 1)], [5]), {'_id': {'$gt': 5}})
+        self.assertEqual(keyset_spec([('date', -1), ('_id', 1)], [10, 5]),
+                         {'$or': [{'date': {'$lt': 10}},
+                                  {'date': 10, '_id': {'$gt': 5}}]})
@@ -1,12 +1,13 @@
 # coding: utf-8
+import unittest
 import six
 from tornado.ioloop import IOLoop
 from tornado import testing
 from bson import ObjectId
 from mongotor.connection import Connection
-from mongotor.pool import ConnectionPool
+from mongotor.pool import ConnectionPool, OperationStats, ReconnectGovernor
 from mongotor.database import Database
-from mongotor.errors import TooManyConnections
+from mongotor.errors import TooManyConnections, InterfaceError
 from mongotor import message
 
 
@@ -161,3 +162,76 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
             self.assertEquals(db._nodes[0].pool._connections, 0)
         finally:
             Database.disconnect()
+
+
+class OperationStatsTestCase(unittest.TestCase):
+
+    def test_moving_average_latency(self):
+        """[OperationStatsTestCase] - keep a moving average of latencies"""
+        stats = OperationStats(alpha=0.5)
+        self.assertIsNone(stats.latency)
+
+        stats.add(10)
+        stats.add(20)
+
+        self.assertEquals(stats.latency, 15)
+
+    def test_latency_percentile(self):
+        """[OperationStatsTestCase] - compute latency percentiles of recent operations"""
+        stats = OperationStats()
+        for latency in six.moves.range(1, 101):
+            stats.add(latency)
+
+        self.assertEquals(stats.percentile(50), 51)
+        self.assertEquals(stats.percentile(95), 95)
+        self.assertEquals(stats.percentile(100), 100)
+
+    def test_no_percentile_without_enough_samples(self):
+        """[OperationStatsTestCase] - percentile is unknown without enough samples"""
+        stats = OperationStats()
+        stats.add(10)
+
+        self.assertIsNone(stats.percentile(95))
+
+
+class ReconnectGovernorTestCase(unittest.TestCase):
+
+    def test_limit_concurrent_attempts(self):
+        """[ReconnectGovernorTestCase] - limit concurrent connection attempts"""
+        governor = ReconnectGovernor(max_attempts=1)
+        allowed = []
+
+        governor.acquire(allowed.append)
+        governor.acquire(allowed.append)
+
+        self.assertEquals(allowed, [None])
+        self.assertEquals(governor.waiting, 1)
+
+        governor.succeeded()
+        self.assertEquals(allowed, [None, None])
+        self.assertEquals(governor.waiting, 0)
+
+    def test_waiting_requests_fail_with_the_attempt(self):
+        """[ReconnectGovernorTestCase] - waiting requests fail with the attempt"""
+        governor = ReconnectGovernor(max_attempts=1)
+        results = []
+
+        governor.acquire(results.append)
+        governor.acquire(results.append)
+
+        error = InterfaceError('connection refused')
+        governor.failed(error)
+
+        self.assertEquals(results, [None, error])
+
+    def test_backoff_after_failure(self):
+        """[ReconnectGovernorTestCase] - back off after a failed attempt"""
+        governor = ReconnectGovernor(max_attempts=1, backoff=60, wait=False)
+        results = []
+
+        governor.acquire(results.append)
+        governor.failed(InterfaceError('connection refused'))
+
+        governor.acquire(results.append)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], InterfaceError)
@@ -79,3 +79,68 @@ class SecondaryPreferredTestCase(testing.AsyncTestCase):
         doc_found, error = self.wait()
 
         self.assertEquals(doc_found, doc)
+
+    def test_hedged_find_on_secondary(self):
+        """[SecondaryPreferredTestCase] - test hedged find sent to a second node"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test',
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+        db._connect(callback=self.stop)
+        self.wait()
+
+        doc = {'_id': ObjectId()}
+        db.test.insert(doc, callback=self.stop)
+        self.wait()
+
+        time.sleep(2)
+
+        # the secondary is always slower than its p95, so the query is hedged
+        secondary = db.select_node(ReadPreference.SECONDARY)
+        for i in range(10):
+            secondary.pool.stats.add(0)
+
+        db.test.find_one(doc, hedge=True, callback=self.stop)
+        doc_found, error = self.wait()
+
+        self.assertEquals(doc_found, doc)
+        # sending the hedge spent a token of the budget
+        self.assertTrue(db._hedge_budget.balance < 5)
+
+
+class NodeMonitorTestCase(testing.AsyncTestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def tearDown(self):
+        super(NodeMonitorTestCase, self).tearDown()
+        Database.disconnect()
+
+    def test_config_node_when_pool_is_saturated(self):
+        """[NodeMonitorTestCase] - Configure node through its monitoring connection when the pool is full"""
+        db = Database.init(["localhost:27027"], dbname='test', maxconnections=1)
+        node = db._nodes[0]
+
+        node.connection(self.stop)
+        connection = self.wait()
+
+        node.config(callback=self.stop)
+        self.wait()
+
+        self.assertTrue(node.available)
+        self.assertTrue(node.is_primary)
+        self.assertIsNotNone(node.ping_time)
+        self.assertEquals(node.pool.in_use, 1)
+        self.assertIsNone(node._monitor._pool)
+
+        connection.release()
+
+    def test_unavailable_node_when_monitor_cant_connect(self):
+        """[NodeMonitorTestCase] - Mark node unavailable when the monitoring connection fails"""
+        db = Database.init(["localhost:27030"], dbname='test')
+        node = db._nodes[0]
+
+        node.config(callback=self.stop)
+        self.wait()
+
+        self.assertTrue(node.initialized)
+        self.assertFalse(node.available)
@@ -0,0 +1,73 @@
+# coding: utf-8
+import socket
+import unittest
+from tornado.concurrent import Future
+from mongotor.resolver import CachingResolver, interleave_families
+from mongotor.errors import InterfaceError
+
+
+class FakeResolver(object):
+
+    def __init__(self):
+        self.futures = []
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+class InterleaveFamiliesTestCase(unittest.TestCase):
+
+    def test_alternate_address_families(self):
+        """[InterleaveFamiliesTestCase] - alternate address families"""
+        v6 = [(socket.AF_INET6, ('::1', 27017)), (socket.AF_INET6, ('::2', 27017))]
+        v4 = [(socket.AF_INET, ('127.0.0.1', 27017))]
+
+        self.assertEqual(interleave_families(v6 + v4), [v6[0], v4[0], v6[1]])
+        self.assertEqual(interleave_families(v4 + v6), [v4[0], v6[0], v6[1]])
+        self.assertEqual(interleave_families([]), [])
+
+
+class CachingResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeResolver()
+        self.resolver = CachingResolver(self.fake, ttl=60)
+
+    def test_ip_addresses_are_not_resolved(self):
+        """[CachingResolverTestCase] - ip addresses are not resolved"""
+        self.assertEqual(self.resolver.cached('127.0.0.1', 27017),
+                         [(socket.AF_INET, ('127.0.0.1', 27017))])
+        self.assertIsNone(self.resolver.cached('localhost', 27017))
+
+    def test_concurrent_lookups_share_a_query(self):
+        """[CachingResolverTestCase] - concurrent lookups share a query and are cached"""
+        results = []
+        self.resolver.resolve('mongo.example', 27017, results.append)
+        self.resolver.resolve('mongo.example', 27017, results.append)
+        self.assertEqual(len(self.fake.futures), 1)
+
+        addresses = [(socket.AF_INET, ('10.0.0.1', 27017))]
+        self.fake.futures[0].set_result(addresses)
+        self.resolver._on_resolve(('mongo.example', 27017), self.fake.futures[0])
+
+        self.assertEqual(results, [(addresses, None)] * 2)
+        self.assertEqual(self.resolver.cached('mongo.example', 27017), addresses)
+
+        self.resolver.resolve('mongo.example', 27017, results.append)
+        self.assertEqual(len(self.fake.futures), 1)
+        self.assertEqual(len(results), 3)
+
+    def test_failed_lookups_are_not_cached(self):
+        """[CachingResolverTestCase] - failed lookups are reported and not cached"""
+        results = []
+        self.resolver.resolve('mongo.example', 27017, results.append)
+
+        self.fake.futures[0].set_exception(IOError('unknown host'))
+        self.resolver._on_resolve(('mongo.example', 27017), self.fake.futures[0])
+
+        addresses, error = results[0]
+        self.assertIsNone(addresses)
+        self.assertIsInstance(error, InterfaceError)
+        self.assertIsNone(self.resolver.cached('mongo.example', 27017))
@@ -0,0 +1,255 @@
+# coding: utf-8
+import logging
+import struct
+import unittest
+import bson
+from tornado import gen
+from tornado.ioloop import IOLoop
+from mongotor.cache import QueryCache
+from mongotor.client import Client, _idempotent_update
+from mongotor.cursor import Cursor
+from mongotor.node import ReadPreference
+from mongotor.retry import RetryBudget
+from mongotor.errors import (is_retryable, InterfaceError, TooManyConnections,
+    DatabaseError, NotMasterError, IntegrityError, CursorNotFound)
+
+
+class RetryBudgetTestCase(unittest.TestCase):
+
+    def test_withdraw_until_budget_is_exhausted(self):
+        """[RetryBudgetTestCase] - withdraw tokens until budget is exhausted"""
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_operations_refill_the_budget(self):
+        """[RetryBudgetTestCase] - operations deposit tokens in the budget"""
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+        budget.withdraw()
+        budget.withdraw()
+
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_refused_withdrawal_is_logged_unless_silenced(self):
+        """[RetryBudgetTestCase] - a refused withdrawal is logged unless silenced"""
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('mongotor.retry')
+        logger.addHandler(handler)
+        try:
+            RetryBudget(max_tokens=0).withdraw()
+            RetryBudget(max_tokens=0, message=None).withdraw()
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].levelno, logging.WARNING)
+
+    def test_balance_never_exceeds_max_tokens(self):
+        """[RetryBudgetTestCase] - balance never exceeds max tokens"""
+        budget = RetryBudget(ratio=1, max_tokens=3)
+
+        for i in range(10):
+            budget.deposit()
+
+        self.assertEqual(budget.balance, 3)
+
+
+class RetryableErrorTestCase(unittest.TestCase):
+
+    def test_connection_errors_are_retryable(self):
+        """[RetryableErrorTestCase] - connection errors are retryable"""
+        self.assertTrue(is_retryable(InterfaceError('connection closed')))
+        self.assertTrue(is_retryable(NotMasterError('master has changed')))
+
+    def test_other_errors_are_not_retryable(self):
+        """[RetryableErrorTestCase] - busy pools and server errors are not retryable"""
+        self.assertFalse(is_retryable(TooManyConnections()))
+        self.assertFalse(is_retryable(CursorNotFound('cursor id not valid')))
+        self.assertFalse(is_retryable(DatabaseError('database error')))
+        self.assertFalse(is_retryable(IntegrityError('duplicate key')))
+        self.assertFalse(is_retryable(ValueError()))
+
+
+class FakeConnection(object):
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.sent = 0
+        self.pinned = False
+
+    def send_message(self, message, safe, callback):
+        self.sent += 1
+        callback(self.replies.pop(0))
+
+    def send_message_with_response(self, message, callback):
+        self.sent += 1
+        callback(self.replies.pop(0))
+
+    def pin(self):
+        self.pinned = True
+
+    def unpin(self):
+        self.pinned = False
+
+    def closed(self):
+        return False
+
+
+class FakeNode(object):
+    is_mongos = False
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def connection(self, callback, pool=None):
+        callback(self._connection)
+
+
+class FakeDatabase(object):
+    dbname = 'test'
+    single_flight = False
+    read_preference = ReadPreference.PRIMARY
+
+    def __init__(self, replies):
+        self.cache = QueryCache(ttl=0)
+        self.connection = FakeConnection(replies)
+        self.node = FakeNode(self.connection)
+        self.budget = RetryBudget()
+        self.refreshed = 0
+
+    def get_collection_name(self, collection):
+        return 'test.%s' % collection
+
+    def route(self, collection, operation):
+        return None
+
+    def fast_node(self, read_preference):
+        return self.node
+
+    def get_node(self, read_preference, session=None, tags=None, callback=None):
+        callback(self.node)
+
+    def refresh(self, callback):
+        self.refreshed += 1
+        callback()
+
+    def should_retry(self, error):
+        return is_retryable(error) and self.budget.withdraw()
+
+
+def error_reply(message):
+    document = bson.BSON.encode({'$err': message})
+    return struct.pack('<iqii', 2, 0, 0, 1) + document
+
+
+class WriteRetryTestCase(unittest.TestCase):
+
+    def write(self, method, *args):
+        return IOLoop.current().run_sync(lambda: gen.Task(method, *args))
+
+    def test_idempotent_write_is_retried(self):
+        """[WriteRetryTestCase] - an idempotent write is sent again after a lost connection"""
+        database = FakeDatabase([(None, InterfaceError('connection closed')),
+                                 ({'ok': 1}, None)])
+
+        response, error = self.write(Client(database, 'users').insert, {'_id': 1})
+
+        self.assertEqual(response, {'ok': 1})
+        self.assertEqual(database.connection.sent, 2)
+        self.assertEqual(database.refreshed, 1)
+
+    def test_write_is_not_applied_twice(self):
+        """[WriteRetryTestCase] - a write which can't be applied twice isn't sent again"""
+        for method, args in [('insert', ({'name': 'joe'},)),
+                             ('update', ({'_id': 1}, {'$inc': {'n': 1}}))]:
+            error = InterfaceError('connection closed')
+            database = FakeDatabase([(None, error)])
+
+            response, result = self.write(getattr(Client(database, 'users'), method), *args)
+
+            self.assertIs(result, error)
+            self.assertEqual(database.connection.sent, 1)
+
+    def test_write_refused_by_former_primary_is_retried(self):
+        """[WriteRetryTestCase] - a write refused by a former primary is sent again"""
+        database = FakeDatabase([(None, NotMasterError('not master')),
+                                 ({'ok': 1}, None)])
+
+        response, error = self.write(Client(database, 'users').update,
+                                     {'_id': 1}, {'$inc': {'n': 1}})
+
+        self.assertEqual(response, {'ok': 1})
+        self.assertEqual(database.connection.sent, 2)
+
+    def test_idempotent_updates(self):
+        """[WriteRetryTestCase] - replacements and $set updates are idempotent"""
+        self.assertTrue(_idempotent_update({'name': 'joe'}))
+        self.assertTrue(_idempotent_update({'$set': {'name': 'joe'}}))
+        self.assertFalse(_idempotent_update({'$set': {'name': 'joe'}, '$inc': {'n': 1}}))
+        self.assertFalse(_idempotent_update({'$push': {'tags': 'a'}}))
+
+
+class QueryRetryTestCase(unittest.TestCase):
+
+    def find(self, database):
+        cursor = Cursor(database, 'users', {'name': 'joe'})
+        return IOLoop.current().run_sync(lambda: gen.Task(cursor.find))
+
+    def test_query_is_retried_once(self):
+        """[QueryRetryTestCase] - a query is sent again once after a lost connection"""
+        database = FakeDatabase([(None, InterfaceError('connection closed')),
+                                 (error_reply('bad query'), None)])
+
+        self.assertRaises(DatabaseError, self.find, database)
+        self.assertEqual(database.connection.sent, 2)
+        self.assertEqual(database.refreshed, 1)
+
+    def test_server_errors_are_not_retried(self):
+        """[QueryRetryTestCase] - a query failed with a server error isn't sent again"""
+        database = FakeDatabase([(error_reply('bad query'), None)])
+
+        self.assertRaises(DatabaseError, self.find, database)
+        self.assertEqual(database.connection.sent, 1)
+
+    def test_retries_are_limited_by_the_budget(self):
+        """[QueryRetryTestCase] - a query isn't retried when the budget is exhausted"""
+        database = FakeDatabase([(None, InterfaceError('connection closed'))])
+        database.budget = RetryBudget(max_tokens=0)
+
+        self.assertRaises(InterfaceError, self.find, database)
+        self.assertEqual(database.connection.sent, 1)
+
+
+class DroppedConnection(FakeConnection):
+
+    def send_message_with_response(self, message, callback):
+        raise InterfaceError('could not reconnect')
+
+
+class PrefetchErrorTestCase(unittest.TestCase):
+
+    def test_dropped_connection_while_prefetching(self):
+        """[PrefetchErrorTestCase] - a getMore failing to send doesn't lose documents nor hang the cursor"""
+        database = FakeDatabase([])
+        connection = DroppedConnection([])
+        cursor = Cursor(database, 'users', {}, batch_size=2, prefetch=1)
+        cursor._cursor_id = 42
+        cursor._pin(connection)
+        cursor._on_batch({'data': [{'_id': 1}, {'_id': 2}], 'cursor_id': 42}, 20)
+
+        self.assertEqual(cursor.next_object(), {'_id': 1})
+        # prefetches the next batch
+        self.assertEqual(cursor.next_object(), {'_id': 2})
+        self.assertFalse(cursor._fetching)
+        self.assertFalse(connection.pinned)
+
+        self.assertRaises(InterfaceError, IOLoop.current().run_sync, cursor.fetch_next)
+        self.assertFalse(cursor.alive)
@@ -0,0 +1,97 @@
+# coding: utf-8
+import unittest
+from mongotor.client import Client
+from mongotor.database import Database
+from mongotor.errors import DatabaseError
+from mongotor.node import ReadPreference, Node
+from mongotor.routing import Route, RoutingTable
+
+
+class RoutingTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.routing = RoutingTable([
+            Route('reports.*', read_preference=ReadPreference.SECONDARY,
+                  tags={'use': 'analytics'}, pool='analytics', timeout=30000),
+            Route('*', operations=['aggregate', 'mapReduce'],
+                  read_preference=ReadPreference.SECONDARY_PREFERRED),
+        ])
+
+    def test_route_by_collection_pattern(self):
+        """[RoutingTableTestCase] - route operations by collection pattern"""
+        route = self.routing.route('reports.daily', 'find')
+
+        self.assertEqual(route.read_preference, ReadPreference.SECONDARY)
+        self.assertEqual(route.pool, 'analytics')
+        self.assertEqual(route.timeout, 30000)
+        self.assertIsNone(self.routing.route('users', 'find'))
+
+    def test_route_by_operation(self):
+        """[RoutingTableTestCase] - route operations by type, ignoring case"""
+        self.assertEqual(self.routing.route('users', 'mapreduce').read_preference,
+                         ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(self.routing.route('users', 'aggregate').read_preference,
+                         ReadPreference.SECONDARY_PREFERRED)
+        self.assertIsNone(self.routing.route('users', 'count'))
+
+    def test_first_matching_route_applies(self):
+        """[RoutingTableTestCase] - the first matching route applies"""
+        self.routing.add('*', read_preference=ReadPreference.PRIMARY_PREFERRED)
+
+        self.assertEqual(self.routing.route('reports.daily', 'aggregate').pool, 'analytics')
+        self.assertEqual(self.routing.route('users', 'find').read_preference,
+                         ReadPreference.PRIMARY_PREFERRED)
+
+
+    def test_routes_require_an_initialized_database(self):
+        """[RoutingTableTestCase] - routing on a database not initialized raises DatabaseError"""
+        database = object.__new__(Database)
+        database._initialized = False
+
+        self.assertRaises(DatabaseError, database.route, 'users', 'find')
+        self.assertRaises(DatabaseError, getattr, database, 'routing')
+        self.assertRaises(DatabaseError, Client, database, 'users')
+
+
+class TagSetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Database:
+            dbname = 'test'
+
+        self.primary = Node(host='localhost', port=27027, database=Database)
+        self.secondary1 = Node(host='localhost', port=27028, database=Database)
+        self.secondary2 = Node(host='localhost', port=27029, database=Database)
+
+        self.primary.available = True
+        self.primary.is_primary = True
+
+        for secondary in (self.secondary1, self.secondary2):
+            secondary.available = True
+            secondary.is_secondary = True
+
+        self.secondary1.tags = {'use': 'oltp', 'dc': 'east'}
+        self.secondary2.tags = {'use': 'analytics', 'dc': 'east'}
+        self.nodes = [self.primary, self.secondary1, self.secondary2]
+
+    def test_select_secondary_matching_tags(self):
+        """[TagSetsTestCase] - select the secondaries matching the tag set"""
+        nodes = ReadPreference.filter_tags(self.nodes, {'use': 'analytics'})
+
+        for i in range(10):
+            self.assertEqual(ReadPreference.select_node(nodes, ReadPreference.SECONDARY),
+                             self.secondary2)
+
+    def test_tag_sets_by_order_of_preference(self):
+        """[TagSetsTestCase] - use the first tag set matching a secondary"""
+        nodes = ReadPreference.filter_tags(self.nodes, [{'use': 'reporting'},
+                                                        {'dc': 'east', 'use': 'oltp'}])
+        self.assertEqual(nodes, [self.primary, self.secondary1])
+
+    def test_fallback_to_primary_when_no_secondary_matches(self):
+        """[TagSetsTestCase] - fall back to the primary when no secondary matches"""
+        nodes = ReadPreference.filter_tags(self.nodes, {'dc': 'west'})
+
+        self.assertIsNone(ReadPreference.select_node(nodes, ReadPreference.SECONDARY))
+        self.assertEqual(ReadPreference.select_node(nodes, ReadPreference.SECONDARY_PREFERRED),
+                         self.primary)
@@ -0,0 +1,86 @@
+# coding: utf-8
+import unittest
+from collections import deque
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from mongotor.scan import ParallelScan, partition_specs, _evenly
+
+
+class FakeCursor(object):
+
+    def __init__(self, batches):
+        self._batches = deque(batches)
+        self._data = deque()
+
+    def fetch_next(self):
+        future = Future()
+        if not self._data and self._batches:
+            self._data.extend(self._batches.popleft())
+        IOLoop.current().add_callback(future.set_result, bool(self._data))
+        return future
+
+    def next_object(self):
+        return self._data.popleft() if self._data else None
+
+    def close(self):
+        self._batches.clear()
+
+
+class PartitionSpecsTestCase(unittest.TestCase):
+
+    def test_split_points_delimit_ranges(self):
+        """[PartitionSpecsTestCase] - split points delimit half open ranges"""
+        specs = partition_specs({}, '_id', [10, 20])
+
+        self.assertEqual(specs, [{'_id': {'$lt': 10}},
+                                 {'_id': {'$gte': 10, '$lt': 20}},
+                                 {'_id': {'$gte': 20}}])
+
+    def test_spec_restricts_every_range(self):
+        """[PartitionSpecsTestCase] - the spec restricts every range"""
+        specs = partition_specs({'active': True}, 'uid', [5])
+
+        self.assertEqual(specs, [{'$and': [{'active': True}, {'uid': {'$lt': 5}}]},
+                                 {'$and': [{'active': True}, {'uid': {'$gte': 5}}]}])
+
+    def test_without_split_points_spec_is_kept(self):
+        """[PartitionSpecsTestCase] - without split points the spec is kept"""
+        self.assertEqual(partition_specs({'a': 1}, '_id', []), [{'a': 1}])
+        self.assertEqual(partition_specs(None, '_id', []), [{}])
+
+    def test_evenly_spaced_points(self):
+        """[PartitionSpecsTestCase] - keep evenly spaced split points"""
+        self.assertEqual(_evenly(list(range(40)), 4), [10, 20, 30])
+        self.assertEqual(_evenly([1, 2], 4), [1, 2])
+
+
+class ParallelScanTestCase(unittest.TestCase):
+
+    def scan(self, cursors, ordered=False):
+        scan = ParallelScan(None, 'users', partitions=len(cursors), ordered=ordered)
+        scan._cursors = cursors
+
+        @gen.coroutine
+        def read():
+            documents = []
+            while (yield scan.fetch_next()):
+                documents.append(scan.next_object())
+            raise gen.Return(documents)
+
+        return IOLoop.current().run_sync(read)
+
+    def test_stream_documents_of_every_partition(self):
+        """[ParallelScanTestCase] - stream the documents of every partition"""
+        documents = self.scan([FakeCursor([[1, 2], [3]]),
+                               FakeCursor([[10], [11, 12]]),
+                               FakeCursor([])])
+
+        self.assertEqual(sorted(documents), [1, 2, 3, 10, 11, 12])
+
+    def test_ordered_scan_reads_partitions_in_order(self):
+        """[ParallelScanTestCase] - an ordered scan reads the partitions in order"""
+        documents = self.scan([FakeCursor([[1, 2], [3]]),
+                               FakeCursor([[10], [11, 12]])], ordered=True)
+
+        self.assertEqual(documents, [1, 2, 3, 10, 11, 12])
@@ -0,0 +1,133 @@
+# coding: utf-8
+import unittest
+from bson import ObjectId
+from bson.timestamp import Timestamp
+from tornado.ioloop import IOLoop
+from mongotor.node import ReadPreference, Node
+from mongotor.orm import manager
+from mongotor.orm.collection import Collection
+from mongotor.orm.field import ObjectIdField, StringField
+from mongotor.session import Session
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Database:
+            dbname = 'test'
+
+        self.primary = Node(host='localhost', port=27027, database=Database)
+        self.secondary1 = Node(host='localhost', port=27028, database=Database)
+        self.secondary2 = Node(host='localhost', port=27029, database=Database)
+
+        self.primary.available = True
+        self.primary.is_primary = True
+        self.primary.optime = Timestamp(100, 2)
+
+        for secondary in (self.secondary1, self.secondary2):
+            secondary.available = True
+            secondary.is_secondary = True
+
+        self.secondary1.optime = Timestamp(100, 1)
+        self.secondary2.optime = Timestamp(90, 1)
+
+        self.nodes = [self.primary, self.secondary1, self.secondary2]
+
+    def test_reads_follow_read_preference_without_writes(self):
+        """[SessionTestCase] - reads follow the read preference without writes"""
+        session = Session()
+
+        node = session.select_node(self.nodes, ReadPreference.SECONDARY_PREFERRED)
+        self.assertTrue(node.is_secondary)
+        self.assertEqual(session.read_preference(ReadPreference.SECONDARY),
+                         ReadPreference.SECONDARY)
+
+    def test_reads_go_to_primary_after_a_write(self):
+        """[SessionTestCase] - reads go to the primary after a write"""
+        session = Session(window=10)
+        session.record_write()
+
+        for i in range(10):
+            node = session.select_node(self.nodes, ReadPreference.SECONDARY_PREFERRED)
+            self.assertEqual(node, self.primary)
+
+        self.assertEqual(session.read_preference(ReadPreference.SECONDARY),
+                         ReadPreference.PRIMARY)
+
+    def test_reads_go_to_caught_up_secondary(self):
+        """[SessionTestCase] - reads go to a secondary which replicated the write"""
+        session = Session(window=10)
+        session.record_write({'ok': 1, 'err': None, 'lastOp': Timestamp(100, 1)})
+
+        for i in range(10):
+            node = session.select_node(self.nodes, ReadPreference.SECONDARY_PREFERRED)
+            self.assertEqual(node, self.secondary1)
+
+    def test_optime_documents_are_understood(self):
+        """[SessionTestCase] - protocol version 1 optimes are understood"""
+        session = Session(window=10)
+        session.record_write({'lastOp': {'ts': Timestamp(100, 2), 't': 1}})
+
+        node = session.select_node(self.nodes, ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(node, self.primary)
+
+    def test_window_expires(self):
+        """[SessionTestCase] - reads follow the read preference once the window expired"""
+        session = Session(window=0)
+        session.record_write()
+
+        self.assertFalse(session.pinned)
+        node = session.select_node(self.nodes, ReadPreference.SECONDARY)
+        self.assertTrue(node.is_secondary)
+
+
+class SessionUserTest(Collection):
+    __collection__ = "session_user_test"
+
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class FakeClient(object):
+
+    queries = []
+
+    def __init__(self, database, collection):
+        pass
+
+    def find_one(self, spec_or_id, callback, **kwargs):
+        self.queries.append(('find_one', kwargs.get('session')))
+        callback(({'_id': ObjectId(), 'name': u'joe'}, None))
+
+    def find(self, spec, callback, **kwargs):
+        self.queries.append(('find', kwargs.get('session')))
+        callback(([{'_id': ObjectId(), 'name': u'joe'}], None))
+
+
+class ManagerSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+        self.client = manager.Client
+        manager.Client = FakeClient
+        FakeClient.queries = []
+
+    def tearDown(self):
+        manager.Client = self.client
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def test_queries_are_sent_with_the_session(self):
+        """[ManagerSessionTestCase] - the manager queries are sent with the session"""
+        session = Session()
+
+        self.io_loop.run_sync(lambda: SessionUserTest.objects.find_one(
+            {'name': u'joe'}, session=session))
+        self.io_loop.run_sync(lambda: SessionUserTest.objects.find(
+            {'name': u'joe'}, session=session))
+        self.io_loop.run_sync(lambda: SessionUserTest.objects.find({}))
+
+        self.assertEqual(FakeClient.queries, [('find_one', session),
+            ('find', session), ('find', None)])
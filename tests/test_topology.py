@@ -0,0 +1,73 @@
+# coding: utf-8
+import unittest
+from mongotor.database import Database
+from mongotor.errors import DatabaseError
+from mongotor.node import ReadPreference, Node
+from mongotor.topology import Topology
+
+
+class TopologyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Database:
+            dbname = 'test'
+
+        self.primary = Node(host='localhost', port=27027, database=Database)
+        self.secondary1 = Node(host='localhost', port=27028, database=Database)
+        self.secondary2 = Node(host='localhost', port=27029, database=Database)
+
+        self.primary.available = True
+        self.primary.is_primary = True
+
+        self.secondary1.available = True
+        self.secondary1.is_secondary = True
+
+        self.nodes = [self.primary, self.secondary1, self.secondary2]
+
+    def test_precompute_candidates(self):
+        """[TopologyTestCase] - precompute the candidates of the read preferences"""
+        topology = Topology(self.nodes)
+
+        self.assertEqual(topology.primary, self.primary)
+        self.assertEqual(topology.secondaries, (self.secondary1,))
+        self.assertEqual(topology.mongos, ())
+
+    def test_select_node(self):
+        """[TopologyTestCase] - select nodes as the read preferences do"""
+        topology = Topology(self.nodes)
+
+        self.assertEqual(topology.select_node(), self.primary)
+        self.assertEqual(topology.select_node(ReadPreference.SECONDARY), self.secondary1)
+        self.assertEqual(topology.select_node(ReadPreference.SECONDARY_PREFERRED),
+                         self.secondary1)
+
+        self.secondary1.available = False
+        topology = Topology(self.nodes, topology.version + 1)
+
+        self.assertIsNone(topology.select_node(ReadPreference.SECONDARY))
+        self.assertEqual(topology.select_node(ReadPreference.SECONDARY_PREFERRED),
+                         self.primary)
+
+    def test_snapshot_is_not_affected_by_node_changes(self):
+        """[TopologyTestCase] - a snapshot keeps the state it was built with"""
+        topology = Topology(self.nodes)
+        self.assertFalse(topology.changed(self.nodes))
+
+        self.primary.is_primary = False
+        self.primary.is_secondary = True
+
+        self.assertTrue(topology.changed(self.nodes))
+        self.assertEqual(topology.select_node(ReadPreference.PRIMARY), self.primary)
+
+    def test_database_topology(self):
+        """[TopologyTestCase] - the database exposes its current snapshot once initialized"""
+        database = object.__new__(Database)
+        database._initialized = False
+        with self.assertRaises(DatabaseError):
+            database.topology
+
+        database._initialized = True
+        database._snapshot = Topology(self.nodes)
+
+        self.assertIs(database.topology, database._snapshot)
+        self.assertEqual(database.topology.primary, self.primary)